@@ -0,0 +1,62 @@
+"""Compare the per-image PIL augmentation of main_train.py with BatchAugment.
+
+Run from the root of the repository:
+
+    python -m benchmarks.augment [--root ROOT] [--images 256] [--batch_size 64]
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from src.transforms import train_transform
+from src import BatchAugment, HAM10000
+
+
+def load_images(root: str, count: int) -> list:
+    if root is None:
+        rng = np.random.default_rng(0)
+        return [Image.fromarray(rng.integers(0, 256, (450, 600, 3), dtype=np.uint8)) for _ in range(count)]
+
+    dataset = HAM10000.load_from_file(root, train=True, use_store=False)
+    return [Image.open(dataset.paths[i % len(dataset)]).convert("RGB") for i in range(count)]
+
+
+def bench_pil(images: list, batch_size: int) -> float:
+    start = time.perf_counter()
+    for i in range(0, len(images), batch_size):
+        torch.stack([train_transform(img) for img in images[i:i + batch_size]])
+
+    return len(images) / (time.perf_counter() - start)
+
+
+def bench_batch(images: list, batch_size: int, device: str) -> float:
+    augment = BatchAugment()
+    arrays = [torch.from_numpy(np.asarray(img)).permute(2, 0, 1) for img in images]
+
+    start = time.perf_counter()
+    for i in range(0, len(arrays), batch_size):
+        augment(torch.stack(arrays[i:i + batch_size]).to(device))
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+    return len(images) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, default=None, help="Root to the HAM10000 images. Default: random images")
+    parser.add_argument("--images", type=int, default=256, help="Number of images. Default: 256")
+    parser.add_argument("--batch_size", type=int, default=64, help="Batch size. Default: 64")
+    parser.add_argument("--device", type=str, default="cpu", help="Device of the batched augmentation. Default: cpu")
+    args = parser.parse_args()
+
+    images = load_images(args.root, args.images)
+
+    pil = bench_pil(images, args.batch_size)
+    batch = bench_batch(images, args.batch_size, args.device)
+
+    print(f"PIL transforms:     {pil:8.1f} images/s")
+    print(f"BatchAugment ({args.device}): {batch:8.1f} images/s (x{batch / pil:.2f})")
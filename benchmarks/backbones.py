@@ -0,0 +1,93 @@
+"""Compare the types of model: parameters, FLOPs, CPU latency and test accuracy.
+
+Run from the root of the repository:
+
+    python -m benchmarks.backbones [--root ROOT] [--checkpoints model/model_{type}.pth] [--threads 4]
+
+The latency is measured on randomly initialized models (it does not depend on the weights).
+The accuracy is computed on the test split of ROOT for the types whose checkpoint exists.
+"""
+import argparse
+import os
+import time
+
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.flop_counter import FlopCounterMode
+
+from src.transforms import test_transform
+from src import MODEL_TYPES, HAM10000, HAM10000_model, load_model
+from src.backend import TorchBackend
+
+
+def flops(model: torch.nn.Module, image: torch.Tensor) -> float:
+    """FLOPs of one forward pass (a multiply-add counts as 2)"""
+
+    counter = FlopCounterMode(display=False)
+    with torch.inference_mode(), counter:
+        model(image)
+
+    return counter.get_total_flops()
+
+
+def latency(backend: TorchBackend, batch: torch.Tensor, repeat: int) -> float:
+    backend(batch)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        backend(batch)
+
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def accuracy(backend: TorchBackend, loader: DataLoader) -> float:
+    correct = 0
+    for X, y in loader:
+        correct += (backend(X).argmax(1) == y).sum().item()
+
+    return correct / len(loader.dataset)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, default=None, help="Root to the images. Default: no accuracy")
+    parser.add_argument("--checkpoints", type=str, default="model/model_{type}.pth",
+                        help="Checkpoint of each type of model. Default: model/model_{type}.pth")
+    parser.add_argument("--types", type=str, default=",".join(MODEL_TYPES),
+                        help=f"Types of model. Default: {','.join(MODEL_TYPES)}")
+    parser.add_argument("--batch_size", type=int, default=16, help="Size of the batched measure. Default: 16")
+    parser.add_argument("--repeat", type=int, default=10, help="Repetitions of each measure. Default: 10")
+    parser.add_argument("--threads", type=int, default=None, help="Number of PyTorch threads. Default: PyTorch default")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    loader = None
+    if args.root is not None:
+        dataset = HAM10000.load_from_file(args.root, train=False, transform=test_transform)
+        loader = DataLoader(dataset, batch_size=32)
+
+    batch = torch.rand(args.batch_size, 3, 450, 600)
+
+    print(f"Threads: {torch.get_num_threads()}")
+    print(f"{'type':20} {'params (M)':>11} {'GFLOPs':>8} {'1 image (ms)':>13} "
+          f"{f'{args.batch_size} images (ms)':>15} {'images/s':>9} {'accuracy':>9}")
+    for model_type in [t.strip() for t in args.types.split(",") if t.strip()]:
+        checkpoint = args.checkpoints.format(type=model_type)
+        if os.path.exists(checkpoint):
+            model = load_model(checkpoint, 7, model_type)
+        else:
+            model = HAM10000_model(7, model_type=model_type, pretrained=False).eval()
+        backend = TorchBackend(model)
+
+        params = sum(p.numel() for p in model.parameters()) / 1e6
+        gflops = flops(model, batch[:1]) / 1e9
+        single = latency(backend, batch[:1], args.repeat)
+        batched = latency(backend, batch, args.repeat)
+
+        score = "-"
+        if loader is not None and os.path.exists(checkpoint):
+            score = f"{accuracy(backend, loader):.4f}"
+
+        print(f"{model_type:20} {params:11.2f} {gflops:8.2f} {single:13.1f} {batched:15.1f} "
+              f"{1000 * args.batch_size / batched:9.1f} {score:>9}")
@@ -0,0 +1,57 @@
+"""Check the accuracy of an execution mode against fp32 on the test split.
+
+Run from the root of the repository:
+
+    python -m benchmarks.execution ROOT --checkpoint model/model_resnet34.pth --mode bf16,channels_last
+"""
+import argparse
+import copy
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+from src.transforms import test_transform
+from src import ExecutionMode, HAM10000, load_model
+
+
+def predict(model: torch.nn.Module, mode: ExecutionMode, loader: DataLoader) -> tuple:
+    model = mode.prepare_model(copy.deepcopy(model)).eval()
+    preds, labels = [], []
+
+    start = time.perf_counter()
+    with torch.inference_mode(), mode.autocast():
+        for X, y in loader:
+            preds.append(model(mode.prepare_input(X)).float().argmax(1))
+            labels.append(y)
+
+    return torch.cat(preds), torch.cat(labels), time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", nargs=1, help='Root to the images')
+    parser.add_argument("--checkpoint", type=str, default="model/model_resnet34.pth",
+                        help="Checkpoint to evaluate. Default: model/model_resnet34.pth")
+    parser.add_argument("--type", type=str, default="resnet34", help="Type of model. Default: resnet34")
+    parser.add_argument("--mode", type=str, default="bf16,channels_last",
+                        help="Execution mode to compare with fp32. Default: bf16,channels_last")
+    parser.add_argument("--batch_size", type=int, default=32, help="Batch size. Default: 32")
+    args = parser.parse_args()
+
+    dataset = HAM10000.load_from_file(args.root[0], train=False, transform=test_transform)
+    loader = DataLoader(dataset, batch_size=args.batch_size)
+
+    model = load_model(args.checkpoint, 7, args.type)
+
+    mode = ExecutionMode.from_name(args.mode)
+    ref_preds, labels, ref_time = predict(model, ExecutionMode(), loader)
+    preds, _, mode_time = predict(model, mode, loader)
+
+    ref_accuracy = (ref_preds == labels).float().mean().item()
+    accuracy = (preds == labels).float().mean().item()
+    agreement = (preds == ref_preds).float().mean().item()
+
+    print(f"fp32:  accuracy {ref_accuracy:.4f}, {len(dataset) / ref_time:.1f} images/s")
+    print(f"{mode}: accuracy {accuracy:.4f}, {len(dataset) / mode_time:.1f} images/s")
+    print(f"Accuracy delta: {accuracy - ref_accuracy:+.4f}, same prediction as fp32: {agreement:.2%}")
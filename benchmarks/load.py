@@ -0,0 +1,285 @@
+"""Load test of the /predict endpoint: latency percentiles, throughput and error rate.
+
+Run from the root of the repository. Against a local server using a randomly initialized
+model and synthetic images (no trained checkpoint, no network):
+
+    python -m benchmarks.load --local --duration 30 --concurrency 8 --mix none:0.8,Low:0.2
+
+Closed loop (--concurrency clients sending their next request as soon as the previous one
+is answered) or open loop (--rate requests per second, Poisson arrivals, whatever the
+latency). In open loop, the latency is measured from the scheduled start of each request.
+
+Against a running server:
+
+    python -m benchmarks.load --url http://127.0.0.1:8089 --rate 20 --duration 60
+"""
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+import torch
+from PIL import Image
+
+from src import HAM10000_model, make_session, send_image
+
+PRECISIONS = ("Low", "Medium", "High", "Auto")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_mix(mix: str) -> dict:
+    """Parse a mix of requests, e.g. "none:0.8,Low:0.2" (none: prediction without explanation)
+
+    Args:
+        mix (str): Kinds of requests and their weights
+
+    Returns:
+        dict: Normalized weight of each kind
+    """
+
+    weights = {}
+    for item in mix.split(","):
+        kind, _, weight = item.partition(":")
+        if kind not in ("none",) + PRECISIONS:
+            raise ValueError(f"Invalid kind of request: {kind} (kinds: none, {', '.join(PRECISIONS)})")
+        weights[kind] = float(weight or 1)
+
+    total = sum(weights.values())
+    return {kind: weight / total for kind, weight in weights.items() if weight > 0}
+
+
+def synthetic_images(count: int, seed: int = 0) -> list:
+    """JPEG images of random noise, the size of the HAM10000 images
+
+    Args:
+        count (int): Number of images
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        list: Encoded images
+    """
+
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        buffer = io.BytesIO()
+        Image.fromarray(rng.integers(0, 256, (450, 600, 3), dtype=np.uint8)).save(buffer, "JPEG", quality=90)
+        images.append(buffer.getvalue())
+
+    return images
+
+
+def start_local_server(model_dir: str, model_type: str, port: int, timeout: float = 300) -> subprocess.Popen:
+    """Start src/server.py with a randomly initialized model and without result cache
+
+    Args:
+        model_dir (str): Directory where the checkpoint is saved
+        model_type (str): Type of model
+        port (int): Port of the server
+        timeout (float, optional): Maximum time (in seconds) to wait for the server. Defaults to 300.
+
+    Returns:
+        subprocess.Popen: The server process
+    """
+
+    torch.save(HAM10000_model(7, model_type=model_type, pretrained=False).state_dict(),
+               os.path.join(model_dir, f"model_{model_type}.pth"))
+
+    env = dict(os.environ, MODEL=model_type, MODELS=model_type, MODEL_DIR=model_dir, BACKEND="torch",
+               CACHE_MAX_MB="0", CACHE_DIR="", JOB_DIR="")
+    code = f"import server; server.app.run('127.0.0.1', port={port}, threaded=True)"
+    process = subprocess.Popen([sys.executable, "-c", code], cwd=os.path.join(ROOT, "src"), env=env)
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The server has stopped")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/ready", timeout=1).ok:
+                return process
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.5)
+
+    process.terminate()
+    raise RuntimeError("The server is not ready")
+
+
+class LoadTest:
+    def __init__(self, url: str, images: list, mix: dict, connections: int, seed: int = 0):
+        """Send requests to the server and record their latencies
+
+        Args:
+            url (str): URL of the /predict endpoint
+            images (list): Encoded images, sent in turn
+            mix (dict): Weight of each kind of request (see parse_mix)
+            connections (int): Number of connections kept alive
+            seed (int, optional): Random seed of the mix. Defaults to 0.
+        """
+
+        self.url = url
+        self.images = images
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.session = make_session(connections, retries=0)
+        self.random = random.Random(seed)
+
+        self.records = []
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def _next(self) -> tuple:
+        with self._lock:
+            image = self.images[self._count % len(self.images)]
+            self._count += 1
+            kind = self.random.choices(self.kinds, self.weights)[0]
+
+        return image, kind
+
+    def request(self, start: float = None) -> None:
+        """Send one request
+
+        Args:
+            start (float, optional): Time the request was scheduled (open loop). Defaults to now.
+        """
+
+        image, kind = self._next()
+        start = start or time.perf_counter()
+        explain = kind != "none"
+        data = send_image(image, self.url, explain, kind if explain else "Medium", session=self.session)
+        latency = time.perf_counter() - start
+
+        with self._lock:
+            self.records.append((kind, latency, bool(data.get('success'))))
+
+    def closed_loop(self, concurrency: int, duration: float, requests_count: int = None) -> None:
+        deadline = time.perf_counter() + duration
+
+        def client():
+            while time.perf_counter() < deadline:
+                with self._lock:
+                    if requests_count is not None and self._count >= requests_count:
+                        return
+                self.request()
+
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def open_loop(self, rate: float, duration: float, max_in_flight: int) -> None:
+        rng = random.Random(self.random.random())
+        with ThreadPoolExecutor(max_in_flight) as pool:
+            scheduled = start = time.perf_counter()
+            while scheduled < start + duration:
+                scheduled += rng.expovariate(rate)
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(self.request, scheduled)
+
+
+def summarize(records: list, elapsed: float) -> dict:
+    """Latency percentiles (in ms), throughput and error rate of requests
+
+    Args:
+        records (list): (kind, latency, success) of each request
+        elapsed (float): Duration of the test (in seconds)
+
+    Returns:
+        dict: The statistics
+    """
+
+    latencies = np.array([latency for _, latency, _ in records]) * 1000
+    errors = sum(not success for _, _, success in records)
+    if len(latencies) == 0:
+        return {"requests": 0}
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "requests": len(records),
+        "errors": errors,
+        "error_rate": errors / len(records),
+        "throughput": len(records) / elapsed,
+        "mean_ms": float(latencies.mean()),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "max_ms": float(latencies.max()),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8089", help="URL of the server. Default: http://127.0.0.1:8089")
+    parser.add_argument("--local", action="store_true", help="Start a local server with a randomly initialized model")
+    parser.add_argument("--port", type=int, default=8090, help="Port of the local server. Default: 8090")
+    parser.add_argument("--type", type=str, default="resnet34", help="Type of model of the local server. Default: resnet34")
+    parser.add_argument("--concurrency", type=int, default=4, help="Clients of the closed loop. Default: 4")
+    parser.add_argument("--rate", type=float, default=None, help="Requests per second (open loop). Default: closed loop")
+    parser.add_argument("--max_in_flight", type=int, default=64, help="Maximum concurrent requests of the open loop. Default: 64")
+    parser.add_argument("--duration", type=float, default=30, help="Duration of the test in seconds. Default: 30")
+    parser.add_argument("--requests", type=int, default=None, help="Maximum number of requests of the closed loop. Default: no limit")
+    parser.add_argument("--warmup", type=float, default=3, help="Duration of the warm-up in seconds (not recorded). Default: 3")
+    parser.add_argument("--mix", type=str, default="none:1", help="Kinds of requests and their weights (none, Low, Medium, High, Auto). Default: none:1")
+    parser.add_argument("--images", type=int, default=32, help="Number of synthetic images. Default: 32")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed. Default: 0")
+    parser.add_argument("--output", type=str, default=None, help="JSON file of the results")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    images = synthetic_images(args.images, args.seed)
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        server = None
+        url = args.url
+        if args.local:
+            server = start_local_server(model_dir, args.type, args.port)
+            url = f"http://127.0.0.1:{args.port}"
+
+        try:
+            connections = args.max_in_flight if args.rate else args.concurrency
+            if args.warmup > 0:
+                LoadTest(f"{url}/predict", images, {"none": 1}, connections, args.seed).closed_loop(
+                    args.concurrency, args.warmup)
+
+            test = LoadTest(f"{url}/predict", images, mix, connections, args.seed)
+            start = time.perf_counter()
+            if args.rate:
+                test.open_loop(args.rate, args.duration, args.max_in_flight)
+            else:
+                test.closed_loop(args.concurrency, args.duration, args.requests)
+            elapsed = time.perf_counter() - start
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    results = {
+        "mode": f"open loop, {args.rate} requests/s" if args.rate else f"closed loop, {args.concurrency} clients",
+        "mix": mix,
+        "all": summarize(test.records, elapsed),
+        **{kind: summarize([r for r in test.records if r[0] == kind], elapsed) for kind in mix},
+    }
+
+    print(results["mode"])
+    print(f"{'kind':8} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for kind in ["all", *mix]:
+        stats = results[kind]
+        if stats["requests"]:
+            print(f"{kind:8} {stats['requests']:9d} {stats['error_rate']:7.1%} {stats['throughput']:8.2f} "
+                  f"{stats['p50_ms']:9.1f} {stats['p95_ms']:9.1f} {stats['p99_ms']:9.1f}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
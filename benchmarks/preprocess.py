@@ -0,0 +1,84 @@
+"""Compare the serving preprocessing (Preprocessor) with ToTensor then Resize on large inputs.
+
+Run from the root of the repository:
+
+    python -m benchmarks.preprocess [--repeat 10]
+"""
+import argparse
+import io
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from src.preprocess import Preprocessor
+
+SIZE = (450, 600)
+
+
+def synthetic_photo(width: int, height: int, seed: int = 0) -> Image.Image:
+    """Smooth random image with some noise, compressing like a photo"""
+
+    rng = np.random.default_rng(seed)
+    small = Image.fromarray(rng.integers(0, 256, (height // 100, width // 100, 3), dtype=np.uint8))
+    image = np.asarray(small.resize((width, height), Image.BICUBIC), dtype=np.int16)
+    image = image + rng.integers(-8, 9, image.shape, dtype=np.int16)
+
+    return Image.fromarray(np.clip(image, 0, 255).astype(np.uint8))
+
+
+def encode(image: Image.Image, fmt: str, orientation: int = None) -> bytes:
+    options = {"quality": 90} if fmt == "JPEG" else {}
+    if orientation is not None:
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        options["exif"] = exif
+
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **options)
+
+    return buffer.getvalue()
+
+
+def timed(fn, repeat: int) -> tuple:
+    result = fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+
+    return result, 1000 * (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10, help="Repetitions of each measure. Default: 10")
+    args = parser.parse_args()
+
+    reference = transforms.Compose([transforms.ToTensor(), transforms.Resize(SIZE, antialias=True)])
+    preprocess = Preprocessor(SIZE)
+
+    photo = synthetic_photo(4032, 3024)
+    cases = [
+        ("JPEG 4032x3024 (12 MP)", encode(photo, "JPEG")),
+        ("JPEG 6000x4000 (24 MP)", encode(synthetic_photo(6000, 4000, 1), "JPEG")),
+        ("JPEG 12 MP, EXIF rotated", encode(photo, "JPEG", orientation=6)),
+        ("JPEG 12 MP, CMYK", encode(photo.convert("CMYK"), "JPEG")),
+        ("PNG 12 MP", encode(photo, "PNG")),
+        ("JPEG 600x450", encode(photo.resize((600, 450)), "JPEG")),
+    ]
+
+    print(f"{'input':26} {'ToTensor+Resize':>16} {'Preprocessor':>13} {'speedup':>8} {'mean |diff|':>12}")
+    for name, data in cases:
+        old, old_ms = timed(lambda: reference(Image.open(io.BytesIO(data)).convert("RGB")), args.repeat)
+        new, new_ms = timed(lambda: preprocess.batch([preprocess.load(io.BytesIO(data))])[0].clone(), args.repeat)
+
+        # The reference ignores the EXIF orientation
+        diff = "-" if "EXIF" in name else f"{(old - new).abs().mean().item():.4f}"
+        print(f"{name:26} {old_ms:13.1f} ms {new_ms:10.1f} ms {old_ms / new_ms:7.1f}x {diff:>12}")
+
+    images = [preprocess.load(io.BytesIO(cases[0][1])) for _ in range(16)]
+    _, stack_ms = timed(lambda: torch.stack([preprocess(image) for image in images]), args.repeat)
+    _, batch_ms = timed(lambda: preprocess.batch(images), args.repeat)
+    print(f"Batch of 16: torch.stack {stack_ms:.1f} ms, reused buffer {batch_ms:.1f} ms")
@@ -0,0 +1,82 @@
+"""Compare the segmentations of the LIME explanations: time and agreement with quickshift.
+
+Run from the root of the repository:
+
+    python -m benchmarks.segmentation [--root ROOT] [--checkpoint model/model_resnet34.pth] [--images 10]
+
+The agreement is the IoU between the pixels of the segments kept by the explanation and
+those kept with quickshift at full scale. A second quickshift explanation gives the agreement
+expected from the randomness of LIME alone. Without checkpoint, the model is randomly initialized.
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from benchmarks.preprocess import synthetic_photo
+from src import ExplainResults, HAM10000, HAM10000_model, load_model
+from src.preprocess import Preprocessor
+from src.segmentation import Segmenter
+
+CONFIGS = [("quickshift", 1.0), ("quickshift", 0.5), ("slic", 1.0), ("slic", 0.5),
+           ("felzenszwalb", 1.0), ("felzenszwalb", 0.5), ("grid", 1.0)]
+
+
+def kept(explanation: dict) -> np.ndarray:
+    """Pixels of the segments with a positive weight in the explanation"""
+
+    weights = explanation["weights"]
+    return np.isin(explanation["segments"], weights[weights[:, 1] > 0, 0].astype(int))
+
+
+def iou(a: np.ndarray, b: np.ndarray) -> float:
+    union = np.logical_or(a, b).sum()
+    return np.logical_and(a, b).sum() / union if union else 1.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, default=None, help="Root to the images. Default: synthetic images")
+    parser.add_argument("--checkpoint", type=str, default=None, help="Checkpoint of the model. Default: random model")
+    parser.add_argument("--type", type=str, default="resnet34", help="Type of model. Default: resnet34")
+    parser.add_argument("--images", type=int, default=10, help="Number of images. Default: 10")
+    parser.add_argument("--samples", type=int, default=200, help="LIME samples per explanation. Default: 200")
+    args = parser.parse_args()
+
+    preprocess = Preprocessor((450, 600))
+    if args.root is not None:
+        dataset = HAM10000.load_from_file(args.root, train=False, use_store=False)
+        images = [preprocess.resize(Image.open(path)) for path in dataset.paths[:args.images]]
+    else:
+        images = [preprocess.resize(synthetic_photo(600, 450, seed)) for seed in range(args.images)]
+
+    if args.checkpoint is not None:
+        model = load_model(args.checkpoint, 7, args.type)
+    else:
+        model = HAM10000_model(7, model_type=args.type, pretrained=False).eval()
+
+    lesion_type = {i: str(i) for i in range(7)}
+
+    def explain(segmenter: Segmenter) -> list:
+        explain_model = ExplainResults(model, preprocess, lesion_type, segmenter=segmenter)
+        return [explain_model.explanation(image, args.samples) for image in images]
+
+    torch.manual_seed(0)
+    reference = [kept(e) for e in explain(Segmenter("quickshift"))]
+    repeat = [kept(e) for e in explain(Segmenter("quickshift"))]
+    print(f"LIME randomness alone (quickshift twice): IoU {np.mean([iou(a, b) for a, b in zip(reference, repeat)]):.3f}")
+
+    print(f"{'segmentation':18} {'ms/image':>9} {'segments':>9} {'IoU':>6}")
+    for kind, scale in CONFIGS:
+        segmenter = Segmenter(kind, scale)
+        arrays = [np.asarray(image) for image in images]
+
+        start = time.perf_counter()
+        segments = [segmenter.segment(array) for array in arrays]
+        ms = 1000 * (time.perf_counter() - start) / len(arrays)
+
+        count = np.mean([s.max() + 1 for s in segments])
+        agreement = np.mean([iou(a, kept(e)) for a, e in zip(reference, explain(segmenter))])
+        print(f"{segmenter.name:18} {ms:9.1f} {count:9.0f} {agreement:6.3f}")
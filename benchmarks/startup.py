@@ -0,0 +1,77 @@
+"""Measure the startup time of the server and of the ways to build the model.
+
+Run from the root of the repository:
+
+    python -m benchmarks.startup [--checkpoint model/model_resnet34.pth] [--type resnet34]
+
+Without checkpoint, a randomly initialized model is saved in a temporary folder.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+from src import HAM10000_model, load_model
+
+SERVER_IMPORT = "import server"
+
+
+def timed(fn) -> tuple:
+    start = time.perf_counter()
+    try:
+        fn()
+    except Exception as e:
+        return None, str(e)
+
+    return time.perf_counter() - start, None
+
+
+def pretrained_then_load(path: str, model_type: str) -> None:
+    model = HAM10000_model(7, model_type=model_type)
+    model.load_state_dict(torch.load(path))
+
+
+def import_explainers() -> None:
+    import lime.lime_image  # noqa: F401
+    import skimage.segmentation  # noqa: F401
+
+
+def server_startup(model_dir: str, model_type: str) -> None:
+    env = dict(os.environ, MODEL=model_type, MODEL_DIR=model_dir, BACKEND="torch")
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+    result = subprocess.run([sys.executable, "-c", SERVER_IMPORT], cwd=src, env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, default=None, help="Checkpoint to load. Default: random model")
+    parser.add_argument("--type", type=str, default="resnet34", help="Type of model. Default: resnet34")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.checkpoint
+        if path is None:
+            path = os.path.join(tmp, f"model_{args.type}.pth")
+            torch.save(HAM10000_model(7, model_type=args.type, pretrained=False).state_dict(), path)
+
+        model_dir = os.path.dirname(os.path.abspath(path))
+        if os.path.basename(path) != f"model_{args.type}.pth":
+            os.symlink(os.path.abspath(path), os.path.join(tmp, f"model_{args.type}.pth"))
+            model_dir = tmp
+
+        rows = [
+            ("ImageNet weights + torch.load", *timed(lambda: pretrained_then_load(path, args.type))),
+            ("load_model (no download, mmap)", *timed(lambda: load_model(path, 7, args.type))),
+            ("lime + skimage import", *timed(import_explainers)),
+            ("server startup (new process)", *timed(lambda: server_startup(model_dir, args.type))),
+        ]
+
+    for name, seconds, error in rows:
+        print(f"{name:34} " + (f"{seconds:8.2f} s" if error is None else f"failed: {error}"))
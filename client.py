@@ -1,12 +1,19 @@
-import base64
 import sys
+import csv
+import glob
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import matplotlib.pyplot as plt
-import numpy as np
-from src import send_image
+from src import send_image, send_batch, make_session, decode_explanation
 import argparse
 
 headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
 url = "http://127.0.0.1:8089/predict"
+batch_url = "http://127.0.0.1:8089/predict_batch"
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+FIELDS = ["path", "success", "prediction", "probability", "error"]
 
 def transform_image(img_path):
     try:
@@ -16,34 +23,152 @@ def transform_image(img_path):
         print("Cannot open image: " + img_path)
         exit(1)
 
-    return base64.b64encode(im_bytes).decode("utf8")
+    return im_bytes
 
-def get_prediction(img, url, explain, precision):
-    data = send_image(img, url, explain, precision)
+def get_prediction(img, url, explain, precision, upload="raw", model=None, method=None, budget_ms=None):
+    data = send_image(img, url, explain, precision, upload=upload, model=model, method=method,
+                      budget_ms=budget_ms)
     
     if not data.get('success'):
         print("Error: " + data.get('error'))
     else:
         prediction = data.get('prediction')
         probability = data.get('probability')
-        explain = data.get('image')
+        explain = decode_explanation(data)
         
         print(f"prediction: {prediction} - {round(probability, 2) * 100}%")
+        if 'samples' in data:
+            print(f"explanation: {data['samples']} samples ({data['convergence']})")
         
         if explain is not None:
-            plt.imshow(np.array(explain))
+            plt.imshow(explain)
             plt.show()
 
+def is_bulk(path):
+    return os.path.isdir(path) or glob.has_magic(path)
+
+def list_images(path):
+    """Images of a directory (recursively) or matching a glob pattern, listed lazily"""
+
+    if not os.path.isdir(path):
+        yield from sorted(glob.iglob(path, recursive=True))
+        return
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, name)
+
+def chunks(paths, size):
+    chunk = []
+    for path in paths:
+        chunk.append(path)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+def predict_files(paths, url, session, model=None):
+    """Send a batch of files and return one row per file"""
+
+    images, rows = [], {}
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                images.append((path, f.read()))
+        except OSError as e:
+            rows[path] = {"path": path, "success": False, "error": str(e)}
+
+    if images:
+        data = send_batch(images, url, model=model, session=session)
+        results = data.get('results') if data.get('success') else None
+        for i, (path, _) in enumerate(images):
+            if results is None:
+                rows[path] = {"path": path, "success": False, "error": data.get('error')}
+            else:
+                rows[path] = {"path": path, **{k: v for k, v in results[i].items() if k != "name"}}
+
+    return [rows[path] for path in paths]
+
+class ResultWriter:
+    def __init__(self, output):
+        """Write the results as they arrive, in CSV if output ends with .csv, in JSON lines otherwise"""
+
+        self.file = sys.stdout if output == "-" else open(output, "w", newline="")
+        self.writer = None
+        if output.endswith(".csv"):
+            self.writer = csv.DictWriter(self.file, fieldnames=FIELDS)
+            self.writer.writeheader()
+
+    def write(self, rows):
+        for row in rows:
+            if self.writer is not None:
+                self.writer.writerow(row)
+            else:
+                self.file.write(json.dumps(row) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+def bulk_prediction(path, url, output, batch_size=16, concurrency=4, retries=3, model=None):
+    """Classify all the images of a directory or matching a glob pattern"""
+
+    session = make_session(concurrency, retries)
+    writer = ResultWriter(output)
+    total = failed = 0
+
+    def collect(futures):
+        nonlocal total, failed
+        for future in futures:
+            rows = future.result()
+            writer.write(rows)
+            total += len(rows)
+            failed += sum(not row["success"] for row in rows)
+        print(f"\r{total} images ({failed} failed)", end="", file=sys.stderr)
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        pending = set()
+        for paths in chunks(list_images(path), batch_size):
+            if len(pending) >= 2 * concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(pool.submit(predict_files, paths, url, session, model))
+
+        collect(wait(pending).done)
+
+    writer.close()
+    print(file=sys.stderr)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--explain", action="store_true", help="If the server should explain the prediction")
-    parser.add_argument("--precision", default="Medium", help="Precision of the explanation (Low, Medium, High)")
-    parser.add_argument("image", nargs=1, help='path to the image')
+    parser.add_argument("--precision", default="Medium", help="Precision of the explanation (Low, Medium, High, Auto)")
+    parser.add_argument("--budget_ms", type=float, default=None,
+                        help="Time budget of the explanation in milliseconds (adaptive sampling). Default: budget of the server")
+    parser.add_argument("--upload", default="raw", choices=["raw", "multipart", "json"],
+                        help="How the image is sent to the server (raw, multipart, json). Default: raw")
+    parser.add_argument("--method", default=None, choices=["lime", "gradcam"],
+                        help="Explanation method (lime, gradcam). Default: lime")
+    parser.add_argument("--model", default=None, help="Model used by the server (e.g. resnet18). Default: model of the server")
+    parser.add_argument("--output", default="-", help="Results of a directory or a glob pattern, CSV if it ends with .csv, JSON lines otherwise. Default: standard output")
+    parser.add_argument("--batch_size", type=int, default=16, help="Images per request for a directory or a glob pattern. Default: 16")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent requests for a directory or a glob pattern. Default: 4")
+    parser.add_argument("--retries", type=int, default=3, help="Retries of a failed request. Default: 3")
+    parser.add_argument("image", nargs=1, help='path to the image, to a directory of images or glob pattern (e.g. "photos/*.jpg")')
     args = parser.parse_args()
 
     if len(sys.argv) < 2:
         exit(0)
         
-    img = transform_image(args.image[0])
-    get_prediction(img, url, args.explain, args.precision)
+    if is_bulk(args.image[0]):
+        bulk_prediction(args.image[0], batch_url, args.output, args.batch_size, args.concurrency,
+                        args.retries, args.model)
+        exit(0)
 
+    img = transform_image(args.image[0])
+    get_prediction(img, url, args.explain, args.precision, args.upload, args.model, args.method, args.budget_ms)
@@ -0,0 +1,68 @@
+import argparse
+import time
+
+from src import load_model
+from src.backend import export_onnx, export_torchscript, load_backend
+
+import torch
+
+
+def latency(backend, batch: torch.Tensor, repeat: int = 10) -> float:
+    backend(batch)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        backend(batch)
+
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, default="model/model_resnet34.pth",
+                        help="Trained model. Default: model/model_resnet34.pth")
+    parser.add_argument("--type", type=str, default="resnet34", help="Type of model (see --type of main_train.py). Default: resnet34")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Path of the exported models, without extension (.ts for TorchScript, .onnx for ONNX). Default: model/model_{type}")
+    parser.add_argument("--formats", type=str, default="torchscript,onnx",
+                        help="Formats to export (torchscript, onnx). Default: torchscript,onnx")
+    parser.add_argument("--check", action="store_true",
+                        help="Compare the logits and the latency of the exported models with the PyTorch model")
+    parser.add_argument("--batch_size", type=int, default=16, help="Batch size of the check. Default: 16")
+    parser.add_argument("--tolerance", type=float, default=1e-3,
+                        help="Maximum absolute difference of the logits accepted by the check. Default: 1e-3")
+    args = parser.parse_args()
+
+    output = args.output or f"model/model_{args.type}"
+    formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+
+    model = load_model(args.checkpoint, 7, args.type)
+
+    example = torch.rand(1, 3, 450, 600)
+    paths = {}
+    if "torchscript" in formats:
+        paths["torchscript"] = f"{output}.ts"
+        export_torchscript(model, paths["torchscript"], example)
+    if "onnx" in formats:
+        paths["onnx"] = f"{output}.onnx"
+        export_onnx(model, paths["onnx"], example)
+
+    for kind, path in paths.items():
+        print(f"{kind} model saved to {path}.")
+
+    if args.check:
+        batch = torch.rand(args.batch_size, 3, 450, 600)
+        reference = load_backend("torch", None, model=model)
+        expected = reference(batch)
+
+        print(f"{'':12} {'max |diff|':>12} {'1 image (ms)':>14} {f'{args.batch_size} images (ms)':>16}")
+        print(f"{'torch':12} {0:12.2e} {latency(reference, batch[:1]):14.1f} {latency(reference, batch):16.1f}")
+
+        failed = False
+        for kind, path in paths.items():
+            backend = load_backend(kind, path)
+            diff = (backend(batch) - expected).abs().max().item()
+            failed |= diff > args.tolerance
+            print(f"{kind:12} {diff:12.2e} {latency(backend, batch[:1]):14.1f} {latency(backend, batch):16.1f}")
+
+        if failed:
+            raise SystemExit(f"Logits differ from the PyTorch model by more than {args.tolerance}.")
@@ -0,0 +1,78 @@
+import argparse
+import time
+
+from src import HAM10000, load_model
+from src.quantize import STATIC_TYPES, quantize_dynamic, quantize_static, save_quantized
+from src.transforms import test_transform
+
+from torch.utils.data import DataLoader
+import torch
+
+
+def accuracy(model: torch.nn.Module, dataloader: DataLoader) -> float:
+    correct = 0
+    with torch.inference_mode():
+        for X, y in dataloader:
+            correct += (model(X).argmax(1) == y).sum().item()
+
+    return correct / len(dataloader.dataset)
+
+
+def latency(model: torch.nn.Module, batch: torch.Tensor, repeat: int = 10) -> float:
+    with torch.inference_mode():
+        model(batch)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            model(batch)
+
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root", nargs=1, help='Root to the images')
+    parser.add_argument("--checkpoint", type=str, default="model/model_resnet34.pth",
+                        help="Trained fp32 model. Default: model/model_resnet34.pth")
+    parser.add_argument("--type", type=str, default="resnet34", help="Type of model (see --type of main_train.py). Default: resnet34")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Quantized model (TorchScript). Default: model/model_{type}_int8.pt")
+    parser.add_argument("--method", type=str, default="static", choices=["static", "dynamic"],
+                        help=f"Static quantization (calibrated on the training images, {', '.join(STATIC_TYPES)} only) or dynamic quantization. Default: static")
+    parser.add_argument("--calibration_batches", type=int, default=10,
+                        help="Number of batches of 16 training images used for the calibration. Default: 10")
+    parser.add_argument("--report", action="store_true",
+                        help="Compare the accuracy (test images) and the latency of the fp32 and int8 models")
+    args = parser.parse_args()
+    if args.method == "static" and args.type not in STATIC_TYPES:
+        parser.error(f"Static quantization is only supported for {', '.join(STATIC_TYPES)}: "
+                     f"use --method dynamic for {args.type}")
+
+    output = args.output or f"model/model_{args.type}_int8.pt"
+
+    model = load_model(args.checkpoint, 7, args.type)
+
+    dataset_train = HAM10000.load_from_file(args.root[0], train=True, transform=test_transform)
+    calibration = DataLoader(dataset_train, batch_size=16, shuffle=True)
+
+    quantized = None
+    if args.method == "static":
+        try:
+            quantized = quantize_static(model, calibration, args.calibration_batches)
+        except Exception as e:
+            print(f"Static quantization failed ({e}), falling back to dynamic quantization.")
+
+    if quantized is None:
+        quantized = quantize_dynamic(model)
+
+    example = next(iter(calibration))[0][:1]
+    save_quantized(quantized, output, example)
+    print(f"Quantized model saved to {output}.")
+
+    if args.report:
+        dataset_test = HAM10000.load_from_file(args.root[0], train=False, transform=test_transform)
+        test_data = DataLoader(dataset_test, batch_size=32)
+        batch = next(iter(test_data))[0]
+
+        print(f"{'':6} {'accuracy':>10} {'1 image (ms)':>14} {f'{len(batch)} images (ms)':>16}")
+        for name, m in (("fp32", model), ("int8", quantized)):
+            print(f"{name:6} {accuracy(m, test_data):10.4f} {latency(m, batch[:1]):14.1f} {latency(m, batch):16.1f}")
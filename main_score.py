@@ -0,0 +1,75 @@
+import argparse
+import os
+import sys
+import time
+
+from src import HAM10000, ExecutionMode, load_model
+from src.backend import load_backend
+from src.preprocess import Preprocessor
+from src.scoring import columns, decoded, list_files, open_writer, score
+
+import torch
+
+SIZE = (450, 600)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", nargs=1,
+                        help="Directory of images (searched recursively), or manifest: CSV file with a path column or text file with one path per line")
+    parser.add_argument("--checkpoint", type=str, default="model/model_resnet34.pth",
+                        help="Trained model, or model exported by main_export.py with --backend torchscript or onnx. Default: model/model_resnet34.pth")
+    parser.add_argument("--type", type=str, default="resnet34", help="Type of model (see --type of main_train.py). Default: resnet34")
+    parser.add_argument("--backend", type=str, default="torch", choices=["torch", "torchscript", "onnx"],
+                        help="Run the checkpoint (torch) or a model exported by main_export.py (torchscript, onnx). Default: torch")
+    parser.add_argument("--execution", type=str, default="fp32",
+                        help="Execution mode of the PyTorch backends: fp32, or options among bf16 and channels_last. Default: fp32")
+    parser.add_argument("--output", type=str, default="scores.csv",
+                        help="Results: directory of Parquet files if it ends with .parquet, CSV file otherwise. Default: scores.csv")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Start over instead of resuming from the images already in the output")
+    parser.add_argument("--batch_size", type=int, default=64, help="Images per forward pass. Default: 64")
+    parser.add_argument("--rows_per_part", type=int, default=1024,
+                        help="Maximum number of rows of each Parquet file. Default: 1024")
+    parser.add_argument("--flush_seconds", type=float, default=30,
+                        help="Maximum time in seconds between two Parquet files. Default: 30")
+    parser.add_argument("--workers", type=int, default=max((os.cpu_count() or 2) // 2, 1),
+                        help="Number of decoding processes. Default: half of the cores")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Number of threads of the forward passes. Default: the cores not used for decoding")
+    args = parser.parse_args()
+    if args.rows_per_part < 1:
+        parser.error("--rows_per_part should be at least 1")
+
+    threads = args.threads or max((os.cpu_count() or 2) - args.workers, 1)
+    torch.set_num_threads(threads)
+
+    # Index -> name of each class, and short names for the columns (e.g. p_nv)
+    lesion_type = {i: name for name, i in HAM10000.TYPE_CARDINAL.items()}
+    codes = {HAM10000.TYPE_CARDINAL[name]: code for code, name in HAM10000.LESION_TYPE.items()}
+
+    writer = open_writer(args.output, columns(codes), args.overwrite, args.rows_per_part, args.flush_seconds)
+    done = set() if args.overwrite else writer.done()
+    if done:
+        print(f"Resuming: {len(done)} images already scored", file=sys.stderr)
+
+    execution = ExecutionMode.from_name(args.execution)
+    model = load_model(args.checkpoint, 7, args.type) if args.backend == "torch" else None
+    backend = load_backend(args.backend, args.checkpoint, model=model, execution=execution, threads=threads)
+    preprocess = Preprocessor(SIZE)
+
+    paths = (path for path in list_files(args.source[0]) if path not in done)
+    images = decoded(paths, SIZE, args.workers)
+
+    total = failed = 0
+    start = time.perf_counter()
+    try:
+        for rows in score(backend, images, preprocess, lesion_type, codes, args.batch_size):
+            writer.write(rows)
+            total += len(rows)
+            failed += sum(not row["success"] for row in rows)
+            rate = total / (time.perf_counter() - start)
+            print(f"\r{total} images ({failed} failed), {rate:.1f} images/s", end="", file=sys.stderr)
+    finally:
+        writer.close()
+        print(file=sys.stderr)
@@ -1,26 +1,17 @@
 import argparse
+from os.path import join
 
-from src import HAM10000, HAM10000_model, Trainer
+from src import BatchAugment, HAM10000, HAM10000_model, Trainer, to_float
+from src import MODEL_TYPES, DistillationLoss, last_layer, load_model, save_checkpoint
+from src import FeatureDataset, extract_features, feature_metadata, has_features
+from src import ExecutionMode, Instrumentation
+from src import batch_transform, test_transform, train_transform
 
-from torchvision import transforms
 from torch.utils.data import DataLoader
 from torch.optim import lr_scheduler
 import torch
 from torch import nn
 
-train_transform = transforms.Compose(
-    [
-        transforms.GaussianBlur(kernel_size=(5, 5)),
-        transforms.RandomPerspective(),
-        transforms.RandomRotation(180),
-        transforms.ToTensor(), # Scale image to [0, 1]
-    ])
-
-test_transform = transforms.Compose(
-    [
-        transforms.ToTensor(),   
-    ])
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("root", nargs=1, help='Root to the images')
@@ -29,11 +20,56 @@ if __name__ == '__main__':
     parser.add_argument("--modelname", type=str, default="model/model_resnet34.pth",
                         help="Name of the model to save. Default: model/model_resnet34.pth")
     parser.add_argument("--fine_tune", action="store_true", help="If the model should be fine tuned")
-    parser.add_argument("--type", type=str, default="resnet34", help="Type of model to train (resnet18 or resnet34). Default: resnet34")
+    parser.add_argument("--type", type=str, default="resnet34", help=f"Type of model to train ({', '.join(MODEL_TYPES)}). Default: resnet34")
+    parser.add_argument("--teacher", type=str, default=None,
+                        help="Checkpoint of a trained model distilled into the trained model (e.g. model/model_resnet34.pth)")
+    parser.add_argument("--teacher_type", type=str, default="resnet34", help="Type of the teacher model. Default: resnet34")
+    parser.add_argument("--distill_alpha", type=float, default=0.5,
+                        help="Weight of the distillation loss (the rest is the cross entropy with the labels). Default: 0.5")
+    parser.add_argument("--distill_temperature", type=float, default=4.0,
+                        help="Temperature of the distillation. Default: 4.0")
+    parser.add_argument("--build_store", action="store_true",
+                        help="Decode the images once into a memory-mapped store (rebuilt only if the images changed)")
+    parser.add_argument("--augment", type=str, default="pil", choices=["pil", "batch"],
+                        help="Augment each image with PIL transforms (pil) or whole batches with tensor operations (batch). Default: pil")
+    parser.add_argument("--eval_every", type=int, default=1,
+                        help="Evaluate the model on the test set every N epochs. Default: 1")
+    parser.add_argument("--eval_subset", type=float, default=None,
+                        help="Evaluate on a fixed random subset of the test set: number of images (> 1) or fraction (<= 1). Default: whole test set")
+    parser.add_argument("--feature_cache", type=str, default=None,
+                        help="Train only the last layer on the features of the backbone, computed once and stored in this folder")
+    parser.add_argument("--feature_views", type=int, default=1,
+                        help="Number of augmented views of each training image stored with --feature_cache (1: no augmentation). Default: 1")
+    parser.add_argument("--execution", type=str, default="fp32",
+                        help="Execution mode: fp32, or options among bf16 (bfloat16 autocast) and channels_last, e.g. bf16,channels_last. Default: fp32")
+    parser.add_argument("--instrument", type=str, default=None,
+                        help="Record the timings of each step in this file (CSV if it ends with .csv, JSON lines otherwise)")
+    parser.add_argument("--profile_start", type=int, default=None,
+                        help="Profile the training steps from this step with torch.profiler (requires --instrument)")
+    parser.add_argument("--profile_steps", type=int, default=10, help="Number of profiled steps. Default: 10")
+    parser.add_argument("--trace", type=str, default="trace.json",
+                        help="Chrome trace of the profiled steps. Default: trace.json")
     args = parser.parse_args()
+    if args.profile_start is not None and args.instrument is None:
+        parser.error("--profile_start requires --instrument")
+    if args.eval_every < 1:
+        parser.error("--eval_every should be at least 1")
+    if args.eval_subset is not None and args.eval_subset <= 0:
+        parser.error("--eval_subset should be positive")
+    if args.teacher is not None and args.feature_cache is not None:
+        parser.error("--teacher cannot be used with --feature_cache")
+    
+    execution = ExecutionMode.from_name(args.execution)
     
-    dataset_train = HAM10000.load_from_file(args.root[0], train=True, transform=train_transform)
-    dataset_test = HAM10000.load_from_file(args.root[0], train=False, transform=test_transform)
+    if args.build_store:
+        for train in (True, False):
+            print(f"Image store ready: {HAM10000.build_store(args.root[0], train=train)}")
+    
+    batched = args.augment == "batch"
+    dataset_train = HAM10000.load_from_file(args.root[0], train=True,
+                                            transform=batch_transform if batched else train_transform)
+    dataset_test = HAM10000.load_from_file(args.root[0], train=False,
+                                           transform=batch_transform if batched else test_transform)
     
     batch_size = 64
     
@@ -42,17 +78,65 @@ if __name__ == '__main__':
  
     device = "cuda" if torch.cuda.is_available() else "cpu"
    
-    fine_tune = args.fine_tune or False 
+    fine_tune = args.fine_tune or args.feature_cache is not None
     model = HAM10000_model(7, fine_tune=fine_tune, model_type=args.type).to(device)
     loss_function = nn.CrossEntropyLoss()
+    teacher = None
+    if args.teacher is not None:
+        teacher = load_model(args.teacher, 7, args.teacher_type)
+        loss_function = DistillationLoss(args.distill_alpha, args.distill_temperature)
     if fine_tune:
-        optimizer = torch.optim.Adam(model.fc.parameters())
+        optimizer = torch.optim.Adam(last_layer(model).parameters())
     else:
         optimizer = torch.optim.Adam(model.parameters())
         
     lr_scheduler = lr_scheduler.StepLR(optimizer, step_size=4, gamma=0.1)
     
-    trainer = Trainer(model, optimizer, loss_function, device, scheduler=lr_scheduler)
-    trainer.train(train_data, test_data, args.epochs, keep_best=True)
+    instrumentation = None
+    if args.instrument is not None:
+        instrumentation = Instrumentation(args.instrument, device, args.profile_start,
+                                          args.profile_steps, args.trace)
+    
+    if args.feature_cache is not None:
+        # The backbone is frozen: compute its features once, then train the last layer on them
+        views = args.feature_views
+        train_path = join(args.feature_cache, f"{args.type}_train_{views}")
+        test_path = join(args.feature_cache, f"{args.type}_test")
+        
+        augmented = HAM10000.load_from_file(args.root[0], train=True,
+                                            transform=batch_transform if batched else
+                                            (train_transform if views > 1 else test_transform))
+        augment = (BatchAugment() if views > 1 else to_float) if batched else None
+        train_metadata = feature_metadata(model, augmented, views, augment)
+        if not has_features(train_path, len(dataset_train), views, train_metadata):
+            extract_features(model, augmented, train_path, views, batch_size, device, batch_transform=augment,
+                             metadata=train_metadata)
+        test_augment = to_float if batched else None
+        test_metadata = feature_metadata(model, dataset_test, 1, test_augment)
+        if not has_features(test_path, len(dataset_test), 1, test_metadata):
+            extract_features(model, dataset_test, test_path, 1, batch_size, device,
+                             batch_transform=test_augment, metadata=test_metadata)
+        
+        train_data = DataLoader(FeatureDataset(train_path), batch_size=256, shuffle=True)
+        test_data = DataLoader(FeatureDataset(test_path, random_view=False), batch_size=256)
+        
+        trainer = Trainer(last_layer(model), optimizer, loss_function, device, scheduler=lr_scheduler,
+                          execution=execution, instrumentation=instrumentation)
+        trainer.train(train_data, test_data, args.epochs, keep_best=True,
+                      eval_every=args.eval_every, eval_subset=args.eval_subset)
+        
+        # The last layer is the trained layer, save the whole model
+        save_checkpoint(model.to('cpu').state_dict(), args.modelname)
+        print(f"Model saved to {args.modelname}.")
+    else:
+        trainer = Trainer(model, optimizer, loss_function, device, scheduler=lr_scheduler,
+                          batch_transform=BatchAugment() if batched else None,
+                          eval_batch_transform=to_float if batched else None,
+                          execution=execution, instrumentation=instrumentation, teacher=teacher)
+        trainer.train(train_data, test_data, args.epochs, keep_best=True,
+                      eval_every=args.eval_every, eval_subset=args.eval_subset)
+        
+        trainer.save(args.modelname)
     
-    trainer.save(args.modelname)
\ No newline at end of file
+    if instrumentation is not None:
+        instrumentation.close()
\ No newline at end of file
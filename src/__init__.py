@@ -1,13 +1,40 @@
+from .augment import BatchAugment, to_float
+from .execution import ExecutionMode
 from .explain import ExplainResults
+from .features import FeatureDataset, extract_features, feature_metadata, has_features
+from .instrument import Instrumentation
 from .datasetHAM10000 import HAM10000
-from .model import HAM10000_model
-from .sender import send_image
-from .trainer import Trainer
+from .model import MODEL_TYPES, HAM10000_model, last_layer, load_model, save_checkpoint
+from .sender import (send_image, send_batch, make_session, decode_explanation, submit_explanation,
+                     get_explanation)
+from .trainer import DistillationLoss, Trainer
+from .transforms import batch_transform, test_transform, train_transform
 
 __all__ = [
+    "BatchAugment",
+    "to_float",
+    "ExecutionMode",
     "ExplainResults",
+    "FeatureDataset",
+    "Instrumentation",
+    "extract_features",
+    "feature_metadata",
+    "has_features",
     "HAM10000",
+    "MODEL_TYPES",
     "HAM10000_model",
+    "last_layer",
+    "load_model",
+    "save_checkpoint",
     "send_image",
+    "send_batch",
+    "make_session",
+    "decode_explanation",
+    "submit_explanation",
+    "get_explanation",
+    "DistillationLoss",
     "Trainer",
+    "batch_transform",
+    "test_transform",
+    "train_transform",
 ]
\ No newline at end of file
@@ -0,0 +1,173 @@
+import math
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+def to_float(batch: torch.Tensor) -> torch.Tensor:
+    """Scale a batch of uint8 images to [0, 1] (same as ToTensor). Float batches are returned unchanged.
+
+    Args:
+        batch (torch.Tensor): Batch of images (N x C x H x W)
+
+    Returns:
+        torch.Tensor: Float batch
+    """
+
+    if batch.dtype == torch.uint8:
+        return batch.float().div_(255)
+
+    return batch
+
+
+class BatchAugment(nn.Module):
+    def __init__(self, kernel_size: int = 5, sigma: tuple = (0.1, 2.0),
+                 distortion_scale: float = 0.5, perspective_p: float = 0.5, degrees: float = 180):
+        """Batched version of GaussianBlur, RandomPerspective and RandomRotation.
+
+        The parameters are drawn for each image as the torchvision transforms do, then the blur is
+        applied with one grouped convolution and the perspective and the rotation are composed
+        into one homography per image, applied with a single grid_sample.
+
+        Args:
+            kernel_size (int, optional): Size of the Gaussian kernel. Defaults to 5.
+            sigma (tuple, optional): Range of the standard deviation of the blur. Defaults to (0.1, 2.0).
+            distortion_scale (float, optional): Distortion of the perspective. Defaults to 0.5.
+            perspective_p (float, optional): Probability to apply the perspective. Defaults to 0.5.
+            degrees (float, optional): Range of the rotation (-degrees, +degrees). Defaults to 180.
+        """
+
+        super().__init__()
+
+        self.kernel_size = kernel_size
+        self.sigma = sigma
+        self.distortion_scale = distortion_scale
+        self.perspective_p = perspective_p
+        self.degrees = degrees
+
+    def blur(self, batch: torch.Tensor) -> torch.Tensor:
+        """Gaussian blur with a random sigma per image
+
+        Args:
+            batch (torch.Tensor): Float batch (N x C x H x W)
+
+        Returns:
+            torch.Tensor: Blurred batch
+        """
+
+        n, c, h, w = batch.shape
+        sigma = torch.empty(n, device=batch.device).uniform_(*self.sigma)
+
+        half = (self.kernel_size - 1) / 2
+        x = torch.linspace(-half, half, self.kernel_size, device=batch.device)
+        kernel = torch.exp(-0.5 * (x[None] / sigma[:, None]) ** 2)
+        kernel = (kernel / kernel.sum(dim=1, keepdim=True)).repeat_interleave(c, dim=0)
+
+        pad = self.kernel_size // 2
+        out = F.pad(batch.reshape(1, n * c, h, w), (pad, pad, pad, pad), mode="reflect")
+        out = F.conv2d(out, kernel[:, None, None, :], groups=n * c)
+        out = F.conv2d(out, kernel[:, None, :, None], groups=n * c)
+
+        return out.reshape(n, c, h, w)
+
+    def perspective(self, n: int, h: int, w: int, device) -> torch.Tensor:
+        """Random perspectives, as homographies mapping output pixels to input pixels
+
+        Args:
+            n (int): Number of images
+            h (int): Height of the images
+            w (int): Width of the images
+            device: Device of the batch
+
+        Returns:
+            torch.Tensor: Homographies (N x 3 x 3)
+        """
+
+        dx = int(self.distortion_scale * (w // 2))
+        dy = int(self.distortion_scale * (h // 2))
+
+        def randint(low, high):
+            return torch.randint(low, high, (n,), device=device).float()
+
+        start = torch.tensor([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]],
+                             dtype=torch.float, device=device).expand(n, 4, 2)
+        end = torch.stack([
+            torch.stack([randint(0, dx + 1), randint(0, dy + 1)], dim=1),
+            torch.stack([randint(w - dx - 1, w), randint(0, dy + 1)], dim=1),
+            torch.stack([randint(w - dx - 1, w), randint(h - dy - 1, h)], dim=1),
+            torch.stack([randint(0, dx + 1), randint(h - dy - 1, h)], dim=1),
+        ], dim=1)
+
+        # Solve start = H(end) for the 8 coefficients of H
+        ex, ey = end[..., 0], end[..., 1]
+        sx, sy = start[..., 0], start[..., 1]
+        zeros, ones = torch.zeros_like(ex), torch.ones_like(ex)
+        rows_x = torch.stack([ex, ey, ones, zeros, zeros, zeros, -sx * ex, -sx * ey], dim=2)
+        rows_y = torch.stack([zeros, zeros, zeros, ex, ey, ones, -sy * ex, -sy * ey], dim=2)
+        a = torch.cat([rows_x, rows_y], dim=1)
+        b = torch.cat([sx, sy], dim=1)
+        coeffs = torch.linalg.solve(a, b)
+
+        homography = torch.cat([coeffs, torch.ones(n, 1, device=device)], dim=1).reshape(n, 3, 3)
+
+        apply = torch.rand(n, device=device) < self.perspective_p
+        identity = torch.eye(3, device=device).expand(n, 3, 3)
+
+        return torch.where(apply[:, None, None], homography, identity)
+
+    def rotation(self, n: int, h: int, w: int, device) -> torch.Tensor:
+        """Random rotations around the center of the image
+
+        Args:
+            n (int): Number of images
+            h (int): Height of the images
+            w (int): Width of the images
+            device: Device of the batch
+
+        Returns:
+            torch.Tensor: Rotations (N x 3 x 3) mapping output pixels to input pixels
+        """
+
+        angle = torch.empty(n, device=device).uniform_(-self.degrees, self.degrees) * math.pi / 180
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        cx, cy = (w - 1) / 2, (h - 1) / 2
+
+        matrix = torch.zeros(n, 3, 3, device=device)
+        matrix[:, 0, 0] = cos
+        matrix[:, 0, 1] = -sin
+        matrix[:, 0, 2] = cx - cos * cx + sin * cy
+        matrix[:, 1, 0] = sin
+        matrix[:, 1, 1] = cos
+        matrix[:, 1, 2] = cy - sin * cx - cos * cy
+        matrix[:, 2, 2] = 1
+
+        return matrix
+
+    def forward(self, batch: torch.Tensor) -> torch.Tensor:
+        """Augment a batch of images
+
+        Args:
+            batch (torch.Tensor): Batch of uint8 or float images (N x C x H x W)
+
+        Returns:
+            torch.Tensor: Augmented float batch, with values in [0, 1]
+        """
+
+        batch = self.blur(to_float(batch))
+        n, _, h, w = batch.shape
+
+        # Output pixel -> rotated image -> perspective -> blurred image
+        transform = self.perspective(n, h, w, batch.device) @ self.rotation(n, h, w, batch.device)
+
+        ys, xs = torch.meshgrid(torch.arange(h, device=batch.device, dtype=torch.float),
+                                torch.arange(w, device=batch.device, dtype=torch.float),
+                                indexing="ij")
+        points = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1).reshape(1, h * w, 3)
+        source = points @ transform.transpose(1, 2)
+        source = source[..., :2] / source[..., 2:]
+
+        grid = torch.stack([2 * source[..., 0] / (w - 1) - 1,
+                            2 * source[..., 1] / (h - 1) - 1], dim=-1).reshape(n, h, w, 2)
+
+        return F.grid_sample(batch, grid, mode="bilinear", padding_mode="zeros", align_corners=True)
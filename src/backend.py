@@ -0,0 +1,145 @@
+import os
+
+import numpy as np
+import torch
+from torch import nn
+
+try:
+    from .execution import ExecutionMode
+except ImportError:
+    from execution import ExecutionMode
+
+BACKENDS = ("torch", "torchscript", "onnx")
+
+
+class TorchBackend:
+    def __init__(self, model: nn.Module, execution: ExecutionMode = None):
+        """Run an eager PyTorch model
+
+        Args:
+            model (nn.Module): Model to run
+            execution (ExecutionMode, optional): Precision and memory format of the model. Defaults to fp32.
+        """
+
+        self.execution = execution or ExecutionMode()
+        self.model = self.execution.prepare_model(model).eval()
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        """Compute the logits of a batch
+
+        Args:
+            batch (torch.Tensor): Batch of images (N x C x H x W)
+
+        Returns:
+            torch.Tensor: Logits (N x number of lesions)
+        """
+
+        with torch.inference_mode(), self.execution.autocast():
+            return self.model(self.execution.prepare_input(batch)).float()
+
+
+class TorchScriptBackend(TorchBackend):
+    def __init__(self, path: str, execution: ExecutionMode = None):
+        """Run a TorchScript model exported by export_torchscript
+
+        Args:
+            path (str): Path to the TorchScript file
+            execution (ExecutionMode, optional): Precision and memory format of the model. Defaults to fp32.
+        """
+
+        super().__init__(torch.jit.load(path, map_location="cpu"), execution)
+
+
+class OnnxBackend:
+    def __init__(self, path: str, threads: int = None, inter_op_threads: int = 1):
+        """Run an ONNX model exported by export_onnx with ONNX Runtime (CPU)
+
+        Args:
+            path (str): Path to the ONNX file
+            threads (int, optional): Number of intra-op threads. Defaults to the number of cores.
+            inter_op_threads (int, optional): Number of inter-op threads. Defaults to 1.
+        """
+
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads or os.cpu_count()
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        """Compute the logits of a batch
+
+        Args:
+            batch (torch.Tensor): Batch of images (N x C x H x W)
+
+        Returns:
+            torch.Tensor: Logits (N x number of lesions)
+        """
+
+        inputs = np.ascontiguousarray(batch.detach().cpu().numpy(), dtype=np.float32)
+        return torch.from_numpy(self.session.run(None, {self.input_name: inputs})[0])
+
+
+def load_backend(kind: str, path: str, model: nn.Module = None, execution: ExecutionMode = None,
+                 threads: int = None):
+    """Create an inference backend
+
+    Args:
+        kind (str): "torch", "torchscript" or "onnx"
+        path (str): Path to the exported model (ignored for "torch")
+        model (nn.Module, optional): Eager model (only for "torch"). Defaults to None.
+        execution (ExecutionMode, optional): Execution mode of the PyTorch backends. Defaults to fp32.
+        threads (int, optional): Number of intra-op threads of ONNX Runtime. Defaults to the number of cores.
+
+    Raises:
+        ValueError: If the kind of backend is unknown.
+
+    Returns:
+        The backend, called with a batch of images and returning the logits
+    """
+
+    if kind == "torch":
+        return TorchBackend(model, execution)
+    if kind == "torchscript":
+        return TorchScriptBackend(path, execution)
+    if kind == "onnx":
+        return OnnxBackend(path, threads)
+
+    raise ValueError(f"Invalid backend: {kind} (backends: {', '.join(BACKENDS)})")
+
+
+def export_torchscript(model: nn.Module, path: str, example: torch.Tensor) -> None:
+    """Export a model to TorchScript (traced, any batch size)
+
+    Args:
+        model (nn.Module): Model to export
+        path (str): Path of the TorchScript file
+        example (torch.Tensor): Example of input (1 x C x H x W)
+    """
+
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), example)
+
+    torch.jit.save(traced, path)
+
+
+def export_onnx(model: nn.Module, path: str, example: torch.Tensor, opset: int = 17) -> None:
+    """Export a model to ONNX with a dynamic batch dimension
+
+    Args:
+        model (nn.Module): Model to export
+        path (str): Path of the ONNX file
+        example (torch.Tensor): Example of input (1 x C x H x W)
+        opset (int, optional): ONNX opset. Defaults to 17.
+    """
+
+    with torch.no_grad():
+        torch.onnx.export(model.eval(), example, path,
+                          input_names=["input"], output_names=["logits"],
+                          dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+                          opset_version=opset)
@@ -0,0 +1,163 @@
+import threading
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+from typing import Any, Callable
+
+import numpy as np
+
+
+class MicroBatcher:
+    def __init__(self, predict_fn: Callable[[list], np.ndarray], max_batch_size: int = 16,
+                 max_wait_ms: float = 5.0):
+        """Group concurrent predictions into a single forward pass
+
+        Args:
+            predict_fn (Callable[[list], np.ndarray]): Function taking a list of images and
+                returning one row of probabilities per image (e.g. ExplainResults.batch_prediction), or
+                a list with one result per image (e.g. ExplainResults.gradcam_explanations).
+            max_batch_size (int, optional): Maximum number of images in a batch. Defaults to 16.
+            max_wait_ms (float, optional): Maximum time (in milliseconds) the first request of a
+                batch waits for other requests before the batch is run. Defaults to 5.0.
+        """
+
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size should be at least 1")
+
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max(max_wait_ms, 0) / 1000
+
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+        self._batches = 0
+        self._requests = 0
+        self._batch_sizes = {}
+        self._queue_delay_total = 0.0
+        self._queue_delay_max = 0.0
+
+    def _ensure_worker(self) -> None:
+        """Start the worker thread on first use."""
+
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self._worker.start()
+
+    def submit(self, image: Any) -> np.ndarray:
+        """Predict a single image, batched with the other pending requests
+
+        Args:
+            image (Any): Image accepted by predict_fn.
+
+        Returns:
+            np.ndarray: The probabilities of the prediction for this image (for a list, a list
+                holding the result of this image).
+        """
+
+        self._ensure_worker()
+
+        future = Future()
+        self._queue.put((image, future, time.perf_counter()))
+
+        return future.result()
+
+    def _collect(self) -> list:
+        """Wait for a first request then gather others until the batch is full or the
+        maximum wait time of the first request has elapsed.
+
+        Returns:
+            list: Pending requests (image, future, enqueue time). None if the batcher is closed.
+        """
+
+        first = self._queue.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = first[2] + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except Empty:
+                break
+
+            if batch[-1] is None:
+                # Stop after this batch
+                batch.pop()
+                self._queue.put(None)
+                break
+
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+
+            start = time.perf_counter()
+            self._record(len(batch), [start - enqueued for _, _, enqueued in batch])
+
+            try:
+                probs = self.predict_fn([image for image, _, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                else:
+                    self._run_each(batch)
+                continue
+
+            for i, (_, future, _) in enumerate(batch):
+                future.set_result(probs[i:i + 1])
+
+    def _run_each(self, batch: list) -> None:
+        """Run the requests of a failed batch one by one, so only the invalid requests fail"""
+
+        for image, future, _ in batch:
+            try:
+                future.set_result(self.predict_fn([image])[0:1])
+            except Exception as e:
+                future.set_exception(e)
+
+    def close(self) -> None:
+        """Stop the worker thread once the pending requests are processed."""
+
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                self._queue.put(None)
+            self._worker = None
+
+    def _record(self, size: int, delays: list) -> None:
+        with self._lock:
+            self._batches += 1
+            self._requests += size
+            self._batch_sizes[size] = self._batch_sizes.get(size, 0) + 1
+            self._queue_delay_total += sum(delays)
+            self._queue_delay_max = max(self._queue_delay_max, max(delays))
+
+    def stats(self) -> dict:
+        """Counters used to tune max_batch_size and max_wait_ms
+
+        Returns:
+            dict: Number of batches and requests, batch size histogram and queue delays (in ms).
+        """
+
+        with self._lock:
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "batches": self._batches,
+                "requests": self._requests,
+                "mean_batch_size": self._requests / self._batches if self._batches else 0.0,
+                "batch_sizes": {str(k): v for k, v in sorted(self._batch_sizes.items())},
+                "mean_queue_delay_ms": 1000 * self._queue_delay_total / self._requests if self._requests else 0.0,
+                "max_queue_delay_ms": 1000 * self._queue_delay_max,
+            }
@@ -0,0 +1,318 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+ENTRY_OVERHEAD = 256
+# Only the directories with this prefix are created (and deleted) by the cache in disk_dir
+VERSION_PREFIX = "results-"
+
+
+def image_digest(image: Image.Image) -> str:
+    """Hash the decoded pixels of an image
+
+    Args:
+        image (Image.Image): Image to hash
+
+    Returns:
+        str: SHA-256 of the mode, the size and the pixels of the image
+    """
+
+    h = hashlib.sha256()
+    h.update(f"{image.mode}:{image.size}".encode("utf8"))
+    h.update(image.tobytes())
+
+    return h.hexdigest()
+
+
+def checkpoint_digest(path: str) -> str:
+    """Hash a checkpoint file, used to invalidate the cached results
+
+    Args:
+        path (str): Path to the checkpoint
+
+    Returns:
+        str: SHA-256 of the content of the file
+    """
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_bytes: int, version: str, disk_dir: Optional[str] = None,
+                 max_disk_bytes: Optional[int] = None):
+        """LRU cache of predictions and explanations, with an optional on-disk tier
+
+        Args:
+            max_bytes (int): Memory budget of the cache (in bytes)
+            version (str): Version of the model (e.g. checkpoint_digest). Entries of other versions are never returned.
+            disk_dir (Optional[str], optional): Directory where explanations are also stored. Defaults to None.
+            max_disk_bytes (Optional[int], optional): Disk budget of the stored explanations (in bytes), the
+                least recently used files are removed beyond it. Defaults to None (no limit).
+        """
+
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.version = None
+        self._disk_size = 0
+
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+        self.set_version(version)
+
+    @staticmethod
+    def key(digest: str, model: str, num_samples: int) -> str:
+        """Key of a result
+
+        Args:
+            digest (str): Hash of the image (see image_digest)
+            model (str): Name of the model
+            num_samples (int): Number of LIME samples, 0 when there is no explanation
+
+        Returns:
+            str: Key of the result
+        """
+
+        return f"{model}-{num_samples}-{digest}"
+
+    def set_version(self, version: str) -> None:
+        """Change the version of the model, dropping the entries of the previous version
+
+        Args:
+            version (str): New version
+        """
+
+        with self._lock:
+            if version == self.version:
+                return
+
+            self.version = version
+            self._entries.clear()
+            self._size = 0
+
+            if self.disk_dir is not None:
+                os.makedirs(self._version_dir(), exist_ok=True)
+                for name in os.listdir(self.disk_dir):
+                    path = os.path.join(self.disk_dir, name)
+                    if name.startswith(VERSION_PREFIX) and path != self._version_dir() and os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                self._disk_size = sum(size for _, size, _ in self._disk_files())
+
+        self._prune_disk()
+
+    def _version_dir(self) -> str:
+        return os.path.join(self.disk_dir, VERSION_PREFIX + self.version)
+
+    def _disk_files(self) -> list:
+        """(path, size, last use) of the stored explanations"""
+
+        files = []
+        with os.scandir(self._version_dir()) as entries:
+            for entry in entries:
+                if entry.name.endswith(".npz"):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    files.append((entry.path, stat.st_size, stat.st_mtime))
+
+        return files
+
+    def _prune_disk(self) -> None:
+        """Remove the least recently used explanations beyond the disk budget (down to 90% of it).
+        The files are listed again, as other processes may share the directory."""
+
+        if self.disk_dir is None or self.max_disk_bytes is None:
+            return
+
+        with self._disk_lock:
+            if self._disk_size <= self.max_disk_bytes:
+                return
+
+            files = sorted(self._disk_files(), key=lambda file: file[2])
+            size = sum(file[1] for file in files)
+            for path, file_size, _ in files:
+                if size <= 0.9 * self.max_disk_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= file_size
+                self.disk_evictions += 1
+
+            self._disk_size = size
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self._version_dir(), key + ".npz")
+
+    def get(self, key: str) -> Optional[Tuple[tuple, Optional[dict]]]:
+        """Get a result
+
+        Args:
+            key (str): Key of the result
+
+        Returns:
+            Optional[Tuple[tuple, Optional[dict]]]: (The prediction, The probability), The explanation. None if not cached.
+        """
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+
+        value = self._load(key)
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.disk_hits += 1
+
+        self._insert(key, value)
+        return value
+
+    def put(self, key: str, lesion: tuple, explanation: Optional[dict]) -> None:
+        """Store a result
+
+        Args:
+            key (str): Key of the result
+            lesion (tuple): (The prediction, The probability of the prediction)
+            explanation (Optional[dict]): The arrays of the explanation (see ExplainResults.explanation),
+                None if there is no explanation
+        """
+
+        value = ((lesion[0], float(lesion[1])), explanation)
+        self._insert(key, value)
+
+        if explanation is not None:
+            self._store(key, value)
+
+    def discard(self, model: str) -> None:
+        """Drop the results of a model (e.g. after its checkpoint was replaced)
+
+        Args:
+            model (str): Name of the model, as given to key
+        """
+
+        prefix = f"{model}-"
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                self._size -= self._entries.pop(key)[1]
+
+        if self.disk_dir is None:
+            return
+
+        # The files are removed without holding the lock of the requests, as in _prune_disk
+        paths = [os.path.join(self._version_dir(), name) for name in os.listdir(self._version_dir())
+                 if name.startswith(prefix)]
+        for path in paths:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                continue
+            with self._disk_lock:
+                self._disk_size -= size
+
+    def _insert(self, key: str, value: tuple) -> None:
+        size = ENTRY_OVERHEAD + sum(a.nbytes for a in (value[1] or {}).values())
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, size)
+            self._size += size
+
+            while self._size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= evicted
+                self.evictions += 1
+
+    def _store(self, key: str, value: tuple) -> None:
+        if self.disk_dir is None:
+            return
+
+        (prediction, probability), explanation = value
+        path = self._disk_path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        try:
+            with open(tmp, "wb") as f:
+                np.savez(f, prediction=np.array(prediction), probability=np.array(probability), **explanation)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+            with self._disk_lock:
+                self._disk_size += size
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+
+        self._prune_disk()
+
+    def _load(self, key: str) -> Optional[tuple]:
+        if self.disk_dir is None:
+            return None
+
+        path = self._disk_path(key)
+        try:
+            with np.load(path) as data:
+                lesion = (str(data["prediction"]), float(data["probability"]))
+                explanation = {k: data[k] for k in data.files if k not in ("prediction", "probability")}
+        except (OSError, KeyError, ValueError):
+            return None
+
+        try:
+            # The modification time is the last use of the file (see _prune_disk)
+            os.utime(path)
+        except OSError:
+            pass
+
+        return lesion, explanation
+
+    def stats(self) -> dict:
+        """Counters of the cache
+
+        Returns:
+            dict: Number of entries, memory used, hits, misses and evictions.
+        """
+
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_bytes": self._disk_size,
+                "max_disk_bytes": self.max_disk_bytes,
+                "disk_evictions": self.disk_evictions,
+            }
@@ -1,10 +1,15 @@
 from torch.utils.data import Dataset
 import torch
+import numpy as np
 from PIL import Image
 import pandas as pd
 from torchvision.transforms import Compose
-from os.path import isfile, join
-from os import listdir
+from os.path import isfile, isdir, join, basename
+from os import listdir, makedirs, stat, replace
+import json
+import shutil
+
+STORE_SHAPE = (450, 600, 3)
 
 def load_images(path_meta: str, path_images:str , type_dict: dict, cardinal_dict: dict) -> pd.DataFrame:
     """Load the HAM10000 images.
@@ -32,6 +37,148 @@ def load_images(path_meta: str, path_images:str , type_dict: dict, cardinal_dict
     return meta.drop(columns=['dx'])
 
 
+def store_path(path_images: str) -> str:
+    """Path of the decoded image store of an image folder.
+
+    Args:
+        path_images (str): Path to the images.
+
+    Returns:
+        str: Path to the store.
+    """
+
+    return path_images.rstrip("/") + ".store"
+
+
+def _store_index(meta: pd.DataFrame, path_meta: str) -> dict:
+    """Describe the files a store is built from, to detect when it is out of date.
+
+    Args:
+        meta (pd.DataFrame): DataFrame with the metadata of the images.
+        path_meta (str): Path to the metadata.
+
+    Returns:
+        dict: Names, sizes and modification times of the images and the metadata.
+    """
+
+    stats = [stat(path) for path in meta["image_id"]]
+    meta_stat = stat(path_meta)
+
+    return {
+        "image_ids": [basename(path) for path in meta["image_id"]],
+        "images": [[s.st_size, s.st_mtime_ns] for s in stats],
+        "metadata": [meta_stat.st_size, meta_stat.st_mtime_ns],
+    }
+
+
+def is_store_up_to_date(store: str, meta: pd.DataFrame, path_meta: str) -> bool:
+    """Check that a store exists and matches the images and the metadata.
+
+    Args:
+        store (str): Path to the store.
+        meta (pd.DataFrame): DataFrame with the metadata of the images.
+        path_meta (str): Path to the metadata.
+
+    Returns:
+        bool: True if the store can be used.
+    """
+
+    try:
+        with open(join(store, "index.json")) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    expected = _store_index(meta, path_meta)
+    return all(index.get(k) == v for k, v in expected.items())
+
+
+def build_store(store: str, meta: pd.DataFrame, path_meta: str, shape: tuple = STORE_SHAPE) -> None:
+    """Decode the images once into a memory-mapped uint8 array.
+
+    The store is a folder with images.npy (N x H x W x 3 uint8), labels.npy and index.json.
+    Images whose size differs from shape are resized.
+
+    Args:
+        store (str): Path to the store.
+        meta (pd.DataFrame): DataFrame with the metadata of the images.
+        path_meta (str): Path to the metadata.
+        shape (tuple, optional): Shape (H, W, 3) of the stored images. Defaults to STORE_SHAPE.
+    """
+
+    tmp = store + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    makedirs(tmp)
+
+    images = np.lib.format.open_memmap(join(tmp, "images.npy"), mode="w+",
+                                       dtype=np.uint8, shape=(len(meta), *shape))
+    for i, path in enumerate(meta["image_id"]):
+        with Image.open(path) as img:
+            img = img.convert("RGB")
+            if img.size != (shape[1], shape[0]):
+                img = img.resize((shape[1], shape[0]), Image.BILINEAR)
+            images[i] = np.asarray(img)
+    images.flush()
+    del images
+
+    np.save(join(tmp, "labels.npy"), meta["label"].to_numpy(dtype=np.int64))
+    with open(join(tmp, "index.json"), "w") as f:
+        json.dump(_store_index(meta, path_meta), f)
+
+    shutil.rmtree(store, ignore_errors=True)
+    replace(tmp, store)
+
+
+def _paths(root: str, train: bool) -> tuple:
+    path_images = "/HAM10000_images_train/" if train else "/HAM10000_images_test/"
+    path_metadata = "/HAM10000_metadata.csv"
+
+    return root + path_images, root + path_metadata
+
+
+class HAM10000Store(Dataset):
+    def __init__(self, store: str, transform=None):
+        """HAM10000 dataset served from a decoded image store (see build_store).
+
+        The store is memory-mapped lazily, so each DataLoader worker maps it once and
+        the images are read without decoding or copying.
+
+        Args:
+            store (str): Path to the store.
+            transform (Compose, optional): Transformations to apply to the PIL image. Defaults to None.
+                Without transform, the image is returned as a uint8 tensor (3 x H x W) sharing the memory of the store.
+        """
+
+        self.store = store
+        self.transform = transform
+        self.labels = torch.from_numpy(np.load(join(store, "labels.npy")))
+        self._images = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    @property
+    def images(self) -> np.ndarray:
+        if self._images is None:
+            self._images = np.load(join(self.store, "images.npy"), mmap_mode="c")
+        return self._images
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        X = self.images[index]
+
+        if self.transform:
+            X = self.transform(Image.fromarray(X))
+        else:
+            X = torch.from_numpy(X).permute(2, 0, 1)
+
+        return X, self.labels[index]
+
+
 class HAM10000(Dataset):
     LESION_TYPE = {
         'nv': 'Melanocytic nevi',
@@ -67,13 +214,16 @@ class HAM10000(Dataset):
         return HAM10000(df, transform)
     
     @staticmethod
-    def load_from_file(root: str, train: bool = True, transform: Compose = None) -> Dataset:
+    def load_from_file(root: str, train: bool = True, transform: Compose = None,
+                       use_store: bool = True) -> Dataset:
         """Load the HAM10000 images from a path.
 
         Args:
             root (str): Path to the HAM10000 dataset.
             train (bool, optional): Get the training sample. Defaults to True.
             transform (Compose, optional): Transformation to apply. Defaults to None.
+            use_store (bool, optional): Use the decoded image store (see HAM10000.build_store)
+                if it is up to date. Defaults to True.
 
         Raises:
             FileNotFoundError: If the file are not found.
@@ -82,34 +232,60 @@ class HAM10000(Dataset):
             Dataset: The HAM10000 dataset.
         """
 
-        path_images = "/HAM10000_images_train/" if train else "/HAM10000_images_test/"
-        path_metadata = "/HAM10000_metadata.csv"
-        
-        path_images = root + path_images
-        path_metadata = root + path_metadata
+        path_images, path_metadata = _paths(root, train)
+        meta_df = HAM10000._load_metadata(path_images, path_metadata)
+
+        store = store_path(path_images)
+        if use_store and isdir(store) and is_store_up_to_date(store, meta_df, path_metadata):
+            return HAM10000Store(store, transform)
         
+        return HAM10000(meta_df, transform)
+
+    @staticmethod
+    def build_store(root: str, train: bool = True, force: bool = False) -> str:
+        """Decode the HAM10000 images into a memory-mapped store, used by load_from_file.
+
+        Args:
+            root (str): Path to the HAM10000 dataset.
+            train (bool, optional): Build the store of the training sample. Defaults to True.
+            force (bool, optional): Rebuild the store even if it is up to date. Defaults to False.
+
+        Returns:
+            str: Path to the store.
+        """
+
+        path_images, path_metadata = _paths(root, train)
+        meta_df = HAM10000._load_metadata(path_images, path_metadata)
+
+        store = store_path(path_images)
+        if force or not is_store_up_to_date(store, meta_df, path_metadata):
+            build_store(store, meta_df, path_metadata)
+
+        return store
+
+    @staticmethod
+    def _load_metadata(path_images: str, path_metadata: str) -> pd.DataFrame:
         try:
-            meta_df = load_images(path_metadata, path_images,
-                                  HAM10000.LESION_TYPE, HAM10000.TYPE_CARDINAL)
+            return load_images(path_metadata, path_images,
+                               HAM10000.LESION_TYPE, HAM10000.TYPE_CARDINAL)
         except FileNotFoundError:
             raise FileNotFoundError(f"File {path_metadata} or {path_images} not found.")
-        
-        return HAM10000(meta_df, transform)
     
     def __init__(self, df: pd.DataFrame, transform=None):
         self.df = df
         self.transform = transform
+        
+        self.paths = df["image_id"].tolist()
+        self.labels = torch.tensor(df["label"].to_numpy(), dtype=torch.long)
 
     def __len__(self):
         return len(self.df)
 
     def __getitem__(self, index):
-        X = Image.open(self.df.iloc[index, 0])
+        X = Image.open(self.paths[index])
         
         if self.transform:
             X = self.transform(X)
 
-        y = torch.tensor(self.df.iloc[index, 2], dtype=torch.long)
-
-        return X, y
+        return X, self.labels[index]
     
@@ -0,0 +1,89 @@
+import contextlib
+
+import torch
+from torch import nn
+
+OPTIONS = ("fp32", "bf16", "channels_last")
+
+
+class ExecutionMode:
+    def __init__(self, bf16: bool = False, channels_last: bool = False):
+        """How the model is executed
+
+        Args:
+            bf16 (bool, optional): Run the model under bfloat16 autocast. Defaults to False.
+            channels_last (bool, optional): Use the channels_last memory format for the model and its inputs. Defaults to False.
+        """
+
+        self.bf16 = bf16
+        self.channels_last = channels_last
+
+    @staticmethod
+    def from_name(name: str) -> "ExecutionMode":
+        """Parse an execution mode
+
+        Args:
+            name (str): "fp32" or a comma separated list of options ("bf16", "channels_last"), e.g. "bf16,channels_last"
+
+        Raises:
+            ValueError: If an option is unknown.
+
+        Returns:
+            ExecutionMode: The execution mode
+        """
+
+        options = {option.strip() for option in (name or "fp32").split(",") if option.strip()}
+        unknown = options - set(OPTIONS)
+        if unknown:
+            raise ValueError(f"Invalid execution mode: {', '.join(sorted(unknown))} (options: {', '.join(OPTIONS)})")
+
+        return ExecutionMode(bf16="bf16" in options, channels_last="channels_last" in options)
+
+    def __str__(self) -> str:
+        options = [name for name, enabled in (("bf16", self.bf16), ("channels_last", self.channels_last)) if enabled]
+        return ",".join(options) or "fp32"
+
+    def prepare_model(self, model: nn.Module) -> nn.Module:
+        """Convert the model to the memory format of the mode
+
+        Args:
+            model (nn.Module): Model to convert (in place)
+
+        Returns:
+            nn.Module: The model
+        """
+
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+
+        return model
+
+    def prepare_input(self, batch: torch.Tensor) -> torch.Tensor:
+        """Convert a batch of images to the memory format of the mode
+
+        Args:
+            batch (torch.Tensor): Batch of images (N x C x H x W)
+
+        Returns:
+            torch.Tensor: The batch
+        """
+
+        if self.channels_last and batch.dim() == 4:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+
+        return batch
+
+    def autocast(self, device: str = "cpu"):
+        """Context running the model in the precision of the mode
+
+        Args:
+            device (str, optional): Device of the model. Defaults to "cpu".
+
+        Returns:
+            Context manager
+        """
+
+        if self.bf16:
+            return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+        return contextlib.nullcontext()
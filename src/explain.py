@@ -1,3 +1,5 @@
+import time
+
 import torch
 import torch.nn.functional as F
 import torchvision.transforms as transforms
@@ -5,26 +7,334 @@ from typing import Tuple
 
 import numpy as np
 
-from lime import lime_image
-from skimage.segmentation import mark_boundaries
+# lime, skimage and sklearn are slow to import: they are imported when the first
+# explanation is requested, not when the server starts.
+
+try:
+    from .backend import TorchBackend
+    from .execution import ExecutionMode
+    from .gradcam import GradCAM
+    from .preprocess import Preprocessor
+    from .segmentation import Segmenter
+except ImportError:
+    from backend import TorchBackend
+    from execution import ExecutionMode
+    from gradcam import GradCAM
+    from preprocess import Preprocessor
+    from segmentation import Segmenter
+
+METHODS = ("lime", "gradcam")
+
+
+class TensorLimeExplainer:
+    def __init__(self, predict_fn, transform: transforms.Compose,
+                 explainer: "lime_image.LimeImageExplainer", batch_size: int = 32,
+                 segmentation_fn=None):
+        """LIME explainer building the perturbed images directly as tensors.
+
+        The base image is transformed and segmented once. Each perturbation is then the
+        transformed image where the hidden segments are replaced by the transformed hide
+        color, so the per-image preprocessing is not run again for every sample.
+
+        Args:
+            predict_fn (Callable[[torch.Tensor], np.ndarray]): Function returning the probabilities of a batch of tensors
+            transform (transforms.Compose): Transformation to apply to the base image
+            explainer (lime_image.LimeImageExplainer): LIME explainer providing the random state and the linear model
+            batch_size (int, optional): Number of perturbed images sent at once to predict_fn. Defaults to 32.
+            segmentation_fn (Callable[[np.ndarray], np.ndarray], optional): Segmentation of the base image
+                (e.g. a Segmenter). Defaults to the quickshift segmentation of LIME.
+        """
+
+        self.predict_fn = predict_fn
+        self.transform = transform
+        self.explainer = explainer
+        self.batch_size = batch_size
+        self.segmentation_fn = segmentation_fn
+
+    def segment(self, image: np.ndarray, random_seed: int) -> np.ndarray:
+        """Segment the image in superpixels (same segmentation as LIME)
+
+        Args:
+            image (np.ndarray): Image to segment
+            random_seed (int): Seed of the segmentation
+
+        Returns:
+            np.ndarray: Segment map, with labels from 0 to the number of segments - 1
+        """
+
+        if self.segmentation_fn is not None:
+            return self.segmentation_fn(image)
+
+        from lime.wrappers.scikit_image import SegmentationAlgorithm
+
+        segmentation_fn = SegmentationAlgorithm('quickshift', kernel_size=4, max_dist=200,
+                                                ratio=0.2, random_seed=random_seed)
+        return segmentation_fn(image)
+
+    def _prepare(self, image: np.ndarray, hide_color: int) -> tuple:
+        """Segment the image and transform it, with and without the hidden segments
+
+        Returns:
+            tuple: The image (H x W x 3), its segment map, the transformed image, the transformed
+                hide color and the segment of each pixel of the transformed image
+        """
+
+        from skimage.color import gray2rgb
+
+        image = np.array(image)
+        if len(image.shape) == 2:
+            image = gray2rgb(image)
+
+        segments = self.segment(image, self.explainer.random_state.randint(0, high=1000))
+
+        base = self.transform(image)
+        fudged = self.transform(np.full_like(image, hide_color))
+
+        # Segment of each pixel of the transformed image
+        segment_map = torch.from_numpy(segments.astype(np.float32))[None, None]
+        segment_map = F.interpolate(segment_map, size=base.shape[-2:], mode='nearest')
+        segment_map = segment_map[0, 0].long()
+
+        return image, segments, base, fudged, segment_map
+
+    def _fit(self, image: np.ndarray, segments: np.ndarray, data: np.ndarray, labels: np.ndarray,
+             top_labels: int, num_features: int) -> "lime_image.ImageExplanation":
+        """Fit the local linear models of LIME on the evaluated samples"""
+
+        from lime import lime_image
+        from sklearn.metrics import pairwise_distances
+
+        distances = pairwise_distances(data, data[0].reshape(1, -1), metric='cosine').ravel()
+
+        explanation = lime_image.ImageExplanation(image, segments)
+        top = np.argsort(labels[0])[-top_labels:]
+        explanation.top_labels = list(top)
+        explanation.top_labels.reverse()
+
+        for label in top:
+            (explanation.intercept[label],
+             explanation.local_exp[label],
+             explanation.score[label],
+             explanation.local_pred[label]) = self.explainer.base.explain_instance_with_data(
+                data, labels, distances, label, num_features,
+                feature_selection=self.explainer.feature_selection)
+
+        return explanation
+
+    def explain_instance(self, image: np.ndarray, top_labels: int = 1, hide_color: int = 0,
+                         num_features: int = 100000, num_samples: int = 1000,
+                         progress=None) -> "lime_image.ImageExplanation":
+        """Explain a prediction, same API as lime_image.LimeImageExplainer.explain_instance
+
+        Args:
+            image (np.ndarray): Image to explain
+            top_labels (int, optional): Number of labels to explain, starting from the most probable. Defaults to 1.
+            hide_color (int, optional): Color of the hidden segments. Defaults to 0.
+            num_features (int, optional): Maximum number of segments in the explanation. Defaults to 100000.
+            num_samples (int, optional): Number of perturbed images. Defaults to 1000.
+            progress (Callable[[int, int], None], optional): Called with the number of evaluated samples and num_samples after each batch. Defaults to None.
+
+        Returns:
+            lime_image.ImageExplanation: The explanation
+        """
+
+        image, segments, base, fudged, segment_map = self._prepare(image, hide_color)
+
+        n_features = np.unique(segments).shape[0]
+        data = self.explainer.random_state.randint(0, 2, num_samples * n_features).reshape((num_samples, n_features))
+        data[0, :] = 1
+
+        rows = torch.from_numpy(data).bool()
+        labels = []
+        for start in range(0, num_samples, self.batch_size):
+            keep = rows[start:start + self.batch_size][:, segment_map]
+            labels.append(self.predict_fn(torch.where(keep[:, None], base, fudged)))
+
+            if progress is not None:
+                progress(min(start + self.batch_size, num_samples), num_samples)
+        labels = np.concatenate(labels)
+
+        return self._fit(image, segments, data, labels, top_labels, num_features)
+
+    def explain_adaptive(self, image: np.ndarray, top_labels: int = 1, hide_color: int = 0,
+                         num_features: int = 100000, max_samples: int = 1000, min_samples: int = 50,
+                         round_size: int = 50, top_k: int = 5, tolerance: float = 0.01, patience: int = 2,
+                         deadline: float = None,
+                         progress=None) -> Tuple["lime_image.ImageExplanation", dict]:
+        """Explain a prediction with as few samples as needed.
+
+        The samples are evaluated in rounds. After each round the linear model is fitted again,
+        and the sampling stops once the top_k segments of the most probable label and the score
+        of the linear model have not changed for patience rounds, once max_samples are evaluated,
+        or before the next batch and the fit of the linear model would end after the deadline.
+
+        Args:
+            image (np.ndarray): Image to explain
+            top_labels (int, optional): Number of labels to explain, starting from the most probable. Defaults to 1.
+            hide_color (int, optional): Color of the hidden segments. Defaults to 0.
+            num_features (int, optional): Maximum number of segments in the explanation. Defaults to 100000.
+            max_samples (int, optional): Maximum number of perturbed images. Defaults to 1000.
+            min_samples (int, optional): Number of perturbed images of the first round. Defaults to 50.
+            round_size (int, optional): Number of perturbed images of the next rounds. Defaults to 50.
+            top_k (int, optional): Number of segments compared between rounds. Defaults to 5.
+            tolerance (float, optional): Largest change of the score (R²) of a stable round. Defaults to 0.01.
+            patience (int, optional): Number of stable rounds before stopping. Defaults to 2.
+            deadline (float, optional): time.monotonic() before which the explanation should be returned,
+                estimated from the durations of the last batch and of the last fit. At least one batch
+                is always evaluated. Defaults to None (no deadline).
+            progress (Callable[[int, int], None], optional): Called with the number of evaluated samples and max_samples after each batch. Defaults to None.
+
+        Returns:
+            Tuple[lime_image.ImageExplanation, dict]: The explanation, and the number of evaluated
+                samples ("samples"), why the sampling stopped ("convergence": "converged",
+                "max_samples" or "deadline") and the score of the linear model ("score").
+        """
+
+        image, segments, base, fudged, segment_map = self._prepare(image, hide_color)
+
+        n_features = np.unique(segments).shape[0]
+        data = self.explainer.random_state.randint(0, 2, max_samples * n_features).reshape((max_samples, n_features))
+        data[0, :] = 1
+
+        rows = torch.from_numpy(data).bool()
+        labels = []
+        evaluated = 0
+        next_fit = min(min_samples, max_samples)
+        batch_seconds = 0.0
+        fit_seconds = 0.0
+        fitted = 0
+        previous = None
+        stable = 0
+        explanation = None
+        convergence = "max_samples"
+
+        while evaluated < max_samples:
+            started = time.monotonic()
+            if deadline is not None and evaluated > 0 and started + batch_seconds + fit_seconds > deadline:
+                convergence = "deadline"
+                break
+
+            stop = min(evaluated + self.batch_size, max_samples)
+            keep = rows[evaluated:stop][:, segment_map]
+            labels.append(self.predict_fn(torch.where(keep[:, None], base, fudged)))
+            evaluated = stop
+            batch_seconds = time.monotonic() - started
+
+            if progress is not None:
+                progress(evaluated, max_samples)
+
+            if next_fit <= evaluated < max_samples:
+                next_fit = evaluated + round_size
+                fit_started = time.monotonic()
+                explanation = self._fit(image, segments, data[:evaluated], np.concatenate(labels),
+                                        top_labels, num_features)
+                fit_seconds = time.monotonic() - fit_started
+                fitted = evaluated
+                label = explanation.top_labels[0]
+                top = {segment for segment, _ in explanation.local_exp[label][:top_k]}
+                score = explanation.score[label]
+
+                if previous is not None and top == previous[0] and abs(score - previous[1]) <= tolerance:
+                    stable += 1
+                else:
+                    stable = 0
+                previous = (top, score)
+
+                if stable >= patience:
+                    convergence = "converged"
+                    break
+
+        # The explanation of the last round is kept when no sample was evaluated since
+        if fitted != evaluated:
+            explanation = self._fit(image, segments, data[:evaluated], np.concatenate(labels),
+                                    top_labels, num_features)
+
+        return explanation, {
+            "samples": evaluated,
+            "convergence": convergence,
+            "score": float(explanation.score[explanation.top_labels[0]]),
+        }
 
 
 class ExplainResults:
     def __init__(self, torch_model: torch.nn.Module, transform: transforms.Compose,
-                 lesion_type: dict):
+                 lesion_type: dict, tensor_lime: bool = True, execution: ExecutionMode = None,
+                 backend=None, segmenter: Segmenter = None):
         """Class to explain the results of a model
 
         Args:
             torch_model (torch.nn.Module): PyTorch model to use
-            transform (transforms.Compose): Transformation to apply
+            transform (transforms.Compose): Transformation to apply. With a Preprocessor, the images are
+                also explained at the size of the model input and the batches reuse a buffer.
             lesion_type (dict): Type of skin diseases
+            tensor_lime (bool, optional): Build the LIME perturbations as tensors instead of
+                transforming every perturbed image. Defaults to True.
+            execution (ExecutionMode, optional): Precision and memory format of the model. Defaults to fp32.
+            backend (optional): Inference backend returning the logits of a batch (see load_backend).
+                Defaults to the eager PyTorch model (torch_model can be None with another backend).
+            segmenter (Segmenter, optional): Segmentation of the explained images. Defaults to the
+                quickshift segmentation of LIME, without cache.
         """
         
         self.lesion_type = lesion_type
+        self.execution = execution or ExecutionMode()
+        self.backend = backend or TorchBackend(torch_model, self.execution)
         self.torch_model = torch_model
         self.transform = transform
+        self.segmenter = segmenter
         
-        self.explainer = lime_image.LimeImageExplainer()
+        self.tensor_lime = tensor_lime
+        self._explainer = None
+        self._tensor_explainer = None
+        self._gradcam = None
+
+    @property
+    def explainer(self) -> "lime_image.LimeImageExplainer":
+        """LIME explainer, created (and lime imported) on first use"""
+
+        if self._explainer is None:
+            from lime import lime_image
+
+            self._explainer = lime_image.LimeImageExplainer()
+
+        return self._explainer
+
+    @property
+    def tensor_explainer(self) -> TensorLimeExplainer:
+        """Tensor-space LIME explainer, None if tensor_lime is False"""
+
+        if self._tensor_explainer is None and self.tensor_lime:
+            self._tensor_explainer = TensorLimeExplainer(self.tensor_prediction, self.transform,
+                                                         self.explainer, segmentation_fn=self.segmenter)
+
+        return self._tensor_explainer
+
+    @property
+    def gradcam(self) -> GradCAM:
+        """Grad-CAM explainer, created on first use"""
+
+        if self._gradcam is None:
+            if not isinstance(self.backend, TorchBackend) or self.torch_model is None:
+                raise ValueError("Grad-CAM needs the eager PyTorch model (BACKEND=torch, not quantized)")
+            self._gradcam = GradCAM(self.torch_model, self.execution)
+
+        return self._gradcam
+
+    def tensor_prediction(self, batch: torch.Tensor) -> np.ndarray:
+        """Make a prediction on a batch of transformed images
+
+        Args:
+            batch (torch.Tensor): Batch of images, with shape (N, C, H, W)
+
+        Returns:
+            np.ndarray: The probabilities of the prediction of each images
+        """
+
+        with torch.inference_mode():
+            pred = self.backend(batch)
+            proba = F.softmax(pred.float(), dim=1)
+
+            return proba.numpy()
         
     def batch_prediction(self, images: list) -> np.ndarray:
         """Make a prediction on a batch of images
@@ -36,15 +346,170 @@ class ExplainResults:
             np.ndarray: The probabilities of the prediction of each images
         """
         
-        batch = torch.stack(tuple(self.transform(i) for i in images), dim=0)
-        self.torch_model.eval()
-        
-        with torch.no_grad():
-            pred = self.torch_model(batch)
-            proba = F.softmax(pred, dim=1)
+        if isinstance(self.transform, Preprocessor):
+            batch = self.transform.batch(images)
+        else:
+            batch = torch.stack(tuple(self.transform(i) for i in images), dim=0)
 
-            return proba.numpy()
+        return self.tensor_prediction(batch)
         
+    def describe(self, probs: np.ndarray) -> tuple:
+        """Convert the probabilities of a single image into a lesion
+
+        Args:
+            probs (np.ndarray): Probabilities of the image, with shape (1, number of lesions)
+
+        Returns:
+            tuple: (The prediction, The probability of the prediction)
+        """
+
+        val = probs.argmax()
+        return self.lesion_type.get(val), probs[0][val]
+
+    def gradcam_explanations(self, images: list, threshold: float = 0.5) -> list:
+        """Predict and explain a batch of images with Grad-CAM (one forward and one backward pass)
+
+        Args:
+            images (list): List of images
+            threshold (float, optional): Pixels whose activation is at least threshold times the
+                maximum of the image form the region shown by the explanation. Defaults to 0.5.
+
+        Returns:
+            list: (probabilities with shape (1, number of lesions), explanation) of each image, the
+                explanation having the same fields as explanation, with a single segment (1) weighted
+                by its mean activation.
+        """
+
+        from skimage.segmentation import mark_boundaries
+
+        if isinstance(self.transform, Preprocessor):
+            bases = [self.transform.image(image) for image in images]
+            batch = self.transform.batch(bases)
+        else:
+            bases = [np.array(image) for image in images]
+            batch = torch.stack(tuple(self.transform(image) for image in bases), dim=0)
+
+        cams, probs = self.gradcam(batch)
+
+        results = []
+        for i, base in enumerate(bases):
+            cam = cams[i:i + 1, None]
+            if cam.shape[-2:] != base.shape[:2]:
+                cam = F.interpolate(cam, size=base.shape[:2], mode="bilinear", align_corners=False)
+            cam = cam[0, 0].numpy()
+
+            mask = cam >= threshold
+            temp = base.astype(np.float64)
+            temp[mask, 1] = np.max(base)
+
+            results.append((probs[i:i + 1], {
+                "overlay": mark_boundaries(temp / 255.0, mask),
+                "segments": mask.astype(np.uint16),
+                "weights": np.array([[1, float(cam[mask].mean()) if mask.any() else 0.0]]),
+            }))
+
+        return results
+
+    def explanation(self, image: np.array, num_samples: int = 100, num_features: int = 5,
+                    progress=None, method: str = "lime", adaptive: bool = False,
+                    deadline: float = None) -> dict:
+        """Explain the prediction made on a single image
+
+        Args:
+            image (np.array): Image to explain
+            num_samples (int, optional): Number of samples needed to make the explanation. Defaults to 100.
+            num_features (int, optional): Number of segments kept in the explanation. Defaults to 5.
+            progress (Callable[[int, int], None], optional): Called with the number of evaluated samples and num_samples. Defaults to None.
+            method (str, optional): "lime" or "gradcam" (num_samples and num_features are then ignored). Defaults to "lime".
+            adaptive (bool, optional): Stop the LIME sampling once the explanation is stable, num_samples
+                being the maximum (see TensorLimeExplainer.explain_adaptive). Defaults to False.
+            deadline (float, optional): With adaptive, time.monotonic() after which the sampling stops
+                and the best explanation so far is returned. Defaults to None (no deadline).
+
+        Returns:
+            dict: The image with the boundaries of the areas used by the model ("overlay"), the segment
+                map ("segments") and the (segment, weight) pairs of the kept segments ("weights").
+                With adaptive, also the number of evaluated samples ("samples") and why the sampling
+                stopped ("convergence": "converged", "max_samples" or "deadline").
+        """
+
+        if method not in METHODS:
+            raise ValueError(f"Invalid method: {method} (methods: {', '.join(METHODS)})")
+        if adaptive and self.tensor_explainer is None:
+            raise ValueError("Adaptive sampling needs tensor_lime")
+
+        if method == "gradcam":
+            return self.gradcam_explanations([image])[0][1]
+
+        from skimage.segmentation import mark_boundaries
+
+        if isinstance(self.transform, Preprocessor):
+            # Segment and perturb the image at the size of the model input, not at its original size
+            image = self.transform.image(image)
+
+        sampling = None
+        if adaptive:
+            explanation, sampling = self.tensor_explainer.explain_adaptive(np.array(image),
+                                                                           top_labels=1,
+                                                                           hide_color=0,
+                                                                           max_samples=num_samples,
+                                                                           top_k=num_features,
+                                                                           deadline=deadline,
+                                                                           progress=progress)
+        elif self.tensor_explainer is not None:
+            explanation = self.tensor_explainer.explain_instance(np.array(image),
+                                                                 top_labels=1,
+                                                                 hide_color=0,
+                                                                 num_samples=num_samples,
+                                                                 progress=progress)
+        else:
+            evaluated = [0]
+
+            def classifier_fn(images):
+                probs = self.batch_prediction(images)
+                evaluated[0] += len(images)
+                if progress is not None:
+                    progress(evaluated[0], num_samples)
+                return probs
+
+            explanation = self.explainer.explain_instance(np.array(image), 
+                                                          classifier_fn, # classification function
+                                                          top_labels=1,
+                                                          hide_color=0,
+                                                          num_samples=num_samples, # number of images that will be sent to classification function
+                                                          segmentation_fn=self.segmenter)
+
+        label = explanation.top_labels[0]
+        temp, mask = explanation.get_image_and_mask(label,
+                                                    positive_only=False,
+                                                    num_features=num_features,
+                                                    hide_rest=False)
+
+        result = {
+            "overlay": mark_boundaries(temp/255.0, mask),
+            "segments": explanation.segments,
+            "weights": np.array(explanation.local_exp[label][:num_features]),
+        }
+        if sampling is not None:
+            # Arrays, as the other fields, so the result is stored as is by the cache
+            result["samples"] = np.array(sampling["samples"])
+            result["convergence"] = np.array(sampling["convergence"])
+
+        return result
+
+    def explain(self, image: np.array, num_samples: int = 100) -> np.array:
+        """Explain the prediction made on a single image
+
+        Args:
+            image (np.array): Image to explain
+            num_samples (int, optional): Number of samples needed to make the explanation. Defaults to 100.
+
+        Returns:
+            np.array: The image with the boundaries of the areas used by the model.
+        """
+
+        return self.explanation(image, num_samples)["overlay"]
+
     def prediction(self, image: np.array, explain: bool = False,
                    num_samples: int = 100) -> Tuple[tuple, np.array]:
         """Make a prediction on a single image
@@ -58,22 +523,9 @@ class ExplainResults:
             Tuple[tuple, np.array]: (The prediction, The probability of the prediction), (The explication if explain is True, None if explain is False).
         """
 
-        probs = self.batch_prediction([image])
-        val = probs.argmax()
-        lesion = (self.lesion_type.get(val), probs[0][val])
+        lesion = self.describe(self.batch_prediction([image]))
         
         if explain:
-            explanation = self.explainer.explain_instance(np.array(image), 
-                                                          self.batch_prediction, # classification function
-                                                          top_labels=1,
-                                                          hide_color=0,
-                                                          num_samples=num_samples) # number of images that will be sent to classification function
-
-            temp, mask = explanation.get_image_and_mask(explanation.top_labels[0],
-                                                        positive_only=False,
-                                                        num_features=5,
-                                                        hide_rest=False)
-
-            return lesion, mark_boundaries(temp/255.0, mask)
+            return lesion, self.explain(image, num_samples)
         
         return lesion, None
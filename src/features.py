@@ -0,0 +1,200 @@
+import copy
+import hashlib
+import json
+from os import makedirs
+from os.path import isfile, join
+from typing import Callable
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, Dataset
+
+try:
+    from .model import last_layer, set_last_layer
+except ImportError:
+    from model import last_layer, set_last_layer
+
+
+def backbone(model: nn.Module) -> nn.Module:
+    """Copy of a HAM10000 model without its last layer, returning the pooled features.
+
+    Args:
+        model (nn.Module): Model (see HAM10000_model)
+
+    Returns:
+        nn.Module: The backbone of the model
+    """
+
+    features = copy.deepcopy(model)
+    set_last_layer(features, nn.Identity())
+
+    return features
+
+
+def _describe(transform) -> object:
+    """Stable description of a transformation (the default repr contains its address)"""
+
+    if transform is None:
+        return None
+    if hasattr(transform, "__name__"):
+        return transform.__name__
+    if not isinstance(transform, nn.Module) and type(transform).__repr__ is not object.__repr__:
+        # e.g. Compose, whose repr lists the transformations and their options
+        return repr(transform)
+
+    options = {k: v for k, v in sorted(vars(transform).items()) if isinstance(v, (bool, int, float, str, tuple, list))}
+    return [type(transform).__name__, options]
+
+
+def feature_metadata(model: nn.Module, dataset: Dataset, views: int = 1,
+                     batch_transform: Callable[[torch.Tensor], torch.Tensor] = None) -> dict:
+    """Describe what the features depend on, to reuse them only when it did not change.
+
+    Args:
+        model (nn.Module): Model (see HAM10000_model)
+        dataset (Dataset): Dataset of the images
+        views (int, optional): Number of views. Defaults to 1.
+        batch_transform (Callable[[torch.Tensor], torch.Tensor], optional): Transformation applied to each batch. Defaults to None.
+
+    Returns:
+        dict: Architecture, hash of the weights of the backbone, input size, transformations and views
+    """
+
+    h = hashlib.sha256()
+    for name, tensor in backbone(model).state_dict().items():
+        h.update(name.encode("utf8"))
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+
+    metadata = {
+        "model": type(model).__name__,
+        "weights": h.hexdigest(),
+        "input_size": list(dataset[0][0].shape),
+        "transform": _describe(getattr(dataset, "transform", None)),
+        "batch_transform": _describe(batch_transform),
+        "views": views,
+    }
+
+    # Same types as once stored in JSON (tuples become lists)
+    return json.loads(json.dumps(metadata))
+
+
+def extract_features(model: nn.Module, dataset: Dataset, path: str, views: int = 1,
+                     batch_size: int = 64, device: str = "cpu", num_workers: int = 0,
+                     batch_transform: Callable[[torch.Tensor], torch.Tensor] = None,
+                     metadata: dict = None) -> str:
+    """Run the backbone of a model once over a dataset and store the pooled features.
+
+    The features are stored in path/features.npy (views x N x number of features, float32)
+    with path/labels.npy and path/index.json. With a random transform in the dataset (or a
+    random batch_transform), each view is a different augmentation of the images.
+
+    Args:
+        model (nn.Module): Model (see HAM10000_model)
+        dataset (Dataset): Dataset of the images
+        path (str): Folder of the features
+        views (int, optional): Number of passes over the dataset. Defaults to 1.
+        batch_size (int, optional): Batch size. Defaults to 64.
+        device (str, optional): Device to use. Defaults to "cpu".
+        num_workers (int, optional): Number of DataLoader workers. Defaults to 0.
+        batch_transform (Callable[[torch.Tensor], torch.Tensor], optional): Transformation applied to
+            each batch on the device (e.g. BatchAugment or to_float). Defaults to None.
+        metadata (dict, optional): Description of the features (see feature_metadata), checked by has_features.
+            Defaults to None.
+
+    Returns:
+        str: Path to the features
+    """
+
+    features = backbone(model).to(device).eval()
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    num_features = last_layer(model).in_features
+
+    makedirs(path, exist_ok=True)
+    store = np.lib.format.open_memmap(join(path, "features.npy"), mode="w+", dtype=np.float32,
+                                      shape=(views, len(dataset), num_features))
+    labels = np.empty(len(dataset), dtype=np.int64)
+
+    with torch.no_grad():
+        for view in range(views):
+            start = 0
+            for X, y in loader:
+                X = X.to(device)
+                if batch_transform is not None:
+                    X = batch_transform(X)
+
+                store[view, start:start + len(y)] = features(X).cpu().numpy()
+                labels[start:start + len(y)] = y.numpy()
+                start += len(y)
+
+            print(f"Features: view {view + 1}/{views} done.")
+
+    store.flush()
+    del store
+
+    np.save(join(path, "labels.npy"), labels)
+    with open(join(path, "index.json"), "w") as f:
+        json.dump({"size": len(dataset), "views": views, "num_features": num_features, "metadata": metadata}, f)
+
+    return path
+
+
+def has_features(path: str, size: int, views: int = 1, metadata: dict = None) -> bool:
+    """Check that features were extracted for a dataset.
+
+    Args:
+        path (str): Folder of the features
+        size (int): Number of images of the dataset
+        views (int, optional): Number of views. Defaults to 1.
+        metadata (dict, optional): Description of the expected features (see feature_metadata). Defaults to
+            None (not checked).
+
+    Returns:
+        bool: True if the features can be used.
+    """
+
+    if not isfile(join(path, "index.json")):
+        return False
+
+    with open(join(path, "index.json")) as f:
+        index = json.load(f)
+
+    if metadata is not None and index.get("metadata") != metadata:
+        return False
+
+    return index.get("size") == size and index.get("views") == views
+
+
+class FeatureDataset(Dataset):
+    def __init__(self, path: str, random_view: bool = True):
+        """Dataset of the features stored by extract_features.
+
+        Args:
+            path (str): Folder of the features
+            random_view (bool, optional): Return a random view of each image (feature-level
+                augmentation), otherwise always the first view. Defaults to True.
+        """
+
+        self.path = path
+        self.random_view = random_view
+        self.labels = torch.from_numpy(np.load(join(path, "labels.npy")))
+        self._features = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_features"] = None
+        return state
+
+    @property
+    def features(self) -> np.ndarray:
+        if self._features is None:
+            self._features = np.load(join(self.path, "features.npy"), mmap_mode="c")
+        return self._features
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        view = np.random.randint(self.features.shape[0]) if self.random_view else 0
+
+        return torch.from_numpy(self.features[view, index]), self.labels[index]
@@ -1,7 +1,6 @@
 import streamlit as st
-import base64
-from sender import send_image
-import numpy as np
+import time
+from sender import send_image, decode_explanation, submit_explanation, get_explanation
 
 st.set_page_config(
     layout="wide",
@@ -16,7 +15,7 @@ image_pred = None
 should_explain = st.checkbox("Explication", value=False)
 
 type_explain = st.selectbox("Précision de l'explication (une précision importante augmente le temps d'éxecution).",
-                            ["Low", "Medium", "High"],
+                            ["Low", "Medium", "High", "Auto"],
                             index=2)
                             
 skin_diseases = None
@@ -26,13 +25,27 @@ st.write("##")
 
 if st.button("Prédiction") and image is not None:
     with st.spinner('Prédiction en cours...'):
-        img = base64.b64encode(image.read()).decode("utf8")
-        data = send_image(img, "http://127.0.0.1:8089/predict", should_explain, type_explain)
+        image_bytes = image.getvalue()
+        
+        if should_explain:
+            data = submit_explanation(image_bytes, "http://127.0.0.1:8089/explain", type_explain)
+            progress = st.progress(0.0)
+            
+            while data.get("status") in ("queued", "running"):
+                time.sleep(0.5)
+                data = get_explanation("http://127.0.0.1:8089/explain", data["job"])
+                done = data.get("progress", {}).get("done", 0)
+                total = data.get("progress", {}).get("total", 0)
+                progress.progress(done / total if total else 0.0, text=f"Explication en cours ({done}/{total})")
+            
+            progress.empty()
+        else:
+            data = send_image(image_bytes, "http://127.0.0.1:8089/predict", should_explain, type_explain)
         
         if data.get("success", False):
             skin_diseases = data.get("prediction")
             proba_skin_diseases = data.get("probability")
-            image_pred = np.array(data.get("image")) if should_explain else None
+            image_pred = decode_explanation(data, image_bytes) if should_explain else None
         else:
             st.error("Une erreur est survenue lors de la prédiction.")
 
@@ -0,0 +1,93 @@
+from typing import Callable, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torchvision.models import EfficientNet, MobileNetV3, ResNet
+
+try:
+    from .execution import ExecutionMode
+except ImportError:
+    from execution import ExecutionMode
+
+
+def split_model(model: nn.Module) -> Tuple[Callable, Callable]:
+    """Split a model into its convolutional features (up to the last conv block) and its head
+
+    Args:
+        model (nn.Module): Model built by HAM10000_model
+
+    Raises:
+        ValueError: If the architecture is not supported.
+
+    Returns:
+        Tuple[Callable, Callable]: Features (images -> activations of the last conv block), head (activations -> logits)
+    """
+
+    if isinstance(model, ResNet):
+        features = nn.Sequential(model.conv1, model.bn1, model.relu, model.maxpool,
+                                 model.layer1, model.layer2, model.layer3, model.layer4)
+
+        def head(activations):
+            return model.fc(torch.flatten(model.avgpool(activations), 1))
+
+        return features, head
+
+    if isinstance(model, (MobileNetV3, EfficientNet)):
+        def head(activations):
+            return model.classifier(torch.flatten(model.avgpool(activations), 1))
+
+        return model.features, head
+
+    raise ValueError(f"Grad-CAM is not available for {type(model).__name__}")
+
+
+class GradCAM:
+    def __init__(self, model: nn.Module, execution: ExecutionMode = None):
+        """Grad-CAM on the last convolutional block: one forward and one backward pass (through
+        the head only) per batch
+
+        Args:
+            model (nn.Module): Model built by HAM10000_model (eager PyTorch, not quantized)
+            execution (ExecutionMode, optional): Precision and memory format of the model. Defaults to fp32.
+        """
+
+        self.model = model
+        self.execution = execution or ExecutionMode()
+        self.features, self.head = split_model(model)
+
+    def __call__(self, batch: torch.Tensor, labels: torch.Tensor = None) -> Tuple[torch.Tensor, np.ndarray]:
+        """Class activation maps of a batch
+
+        Args:
+            batch (torch.Tensor): Batch of images (N x C x H x W)
+            labels (torch.Tensor, optional): Class explained for each image. Defaults to the predicted classes.
+
+        Returns:
+            Tuple[torch.Tensor, np.ndarray]: Maps (N x H x W, values in [0, 1]), probabilities (N x number of lesions)
+        """
+
+        # Only the head is differentiated: the backbone runs without building a graph
+        with torch.no_grad(), self.execution.autocast():
+            activations = self.features(self.execution.prepare_input(batch))
+        activations = activations.float().requires_grad_()
+
+        with torch.enable_grad():
+            logits = self.head(activations).float()
+
+            if labels is None:
+                labels = logits.argmax(1)
+            scores = logits.gather(1, labels[:, None]).sum()
+            # The images of the batch are independent (eval mode): the gradient of the sum gives each image its own gradient
+            grads, = torch.autograd.grad(scores, activations)
+
+        with torch.no_grad():
+            weights = grads.mean((2, 3), keepdim=True)
+            cams = F.relu((weights * activations).sum(1, keepdim=True))
+            cams = F.interpolate(cams, size=batch.shape[-2:], mode="bilinear", align_corners=False)[:, 0]
+            cams = cams / cams.amax((1, 2), keepdim=True).clamp_min(1e-8)
+
+            probs = F.softmax(logits.detach(), dim=1)
+
+        return cams, probs.numpy()
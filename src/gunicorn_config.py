@@ -0,0 +1,53 @@
+"""Gunicorn settings of the pre-fork server (see serve.py)
+
+The model is loaded once by the master (preload_app) and the workers are forked from it,
+so the weights are shared copy-on-write. Each worker gets a fixed torch thread budget so that
+WORKERS x TORCH_THREADS matches the cores of the host. ONNX Runtime is not fork-safe: with
+BACKEND=onnx, each worker loads the model after the fork, with TORCH_THREADS threads.
+"""
+import os
+import tempfile
+
+import torch
+
+CORES = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", 0)) or None
+WORKERS = int(os.environ.get("WORKERS", 0)) or max(CORES // (TORCH_THREADS or 2), 1)
+TORCH_THREADS = TORCH_THREADS or max(CORES // WORKERS, 1)
+
+bind = os.environ.get("BIND", "0.0.0.0:8089")
+workers = WORKERS
+# Concurrent requests of a worker are grouped by its MicroBatcher
+worker_class = "gthread"
+threads = int(os.environ.get("HTTP_THREADS", 4))
+preload_app = True
+timeout = int(os.environ.get("WORKER_TIMEOUT", 120))
+graceful_timeout = int(os.environ.get("WORKER_TIMEOUT", 120))
+
+os.environ["PREFORK"] = "1"
+# The ONNX Runtime threads of a worker follow the same budget as the torch threads
+os.environ.setdefault("BACKEND_THREADS", str(TORCH_THREADS))
+
+# The explanation jobs are followed through files, a request can reach any worker
+if WORKERS > 1:
+    os.environ.setdefault("JOB_DIR", os.path.join(tempfile.gettempdir(), "mlbio-jobs"))
+
+# The master only loads the model and runs the warm-up: with a single thread, no OpenMP thread
+# pool is started before the fork (it would not survive it).
+torch.set_num_threads(1)
+torch.set_num_interop_threads(1)
+
+
+def post_fork(server, worker):
+    torch.set_num_threads(TORCH_THREADS)
+    server.log.info("Worker %s: %d torch threads", worker.pid, TORCH_THREADS)
+
+    if os.environ.get("BACKEND") == "onnx":
+        # The app module was imported by the master (preload_app), without loading the model
+        from server import registry
+
+        registry.warmup()
+
+
+def when_ready(server):
+    server.log.info("%d workers x %d torch threads (%d cores)", WORKERS, TORCH_THREADS, CORES)
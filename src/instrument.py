@@ -0,0 +1,176 @@
+import csv
+import json
+import resource
+import time
+
+import torch
+
+FIELDS = ["phase", "epoch", "step", "images", "data", "copy", "augment", "forward", "backward", "optimizer",
+          "total", "images_per_s", "peak_memory_mb"]
+
+
+def peak_memory_mb(device: str) -> float:
+    """Peak memory used by the process (CPU) or allocated by PyTorch (CUDA) since the start of the step
+
+    Args:
+        device (str): Device of the model
+
+    Returns:
+        float: Peak memory in MB
+    """
+
+    if torch.device(device).type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+
+    # ru_maxrss is in KB on Linux, and cannot be reset: peak of the whole process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_memory(device: str) -> None:
+    """Start measuring the peak memory of a new step (CUDA only)"""
+
+    if torch.device(device).type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+class StepTimer:
+    def __init__(self, instrumentation: "Instrumentation", phase: str):
+        """Time the phases of the steps of an epoch
+
+        Args:
+            instrumentation (Instrumentation): Where the steps are recorded
+            phase (str): "train" or "eval"
+        """
+
+        self.instrumentation = instrumentation
+        self.phase = phase
+        self.step = 0
+        self.times = {}
+        reset_peak_memory(instrumentation.device)
+        self.start = self.last = time.perf_counter()
+
+    def mark(self, name: str) -> None:
+        """End a phase of the step ("data", "copy", "augment", "forward", "backward" or "optimizer")
+
+        Args:
+            name (str): Name of the phase
+        """
+
+        self.instrumentation.synchronize()
+        now = time.perf_counter()
+        self.times[name] = now - self.last
+        self.last = now
+
+    def end(self, images: int) -> None:
+        """End the step and record it
+
+        Args:
+            images (int): Number of images of the step
+        """
+
+        total = time.perf_counter() - self.start
+        self.instrumentation.record({
+            "phase": self.phase,
+            "epoch": self.instrumentation.epoch,
+            "step": self.step,
+            "images": images,
+            **self.times,
+            "total": total,
+            "images_per_s": images / total if total > 0 else 0.0,
+            "peak_memory_mb": peak_memory_mb(self.instrumentation.device),
+        })
+
+        self.step += 1
+        self.times = {}
+        reset_peak_memory(self.instrumentation.device)
+        self.start = self.last = time.perf_counter()
+
+
+class NullTimer:
+    """Timer doing nothing, used when the instrumentation is disabled."""
+
+    def mark(self, name: str) -> None:
+        pass
+
+    def end(self, images: int) -> None:
+        pass
+
+
+class NullInstrumentation:
+    """Instrumentation doing nothing."""
+
+    epoch = 0
+
+    def timer(self, phase: str) -> NullTimer:
+        return NullTimer()
+
+    def close(self) -> None:
+        pass
+
+
+class Instrumentation:
+    def __init__(self, path: str, device: str = "cpu", profile_start: int = None,
+                 profile_steps: int = 10, trace_path: str = "trace.json"):
+        """Record the timings of each training and evaluation step
+
+        Args:
+            path (str): File of the records, CSV if it ends with .csv, JSON lines otherwise
+            device (str, optional): Device of the model. Defaults to "cpu".
+            profile_start (int, optional): Training step from which torch.profiler records
+                profile_steps steps. Defaults to None (no profiling).
+            profile_steps (int, optional): Number of profiled steps. Defaults to 10.
+            trace_path (str, optional): Chrome trace of the profiled steps. Defaults to "trace.json".
+        """
+
+        self.device = device
+        self.epoch = 0
+        self.csv = path.endswith(".csv")
+
+        self._file = open(path, "w", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=FIELDS) if self.csv else None
+        if self._writer is not None:
+            self._writer.writeheader()
+
+        self.profiler = None
+        if profile_start is not None:
+            self.profiler = torch.profiler.profile(
+                schedule=torch.profiler.schedule(wait=max(profile_start - 1, 0), warmup=min(profile_start, 1),
+                                                 active=profile_steps, repeat=1),
+                on_trace_ready=lambda p: p.export_chrome_trace(trace_path),
+                record_shapes=True,
+                profile_memory=True)
+            self.profiler.start()
+
+    def synchronize(self) -> None:
+        if torch.device(self.device).type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def timer(self, phase: str) -> StepTimer:
+        """Timer of the steps of an epoch
+
+        Args:
+            phase (str): "train" or "eval"
+
+        Returns:
+            StepTimer: The timer
+        """
+
+        return StepTimer(self, phase)
+
+    def record(self, row: dict) -> None:
+        if self._writer is not None:
+            self._writer.writerow(row)
+        else:
+            self._file.write(json.dumps(row) + "\n")
+
+        if self.profiler is not None and row["phase"] == "train":
+            self.profiler.step()
+
+    def close(self) -> None:
+        """Stop the profiler and close the records."""
+
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+        self._file.close()
@@ -0,0 +1,265 @@
+import json
+import os
+import threading
+import time
+import uuid
+from queue import Full, Queue
+from typing import Callable, Optional
+
+
+class QueueFullError(Exception):
+    """Raised when too many jobs are waiting."""
+
+
+PROGRESS_INTERVAL = 0.5
+
+
+class Job:
+    def __init__(self, fn: Callable[["Job"], dict], on_update: Callable[["Job"], None] = None):
+        """Background job
+
+        Args:
+            fn (Callable[[Job], dict]): Function run by a worker, it receives the job (to report
+                its progress) and returns the result.
+            on_update (Callable[[Job], None], optional): Called when the progress of the job changes.
+                Defaults to None.
+        """
+
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.status = "queued"
+        self.done = 0
+        self.total = 0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.on_update = on_update
+        self.stored = 0.0
+
+    def progress(self, done: int, total: int) -> None:
+        """Report the progress of the job
+
+        Args:
+            done (int): Number of samples evaluated
+            total (int): Total number of samples
+        """
+
+        self.done = done
+        self.total = total
+
+        if self.on_update is not None:
+            self.on_update(self)
+
+    def to_dict(self) -> dict:
+        """Status of the job
+
+        Returns:
+            dict: Status, progress and, once finished, result or error of the job.
+        """
+
+        state = {
+            "job": self.id,
+            "status": self.status,
+            "progress": {"done": self.done, "total": self.total},
+        }
+
+        if self.status == "done":
+            state.update(self.result)
+        elif self.status == "failed":
+            state["error"] = self.error
+
+        return state
+
+    @classmethod
+    def from_dict(cls, state: dict) -> "Job":
+        """Rebuild a job from its status (see to_dict), e.g. a job run by another process
+
+        Args:
+            state (dict): Status of the job
+
+        Returns:
+            Job: The job, which cannot be run
+        """
+
+        job = cls(None)
+        job.id = state["job"]
+        job.status = state["status"]
+        job.done = state["progress"]["done"]
+        job.total = state["progress"]["total"]
+        job.error = state.get("error")
+        job.result = {k: v for k, v in state.items() if k not in ("job", "status", "progress", "error")}
+
+        return job
+
+
+class JobQueue:
+    def __init__(self, workers: int = 1, max_queued: int = 8, ttl: float = 600, store_dir: Optional[str] = None):
+        """Bounded queue of jobs processed by a pool of worker threads
+
+        Args:
+            workers (int, optional): Number of worker threads. Defaults to 1.
+            max_queued (int, optional): Maximum number of jobs waiting for a worker. Defaults to 8.
+            ttl (float, optional): Time (in seconds) a finished job is kept. Defaults to 600.
+            store_dir (Optional[str], optional): Directory where the status of the jobs is also written,
+                so that the jobs can be followed from other processes sharing this directory. Defaults to None.
+        """
+
+        self.workers = workers
+        self.ttl = ttl
+        self.store_dir = store_dir
+        if store_dir is not None:
+            os.makedirs(store_dir, exist_ok=True)
+
+        self._queue = Queue(maxsize=max_queued)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _ensure_workers(self) -> None:
+        """Start the worker threads on first use."""
+
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, fn: Callable[[Job], dict]) -> Job:
+        """Add a job to the queue
+
+        Args:
+            fn (Callable[[Job], dict]): Function of the job (see Job)
+
+        Raises:
+            QueueFullError: If max_queued jobs are already waiting.
+
+        Returns:
+            Job: The job
+        """
+
+        self._ensure_workers()
+        self._purge()
+
+        job = Job(fn, self._on_progress if self.store_dir is not None else None)
+        with self._lock:
+            self._jobs[job.id] = job
+
+        try:
+            self._queue.put_nowait(job)
+        except Full:
+            with self._lock:
+                del self._jobs[job.id]
+            raise QueueFullError(f"Too many jobs in the queue (maximum: {self._queue.maxsize})")
+
+        self._store(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Get a job
+
+        Args:
+            job_id (str): Id of the job
+
+        Returns:
+            Optional[Job]: The job, None if it does not exist or has expired.
+        """
+
+        self._purge()
+        with self._lock:
+            job = self._jobs.get(job_id)
+
+        if job is None and self.store_dir is not None:
+            job = self._load(job_id)
+
+        return job
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.store_dir, job_id + ".json")
+
+    def _store(self, job: Job) -> None:
+        if self.store_dir is None:
+            return
+
+        job.stored = time.monotonic()
+        path = self._path(job.id)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        try:
+            with open(tmp, "w") as f:
+                json.dump(job.to_dict(), f)
+            os.replace(tmp, path)
+        except (OSError, TypeError, ValueError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _on_progress(self, job: Job) -> None:
+        if time.monotonic() - job.stored >= PROGRESS_INTERVAL:
+            self._store(job)
+
+    def _load(self, job_id: str) -> Optional[Job]:
+        if not job_id.isalnum():
+            return None
+
+        try:
+            with open(self._path(job_id)) as f:
+                return Job.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _purge(self) -> None:
+        now = time.time()
+        with self._lock:
+            expired = [k for k, job in self._jobs.items()
+                       if job.finished is not None and now - job.finished > self.ttl]
+            for k in expired:
+                del self._jobs[k]
+
+        if self.store_dir is None:
+            return
+
+        # Also remove the jobs left by processes that have stopped
+        with self._lock:
+            owned = set(self._jobs)
+
+        for name in os.listdir(self.store_dir):
+            path = os.path.join(self.store_dir, name)
+            job_id = name.split(".")[0]
+            try:
+                if job_id in expired or (job_id not in owned and now - os.path.getmtime(path) > self.ttl):
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            job.status = "running"
+            self._store(job)
+
+            try:
+                job.result = job.fn(job)
+                job.status = "done"
+            except Exception as e:
+                job.error = str(e)
+                job.status = "failed"
+
+            job.finished = time.time()
+            self._store(job)
+
+    def stats(self) -> dict:
+        """Counters of the queue
+
+        Returns:
+            dict: Number of workers, of queued, running and finished jobs.
+        """
+
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+
+        return {
+            "workers": self.workers,
+            "max_queued": self._queue.maxsize,
+            **{status: statuses.count(status) for status in ("queued", "running", "done", "failed")},
+        }
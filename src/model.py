@@ -1,28 +1,126 @@
+import os
+
+import torch
 import torchvision.models as models
 from torch import nn
 
-def HAM10000_model(output_dim: int, fine_tune=False, model_type='resnet18') -> nn.Module:
+# Builder and ImageNet weights of each type of model
+MODEL_TYPES = {
+    'resnet18': (models.resnet18, models.ResNet18_Weights),
+    'resnet34': (models.resnet34, models.ResNet34_Weights),
+    'mobilenet_v3_small': (models.mobilenet_v3_small, models.MobileNet_V3_Small_Weights),
+    'mobilenet_v3_large': (models.mobilenet_v3_large, models.MobileNet_V3_Large_Weights),
+    'efficientnet_b0': (models.efficientnet_b0, models.EfficientNet_B0_Weights),
+}
+
+
+def last_layer(model: nn.Module) -> nn.Linear:
+    """Return the last layer (classifier) of a model built by HAM10000_model.
+
+    Args:
+        model (nn.Module): Model for the HAM10000 dataset.
+
+    Returns:
+        nn.Linear: The last layer of the model.
+    """
+
+    if isinstance(model, models.ResNet):
+        return model.fc
+
+    return model.classifier[-1]
+
+
+def set_last_layer(model: nn.Module, layer: nn.Module) -> None:
+    """Replace the last layer (classifier) of a model built by HAM10000_model.
+
+    Args:
+        model (nn.Module): Model for the HAM10000 dataset (modified in place).
+        layer (nn.Module): New last layer.
+    """
+
+    if isinstance(model, models.ResNet):
+        model.fc = layer
+    else:
+        model.classifier[-1] = layer
+
+
+def HAM10000_model(output_dim: int, fine_tune=False, model_type='resnet18',
+                   pretrained: bool = True) -> nn.Module:
     """Return a model for the HAM10000 dataset.
 
     Args:
         output_dim (int): Dimension of the output.
         fine_tune (bool, optional): If True, fine tune the model (train the last layer). Defaults to False.
-        model_type (str, optional): Model to use ('resnet18' or 'resnet34'). Defaults to 'resnet18'.
+        model_type (str, optional): Model to use (one of MODEL_TYPES: 'resnet18', 'resnet34', 'mobilenet_v3_small',
+            'mobilenet_v3_large' or 'efficientnet_b0'). Defaults to 'resnet18'.
+        pretrained (bool, optional): Start from the ImageNet weights (downloaded if needed). Defaults to True.
+
+    Raises:
+        ValueError: If the type of model is unknown.
 
     Returns:
         nn.Module: Model for the HAM10000 dataset.
     """
     
-    if model_type == 'resnet18':
-        model = models.resnet18(weights=models.ResNet18_Weights.DEFAULT)
-    else:
-        model = models.resnet34(weights=models.ResNet34_Weights.DEFAULT)
+    if model_type not in MODEL_TYPES:
+        raise ValueError(f"Invalid model type: {model_type} (types: {', '.join(MODEL_TYPES)})")
+
+    build, weights = MODEL_TYPES[model_type]
+    model = build(weights=weights.DEFAULT if pretrained else None)
     
     if fine_tune:
         for param in model.parameters():
             param.requiresGrad = True
     
-    num_ftrs = model.fc.in_features
-    model.fc = nn.Linear(num_ftrs, output_dim)
+    num_ftrs = last_layer(model).in_features
+    set_last_layer(model, nn.Linear(num_ftrs, output_dim))
     
-    return model
\ No newline at end of file
+    return model
+
+
+def save_checkpoint(state_dict: dict, path: str) -> None:
+    """Save a state dict next to path, then rename it over path.
+
+    A served checkpoint is memory-mapped (see load_model): writing it in place would change
+    the weights under the requests in progress, while the renamed file leaves the old one intact.
+
+    Args:
+        state_dict (dict): State dict of the model.
+        path (str): Path to the checkpoint.
+    """
+
+    tmp = f"{path}.tmp{os.getpid()}"
+    try:
+        torch.save(state_dict, tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load_model(path: str, output_dim: int, model_type: str = 'resnet18') -> nn.Module:
+    """Build a model for inference from a checkpoint, without the ImageNet weights.
+
+    The checkpoint is memory-mapped and its tensors are used directly as the parameters
+    of the model, so nothing is downloaded and the weights are not copied.
+
+    Args:
+        path (str): Path to the checkpoint (state dict saved by Trainer).
+        output_dim (int): Dimension of the output.
+        model_type (str, optional): Model to use (see HAM10000_model). Defaults to 'resnet18'.
+
+    Returns:
+        nn.Module: Model for the HAM10000 dataset, in eval mode.
+    """
+
+    model = HAM10000_model(output_dim, model_type=model_type, pretrained=False)
+
+    try:
+        state_dict = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    except RuntimeError:
+        # Checkpoints saved without the zip format cannot be memory-mapped
+        state_dict = torch.load(path, map_location='cpu', weights_only=True)
+
+    model.load_state_dict(state_dict, assign=True)
+
+    return model.eval()
@@ -0,0 +1,112 @@
+import base64
+import io
+import zlib
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+FORMATS = ("json", "png", "webp", "raw", "segments")
+
+ACCEPT_FORMATS = {
+    "image/png": "png",
+    "image/webp": "webp",
+    "application/octet-stream": "raw",
+    "application/x-segments": "segments",
+}
+
+
+def negotiate_format(requested: Optional[str], accept: Optional[str]) -> str:
+    """Choose the encoding of the explanation
+
+    Args:
+        requested (Optional[str]): Format given in the request ("format" field), takes precedence
+        accept (Optional[str]): Accept header of the request
+
+    Raises:
+        ValueError: If the requested format is unknown.
+
+    Returns:
+        str: One of FORMATS, "json" if nothing matches.
+    """
+
+    if requested is not None:
+        if requested not in FORMATS:
+            raise ValueError(f"Invalid format: Should be one of {', '.join(FORMATS)}")
+        return requested
+
+    for mime in (accept or "").split(","):
+        fmt = ACCEPT_FORMATS.get(mime.split(";")[0].strip())
+        if fmt is not None:
+            return fmt
+
+    return "json"
+
+
+def to_uint8(overlay: np.ndarray) -> np.ndarray:
+    """Convert an overlay with values in [0, 1] to uint8
+
+    Args:
+        overlay (np.ndarray): Overlay returned by ExplainResults
+
+    Returns:
+        np.ndarray: The overlay with values in [0, 255]
+    """
+
+    return np.clip(np.rint(overlay * 255), 0, 255).astype(np.uint8)
+
+
+def b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("utf8")
+
+
+def encode_explanation(explanation: Optional[dict], fmt: str) -> dict:
+    """Encode an explanation for a JSON response
+
+    Args:
+        explanation (Optional[dict]): Explanation (see ExplainResults.explanation), None if there is no explanation
+        fmt (str): One of FORMATS
+
+    Returns:
+        dict: Fields to add to the response ("image" and, for the binary formats, "image_format" and metadata).
+            Adaptive explanations also report "samples" and "convergence".
+    """
+
+    if explanation is None:
+        return {"image": None}
+
+    sampling = {}
+    if "samples" in explanation:
+        sampling = {
+            "samples": int(explanation["samples"]),
+            "convergence": str(explanation["convergence"]),
+        }
+
+    overlay = explanation["overlay"]
+
+    if fmt == "json":
+        return {"image": overlay.tolist(), **sampling}
+
+    if fmt in ("png", "webp"):
+        buffer = io.BytesIO()
+        Image.fromarray(to_uint8(overlay)).save(buffer, format=fmt.upper(), lossless=True)
+        return {"image": b64(buffer.getvalue()), "image_format": fmt, **sampling}
+
+    if fmt == "raw":
+        return {
+            "image": b64(to_uint8(overlay).tobytes()),
+            "image_format": "raw",
+            "shape": list(overlay.shape),
+            "dtype": "uint8",
+            **sampling,
+        }
+
+    segments = explanation["segments"].astype(np.uint16)
+    return {
+        "image": b64(zlib.compress(segments.tobytes())),
+        "image_format": "segments",
+        "shape": list(segments.shape),
+        "dtype": "uint16",
+        "weights": [[int(s), float(w)] for s, w in explanation["weights"]],
+        **sampling,
+    }
@@ -0,0 +1,146 @@
+import threading
+from typing import Tuple, Union
+
+import numpy as np
+import torch
+from PIL import Image, ImageOps
+
+
+def to_rgb(image: Image.Image) -> Image.Image:
+    """Convert an image of any mode to RGB (16-bit and float images are scaled to 8 bits)
+
+    Args:
+        image (Image.Image): Image to convert
+
+    Returns:
+        Image.Image: The RGB image
+    """
+
+    if image.mode == "RGB":
+        return image
+
+    if image.mode.startswith("I;16"):
+        image = Image.fromarray((np.asarray(image).astype(np.uint16) >> 8).astype(np.uint8))
+    elif image.mode in ("I", "F"):
+        image = Image.fromarray(np.clip(np.asarray(image), 0, 255).astype(np.uint8))
+
+    return image.convert("RGB")
+
+
+class Preprocessor:
+    def __init__(self, size: Tuple[int, int] = (450, 600), resample: int = Image.BILINEAR, draft: bool = True):
+        """Serving preprocessing, fused into one resize in uint8 and one conversion to float.
+
+        JPEG images are decoded at reduced resolution (the smallest DCT scale still larger
+        than the target size), turned upright according to their EXIF orientation, converted
+        to RGB and resized in uint8. Batches are written into a buffer reused between calls.
+
+        Args:
+            size (Tuple[int, int], optional): Size (height, width) of the images given to the model. Defaults to (450, 600).
+            resample (int, optional): Resampling filter of the resize. Defaults to Image.BILINEAR.
+            draft (bool, optional): Decode the JPEG images at reduced resolution. Defaults to True.
+        """
+
+        self.size = size
+        self.resample = resample
+        self.draft = draft
+        self._local = threading.local()
+
+    def open(self, fp) -> Image.Image:
+        """Decode an encoded image at reduced resolution, upright and in RGB
+
+        Args:
+            fp: File-like object (or path) of the encoded image
+
+        Returns:
+            Image.Image: The decoded image, at least as large as size (when the original is)
+        """
+
+        image = Image.open(fp)
+        if self.draft and image.format == "JPEG":
+            # The orientation is not known before the EXIF transposition: both sides should be large enough
+            side = max(self.size)
+            image.draft("RGB", (side, side))
+
+        return to_rgb(ImageOps.exif_transpose(image))
+
+    def resize(self, image: Image.Image) -> Image.Image:
+        """Resize an image to size, in uint8
+
+        Args:
+            image (Image.Image): Image to resize
+
+        Returns:
+            Image.Image: The RGB image, with the size of the model input
+        """
+
+        image = to_rgb(image)
+        height, width = self.size
+        if image.size != (width, height):
+            image = image.resize((width, height), self.resample, reducing_gap=3.0)
+
+        return image
+
+    def load(self, fp) -> Image.Image:
+        """Decode an encoded image directly at the size of the model input
+
+        Args:
+            fp: File-like object (or path) of the encoded image
+
+        Returns:
+            Image.Image: The RGB image, with the size of the model input
+        """
+
+        return self.resize(self.open(fp))
+
+    def image(self, image: Union[Image.Image, np.ndarray]) -> np.ndarray:
+        """Image as a uint8 array of the size of the model input
+
+        Args:
+            image (Union[Image.Image, np.ndarray]): PIL image or array (H x W x 3)
+
+        Returns:
+            np.ndarray: The image (H x W x 3, uint8)
+        """
+
+        if isinstance(image, np.ndarray):
+            if image.shape[:2] == tuple(self.size) and image.dtype == np.uint8 and image.ndim == 3:
+                return image
+            image = Image.fromarray(image.astype(np.uint8))
+
+        return np.array(self.resize(image))
+
+    def __call__(self, image: Union[Image.Image, np.ndarray]) -> torch.Tensor:
+        """Convert an image into a tensor (same output as ToTensor then Resize)
+
+        Args:
+            image (Union[Image.Image, np.ndarray]): PIL image or array (H x W x 3)
+
+        Returns:
+            torch.Tensor: The image (3 x H x W), values in [0, 1]
+        """
+
+        return torch.from_numpy(self.image(image)).permute(2, 0, 1).float().div_(255)
+
+    def batch(self, images: list) -> torch.Tensor:
+        """Convert images into a batch. The batch is a view of a buffer of the calling thread,
+        overwritten by its next call.
+
+        Args:
+            images (list): PIL images or arrays (H x W x 3)
+
+        Returns:
+            torch.Tensor: The batch (N x 3 x H x W), values in [0, 1]
+        """
+
+        height, width = self.size
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None or buffer.shape[0] < len(images):
+            buffer = torch.empty((len(images), 3, height, width))
+            self._local.buffer = buffer
+
+        batch = buffer[:len(images)]
+        for i, image in enumerate(images):
+            batch[i].copy_(torch.from_numpy(self.image(image)).permute(2, 0, 1))
+
+        return batch.div_(255)
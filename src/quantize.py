@@ -0,0 +1,99 @@
+import copy
+from typing import Iterable
+
+import torch
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+# Types of model whose static quantization has been checked. MobileNetV3 (hardswish,
+# squeeze-and-excitation) and EfficientNet (SiLU) are only quantized dynamically.
+STATIC_TYPES = ("resnet18", "resnet34")
+
+
+def quantized_engine() -> str:
+    """Choose the quantized engine of the host (x86, fbgemm or qnnpack)
+
+    Returns:
+        str: Name of the engine, also set as torch.backends.quantized.engine
+    """
+
+    supported = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in supported:
+            torch.backends.quantized.engine = engine
+            return engine
+
+    raise RuntimeError("No quantized engine available")
+
+
+def quantize_static(model: nn.Module, calibration: Iterable, num_batches: int = 10) -> nn.Module:
+    """Post-training static quantization (weights and activations in int8)
+
+    Args:
+        model (nn.Module): Trained fp32 model
+        calibration (Iterable): Batches (X, y) used to calibrate the activation ranges (e.g. a DataLoader)
+        num_batches (int, optional): Number of calibration batches. Defaults to 10.
+
+    Returns:
+        nn.Module: The int8 model
+    """
+
+    engine = quantized_engine()
+    model = copy.deepcopy(model).cpu().eval()
+
+    batches = iter(calibration)
+    X, _ = next(batches)
+
+    prepared = prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs=(X,))
+    with torch.inference_mode():
+        prepared(X)
+        for _, (X, _) in zip(range(num_batches - 1), batches):
+            prepared(X)
+
+    return convert_fx(prepared)
+
+
+def quantize_dynamic(model: nn.Module) -> nn.Module:
+    """Post-training dynamic quantization (int8 weights of the linear layers)
+
+    Args:
+        model (nn.Module): Trained fp32 model
+
+    Returns:
+        nn.Module: The quantized model
+    """
+
+    quantized_engine()
+    model = copy.deepcopy(model).cpu().eval()
+
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def save_quantized(model: nn.Module, path: str, example: torch.Tensor) -> None:
+    """Save a quantized model as TorchScript
+
+    Args:
+        model (nn.Module): Quantized model
+        path (str): Path of the TorchScript file
+        example (torch.Tensor): Example of input, used to trace the model
+    """
+
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+
+    torch.jit.save(traced, path)
+
+
+def load_quantized(path: str) -> nn.Module:
+    """Load a quantized model saved by save_quantized
+
+    Args:
+        path (str): Path of the TorchScript file
+
+    Returns:
+        nn.Module: The quantized model
+    """
+
+    quantized_engine()
+    return torch.jit.load(path, map_location="cpu").eval()
@@ -0,0 +1,298 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+try:
+    from .batching import MicroBatcher
+    from .cache import checkpoint_digest
+except ImportError:
+    from batching import MicroBatcher
+    from cache import checkpoint_digest
+
+
+class ModelEntry:
+    def __init__(self, name: str, path: str, explain_model, batcher: MicroBatcher,
+                 gradcam_batcher: MicroBatcher):
+        """A loaded version of a model
+
+        Args:
+            name (str): Name of the model
+            path (str): Path to the checkpoint
+            explain_model (ExplainResults): Model used to predict and explain
+            batcher (MicroBatcher): Batcher of the predictions of this version
+            gradcam_batcher (MicroBatcher): Batcher of the Grad-CAM explanations of this version
+        """
+
+        stat = os.stat(path)
+        self.name = name
+        self.path = path
+        self.version = checkpoint_digest(path)
+        self.explain_model = explain_model
+        self.batcher = batcher
+        self.gradcam_batcher = gradcam_batcher
+
+        self.signature = (stat.st_mtime_ns, stat.st_size)
+        self.pending = None
+        self.loaded = time.time()
+        self.last_used = time.monotonic()
+        self.checked = time.monotonic()
+        self.in_flight = 0
+        self.retired = False
+
+    @property
+    def tag(self) -> str:
+        """Name and version of the model, used in the keys of the cache"""
+
+        return f"{self.name}@{self.version[:16]}"
+
+    def close(self) -> None:
+        """Stop the batchers of this version"""
+
+        self.batcher.close()
+        self.gradcam_batcher.close()
+
+
+class ModelRegistry:
+    def __init__(self, load_fn: Callable[[str, str], object], paths: Dict[str, str], default: str,
+                 max_batch_size: int = 16, max_wait_ms: float = 5.0, max_loaded: int = None,
+                 idle_ttl: float = 0, check_interval: float = 2.0,
+                 on_reload: Callable[[ModelEntry], None] = None):
+        """Serve several models, loaded on demand, reloaded when their checkpoint changes
+        and unloaded when they are idle
+
+        Args:
+            load_fn (Callable[[str, str], object]): Function taking the name of a model and the path
+                to its checkpoint and returning an ExplainResults
+            paths (Dict[str, str]): Path to the checkpoint of each model
+            default (str): Model used when a request does not choose one. It is never unloaded.
+            max_batch_size (int, optional): See MicroBatcher. Defaults to 16.
+            max_wait_ms (float, optional): See MicroBatcher. Defaults to 5.0.
+            max_loaded (int, optional): Maximum number of models in memory. Defaults to all the models.
+            idle_ttl (float, optional): Time (in seconds) after which an unused model is unloaded, also
+                when no request comes (checked by a thread started on the first request). Defaults to 0 (never).
+            check_interval (float, optional): Minimum time (in seconds) between two checks of a checkpoint.
+                Defaults to 2.0.
+            on_reload (Callable[[ModelEntry], None], optional): Called with the previous version of a
+                model after it has been replaced. Defaults to None.
+        """
+
+        if default not in paths:
+            raise ValueError(f"Unknown default model: {default}")
+
+        self.load_fn = load_fn
+        self.paths = dict(paths)
+        self.default = default
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_loaded = max(max_loaded or len(paths), 1)
+        self.idle_ttl = idle_ttl
+        self.check_interval = check_interval
+        self.on_reload = on_reload
+
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+        self._load_locks = {name: threading.Lock() for name in paths}
+
+        self.loads = 0
+        self.reloads = 0
+        self.unloads = 0
+        self.errors = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.paths
+
+    def _load(self, name: str) -> ModelEntry:
+        path = self.paths[name]
+        explain_model = self.load_fn(name, path)
+        batcher = MicroBatcher(explain_model.batch_prediction, self.max_batch_size, self.max_wait_ms)
+        gradcam_batcher = MicroBatcher(explain_model.gradcam_explanations, self.max_batch_size, self.max_wait_ms)
+
+        return ModelEntry(name, path, explain_model, batcher, gradcam_batcher)
+
+    def _changed(self, entry: ModelEntry) -> bool:
+        """Whether the checkpoint of an entry has been replaced. A file still being written
+        (its size or modification time changed since the previous check) is not reloaded yet.
+        """
+
+        try:
+            stat = os.stat(entry.path)
+        except OSError:
+            return False
+
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == entry.signature:
+            return False
+
+        stable = entry.pending == signature
+        entry.pending = signature
+
+        return stable
+
+    def _retire(self, entry: ModelEntry) -> None:
+        """Stop an entry removed from the registry once its last request is done (lock held)."""
+
+        entry.retired = True
+        if entry.in_flight == 0:
+            entry.close()
+
+    def _refresh(self, name: str) -> ModelEntry:
+        """Load a model, or reload it if its checkpoint changed (only one thread per model)."""
+
+        with self._load_locks[name]:
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is not None:
+                    entry.checked = time.monotonic()
+
+            if entry is not None and not self._changed(entry):
+                return entry
+
+            try:
+                new = self._load(name)
+            except Exception as e:
+                self.errors[name] = str(e)
+                if entry is None:
+                    raise
+                return entry
+
+            self.errors.pop(name, None)
+            if entry is not None and new.version == entry.version:
+                entry.signature = new.signature
+                entry.pending = None
+                return entry
+
+            with self._lock:
+                self._entries[name] = new
+                if entry is None:
+                    self.loads += 1
+                else:
+                    self.reloads += 1
+                    self._retire(entry)
+
+        if entry is not None and self.on_reload is not None:
+            self.on_reload(entry)
+
+        return new
+
+    def _ensure_reaper(self) -> None:
+        """Start the thread unloading the idle models on first use (in each process, the thread
+        of a parent does not survive a fork)."""
+
+        if self.idle_ttl <= 0:
+            return
+
+        with self._lock:
+            if self._reaper is None or not self._reaper.is_alive():
+                self._reaper = threading.Thread(target=self._reap, name="model-reaper", daemon=True)
+                self._reaper.start()
+
+    def _reap(self) -> None:
+        while True:
+            time.sleep(max(min(self.idle_ttl / 2, 60), 1))
+            with self._lock:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Unload the idle models (lock held)."""
+
+        now = time.monotonic()
+        idle = sorted((e for e in self._entries.values() if e.in_flight == 0 and e.name != self.default),
+                      key=lambda e: e.last_used)
+
+        for entry in idle:
+            expired = self.idle_ttl > 0 and now - entry.last_used > self.idle_ttl
+            if not expired and len(self._entries) <= self.max_loaded:
+                continue
+
+            del self._entries[entry.name]
+            self._retire(entry)
+            self.unloads += 1
+
+    @contextmanager
+    def use(self, name: Optional[str] = None) -> Iterator[ModelEntry]:
+        """Use a model for the duration of a request. The version given is kept until the
+        end of the request, even if the checkpoint is reloaded in the meantime.
+
+        Args:
+            name (Optional[str], optional): Name of the model. Defaults to the default model.
+
+        Raises:
+            KeyError: If the model is unknown.
+
+        Yields:
+            ModelEntry: The loaded model
+        """
+
+        name = name or self.default
+        if name not in self.paths:
+            raise KeyError(name)
+
+        self._ensure_reaper()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or time.monotonic() - entry.checked >= self.check_interval:
+                entry = None
+            else:
+                entry.in_flight += 1
+
+        if entry is None:
+            while True:
+                candidate = self._refresh(name)
+                with self._lock:
+                    if self._entries.get(name) is candidate:
+                        entry = candidate
+                        entry.in_flight += 1
+                        break
+
+        try:
+            yield entry
+        finally:
+            with self._lock:
+                entry.in_flight -= 1
+                entry.last_used = time.monotonic()
+                if entry.retired and entry.in_flight == 0:
+                    entry.close()
+                self._evict()
+
+    def warmup(self) -> None:
+        """Load the default model. No thread is started: the registry can be forked afterwards
+        (see gunicorn_config.py)."""
+
+        self._refresh(self.default)
+
+    def stats(self) -> dict:
+        """State of the models
+
+        Returns:
+            dict: Loaded models (version, requests in progress, batching counters), loads, reloads,
+                unloads and last loading errors.
+        """
+
+        with self._lock:
+            self._evict()
+            now = time.monotonic()
+            models = {
+                name: {
+                    "version": entry.version[:16],
+                    "loaded": entry.loaded,
+                    "idle_seconds": now - entry.last_used,
+                    "in_flight": entry.in_flight,
+                    "batching": entry.batcher.stats(),
+                    "gradcam_batching": entry.gradcam_batcher.stats(),
+                } for name, entry in self._entries.items()
+            }
+
+            return {
+                "default": self.default,
+                "available": sorted(self.paths),
+                "loaded": models,
+                "max_loaded": self.max_loaded,
+                "idle_ttl": self.idle_ttl,
+                "loads": self.loads,
+                "reloads": self.reloads,
+                "unloads": self.unloads,
+                "errors": dict(self.errors),
+            }
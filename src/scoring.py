@@ -0,0 +1,305 @@
+import csv
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+try:
+    from .preprocess import Preprocessor
+except ImportError:
+    from preprocess import Preprocessor
+
+EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+_preprocess = None
+
+
+def list_files(source: str) -> Iterator[str]:
+    """Images to score, listed lazily and always in the same order
+
+    Args:
+        source (str): Directory (searched recursively for .jpg, .jpeg and .png files) or manifest:
+            CSV file with a "path" column, or text file with one path per line (relative paths
+            are relative to the directory of the manifest)
+
+    Returns:
+        Iterator[str]: Paths of the images
+    """
+
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(EXTENSIONS):
+                    yield os.path.join(root, name)
+        return
+
+    directory = os.path.dirname(source)
+    with open(source, newline="") as f:
+        if source.endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield os.path.join(directory, row["path"])
+        else:
+            for line in f:
+                if line.strip():
+                    yield os.path.join(directory, line.strip())
+
+
+def _init_worker(size: Tuple[int, int]) -> None:
+    global _preprocess
+
+    # The decoding processes only run PIL: one thread each
+    torch.set_num_threads(1)
+    _preprocess = Preprocessor(size)
+
+
+def decode(paths: List[str]) -> List[Tuple[str, Optional[np.ndarray], Optional[str]]]:
+    """Decode images at the size of the model input (run in the decoding processes)
+
+    Args:
+        paths (List[str]): Paths of the images
+
+    Returns:
+        List[Tuple[str, Optional[np.ndarray], Optional[str]]]: (path, image (H x W x 3, uint8) or None, error or None) of each image
+    """
+
+    results = []
+    for path in paths:
+        try:
+            results.append((path, np.asarray(_preprocess.load(path)), None))
+        except Exception as e:
+            results.append((path, None, str(e)))
+
+    return results
+
+
+def decoded(paths: Iterable[str], size: Tuple[int, int], workers: int,
+            chunk_size: int = 8) -> Iterator[Tuple[str, Optional[np.ndarray], Optional[str]]]:
+    """Decode images in a pool of processes, in order, with a bounded number of decoded images in memory
+
+    Args:
+        paths (Iterable[str]): Paths of the images
+        size (Tuple[int, int]): Size (height, width) of the model input
+        workers (int): Number of decoding processes
+        chunk_size (int, optional): Images decoded per task. Defaults to 8.
+
+    Returns:
+        Iterator[Tuple[str, Optional[np.ndarray], Optional[str]]]: (path, image or None, error or None) of each image
+    """
+
+    # Spawned, not forked: the parent may already run OpenMP threads of PyTorch
+    with ProcessPoolExecutor(workers, mp_context=get_context("spawn"),
+                             initializer=_init_worker, initargs=(size,)) as pool:
+        pending = deque()
+        chunk = []
+        for path in paths:
+            chunk.append(path)
+            if len(chunk) < chunk_size:
+                continue
+
+            pending.append(pool.submit(decode, chunk))
+            chunk = []
+            if len(pending) >= 4 * workers:
+                yield from pending.popleft().result()
+
+        if chunk:
+            pending.append(pool.submit(decode, chunk))
+        while pending:
+            yield from pending.popleft().result()
+
+
+class CsvWriter:
+    def __init__(self, path: str, columns: List[str], overwrite: bool = False):
+        """Append the results to a CSV file, flushed after each batch
+
+        Args:
+            path (str): Path of the CSV file
+            columns (List[str]): Columns of the results
+            overwrite (bool, optional): Start a new file instead of resuming. Defaults to False.
+        """
+
+        self.columns = columns
+        resume = not overwrite and os.path.exists(path) and os.path.getsize(path) > 0
+        if resume:
+            self._drop_partial_line(path)
+
+        self.file = open(path, "a" if resume else "w", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=columns)
+        if not resume:
+            self.writer.writeheader()
+            self.file.flush()
+
+        self.path = path
+
+    @staticmethod
+    def _drop_partial_line(path: str) -> None:
+        # A row interrupted while being written is dropped, its image is scored again
+        with open(path, "rb+") as f:
+            data = f.read()
+            if not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def done(self) -> Set[str]:
+        """Paths of the images already in the file"""
+
+        with open(self.path, newline="") as f:
+            return {row["path"] for row in csv.DictReader(f)}
+
+    def write(self, rows: List[dict]) -> None:
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetWriter:
+    def __init__(self, path: str, columns: List[str], overwrite: bool = False, rows_per_part: int = 1024,
+                 flush_seconds: float = 30.0):
+        """Write the results to a directory of Parquet files, each written at once (a Parquet file
+        cannot be appended to, nor read before it is closed). The rows not yet written are lost
+        if the process is killed: they are scored again when resuming.
+
+        Args:
+            path (str): Directory of the Parquet files
+            columns (List[str]): Columns of the results
+            overwrite (bool, optional): Start a new directory instead of resuming. Defaults to False.
+            rows_per_part (int, optional): Maximum number of rows of each file. Defaults to 1024.
+            flush_seconds (float, optional): Maximum time (in seconds) between two files. Defaults to 30.0.
+        """
+
+        import pyarrow  # noqa: F401, fails early if pyarrow is missing
+
+        self.path = path
+        self.columns = columns
+        self.rows_per_part = rows_per_part
+        self.flush_seconds = flush_seconds
+        self.rows = []
+        self.flushed = time.monotonic()
+
+        os.makedirs(path, exist_ok=True)
+        if overwrite:
+            for name in self._parts():
+                os.remove(os.path.join(path, name))
+        self.index = len(self._parts())
+
+    def _parts(self) -> List[str]:
+        return sorted(name for name in os.listdir(self.path) if name.startswith("part-") and name.endswith(".parquet"))
+
+    def done(self) -> Set[str]:
+        """Paths of the images already in the files"""
+
+        import pyarrow.parquet as pq
+
+        paths = set()
+        for name in self._parts():
+            paths.update(pq.read_table(os.path.join(self.path, name), columns=["path"]).column("path").to_pylist())
+
+        return paths
+
+    def write(self, rows: List[dict]) -> None:
+        self.rows.extend(rows)
+        if len(self.rows) >= self.rows_per_part or time.monotonic() - self.flushed >= self.flush_seconds:
+            self._flush()
+
+    def _flush(self) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.flushed = time.monotonic()
+        if not self.rows:
+            return
+
+        # Same types in every file, even when a column only holds nulls
+        types = {"path": pa.string(), "success": pa.bool_(), "prediction": pa.string(), "error": pa.string()}
+        schema = pa.schema([(column, types.get(column, pa.float64())) for column in self.columns])
+
+        table = pa.Table.from_pydict({column: [row.get(column) for row in self.rows] for column in self.columns},
+                                     schema=schema)
+        path = os.path.join(self.path, f"part-{self.index:05d}.parquet")
+        pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+        self.index += 1
+        self.rows = []
+
+    def close(self) -> None:
+        self._flush()
+
+
+def open_writer(output: str, columns: List[str], overwrite: bool = False, rows_per_part: int = 1024,
+                flush_seconds: float = 30.0):
+    """Writer of the results: a directory of Parquet files if output ends with .parquet, a CSV file otherwise
+
+    Args:
+        output (str): Path of the results
+        columns (List[str]): Columns of the results
+        overwrite (bool, optional): Start over instead of resuming. Defaults to False.
+        rows_per_part (int, optional): Maximum number of rows of each Parquet file. Defaults to 1024.
+        flush_seconds (float, optional): Maximum time (in seconds) between two Parquet files. Defaults to 30.0.
+
+    Returns:
+        CsvWriter | ParquetWriter: The writer
+    """
+
+    if output.endswith(".parquet"):
+        return ParquetWriter(output, columns, overwrite, rows_per_part, flush_seconds)
+
+    return CsvWriter(output, columns, overwrite)
+
+
+def score(backend, images: Iterable[Tuple[str, Optional[np.ndarray], Optional[str]]], preprocess: Preprocessor,
+          lesion_type: dict, codes: dict, batch_size: int = 64) -> Iterator[List[dict]]:
+    """Score decoded images with batched forward passes
+
+    Args:
+        backend (Callable[[torch.Tensor], torch.Tensor]): Model returning the logits of a batch (see load_backend)
+        images (Iterable[Tuple[str, Optional[np.ndarray], Optional[str]]]): Decoded images (see decoded)
+        preprocess (Preprocessor): Preprocessing of the model input
+        lesion_type (dict): Name of each class, by index
+        codes (dict): Short name of each class, by index, used in the names of the columns
+        batch_size (int, optional): Images per forward pass. Defaults to 64.
+
+    Returns:
+        Iterator[List[dict]]: Rows of the results of each batch: path, success, prediction,
+            probability, error and the probability of each class (see columns)
+    """
+
+    rows, arrays = [], []
+
+    def run() -> List[dict]:
+        ok = [row for row in rows if row["success"]]
+        if ok:
+            probs = F.softmax(backend(preprocess.batch(arrays)).float(), dim=1).numpy()
+            for row, p in zip(ok, probs):
+                best = int(p.argmax())
+                row.update(prediction=lesion_type[best], probability=float(p[best]))
+                row.update({f"p_{codes[i]}": float(p[i]) for i in range(len(p))})
+
+        return rows
+
+    for path, image, error in images:
+        if image is None:
+            rows.append({"path": path, "success": False, "error": error})
+        else:
+            rows.append({"path": path, "success": True})
+            arrays.append(image)
+
+        if len(arrays) >= batch_size:
+            yield run()
+            rows, arrays = [], []
+
+    if rows:
+        yield run()
+
+
+def columns(codes: dict) -> List[str]:
+    """Columns of the results, the probability of each class being p_{short name of the class}"""
+
+    return ["path", "success", "prediction", "probability", "error"] + [f"p_{codes[i]}" for i in sorted(codes)]
@@ -0,0 +1,177 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+SEGMENTATIONS = ("quickshift", "slic", "felzenszwalb", "grid")
+
+
+def grid(image: np.ndarray, n_segments: int = 100) -> np.ndarray:
+    """Split an image into a grid of about n_segments cells of similar shape
+
+    Args:
+        image (np.ndarray): Image (H x W x C)
+        n_segments (int, optional): Approximate number of cells. Defaults to 100.
+
+    Returns:
+        np.ndarray: Segment map (H x W)
+    """
+
+    height, width = image.shape[:2]
+    rows = max(int(round(np.sqrt(n_segments * height / width))), 1)
+    cols = max(int(round(n_segments / rows)), 1)
+
+    row = np.arange(height) * rows // height
+    col = np.arange(width) * cols // width
+
+    return row[:, None] * cols + col[None, :]
+
+
+def upsample(labels: np.ndarray, shape: tuple) -> np.ndarray:
+    """Resize a segment map with nearest neighbour interpolation
+
+    Args:
+        labels (np.ndarray): Segment map (h x w)
+        shape (tuple): Size (H, W) of the output
+
+    Returns:
+        np.ndarray: The segment map (H x W)
+    """
+
+    row = np.arange(shape[0]) * labels.shape[0] // shape[0]
+    col = np.arange(shape[1]) * labels.shape[1] // shape[1]
+
+    return labels[row[:, None], col[None, :]]
+
+
+class Segmenter:
+    def __init__(self, kind: str = "quickshift", scale: float = 1.0, n_segments: int = 100,
+                 max_bytes: int = 16 * 1024 * 1024, random_seed: int = 0):
+        """Superpixel segmentation of the explained images, with a cache of the segment maps
+
+        Args:
+            kind (str, optional): "quickshift" (LIME default), "slic", "felzenszwalb" or "grid". Defaults to "quickshift".
+            scale (float, optional): The image is segmented at this scale and the segment map is
+                upsampled to the size of the image. Defaults to 1.0.
+            n_segments (int, optional): Approximate number of segments of slic and grid. Defaults to 100.
+            max_bytes (int, optional): Size of the segment maps kept, by hash of the image. Defaults to 16 MB
+                (about 30 maps of 600x450).
+            random_seed (int, optional): Seed of quickshift. Defaults to 0.
+        """
+
+        if kind not in SEGMENTATIONS:
+            raise ValueError(f"Invalid segmentation: {kind} (segmentations: {', '.join(SEGMENTATIONS)})")
+        if not 0 < scale <= 1:
+            raise ValueError("scale should be in (0, 1]")
+
+        self.kind = kind
+        self.scale = scale
+        self.n_segments = n_segments
+        self.max_bytes = max_bytes
+        self.random_seed = random_seed
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def name(self) -> str:
+        """Name of the segmentation and of its settings, e.g. slic@0.5"""
+
+        return self.kind if self.scale == 1 else f"{self.kind}@{self.scale:g}"
+
+    def segment(self, image: np.ndarray) -> np.ndarray:
+        """Segment an image without cache
+
+        Args:
+            image (np.ndarray): Image (H x W x 3)
+
+        Returns:
+            np.ndarray: Segment map (H x W, uint16, or int32 beyond 65536 segments), with labels from 0
+                to the number of segments - 1
+        """
+
+        small = image
+        if self.scale < 1:
+            height, width = image.shape[:2]
+            size = (max(int(width * self.scale), 1), max(int(height * self.scale), 1))
+            small = np.asarray(Image.fromarray(image.astype(np.uint8)).resize(size, Image.BILINEAR))
+
+        if self.kind == "grid":
+            labels = grid(small, self.n_segments)
+        elif self.kind == "slic":
+            from skimage.segmentation import slic
+
+            labels = slic(small, n_segments=self.n_segments, compactness=10, start_label=0)
+        elif self.kind == "felzenszwalb":
+            from skimage.segmentation import felzenszwalb
+
+            # The minimum size of the segments follows the scale of the image
+            labels = felzenszwalb(small, scale=100, sigma=0.5, min_size=max(int(50 * self.scale ** 2), 1))
+        else:
+            from skimage.segmentation import quickshift
+
+            labels = quickshift(small, kernel_size=4 * self.scale, max_dist=200, ratio=0.2,
+                                random_seed=self.random_seed)
+
+        if labels.shape != image.shape[:2]:
+            labels = upsample(labels, image.shape[:2])
+
+        labels = np.unique(labels, return_inverse=True)[1].reshape(labels.shape)
+
+        # 4 times smaller than the int64 labels of np.unique
+        return labels.astype(np.uint16 if labels.max(initial=0) < 2 ** 16 else np.int32)
+
+    def __call__(self, image: np.ndarray) -> np.ndarray:
+        """Segment an image, or return its cached segment map
+
+        Args:
+            image (np.ndarray): Image (H x W x 3)
+
+        Returns:
+            np.ndarray: Segment map (H x W), with labels from 0 to the number of segments - 1
+        """
+
+        image = np.ascontiguousarray(image)
+        h = hashlib.sha256(f"{image.shape}:{image.dtype}".encode("utf8"))
+        h.update(image.data)
+        key = h.hexdigest()
+
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+
+        segments = self.segment(image)
+
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = segments
+                self._bytes += segments.nbytes
+            while self._cache and self._bytes > self.max_bytes:
+                self._bytes -= self._cache.popitem(last=False)[1].nbytes
+
+        return segments
+
+    def stats(self) -> dict:
+        """Counters of the cache of the segment maps
+
+        Returns:
+            dict: Segmentation, number and size of the cached maps, hits and misses
+        """
+
+        with self._lock:
+            return {
+                "segmentation": self.name,
+                "entries": len(self._cache),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -1,26 +1,280 @@
 import requests
 import json
+import base64
+import io
+import zlib
+from typing import Optional
+
+import numpy as np
+from PIL import Image, ImageOps
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
 
+UPLOADS = ("raw", "multipart", "json")
+
+
+def image_mimetype(img: bytes) -> str:
+    """Guess the MIME type of an encoded image
+
+    Args:
+        img (bytes): Encoded image
+
+    Returns:
+        str: MIME type of the image
+    """
+
+    if img.startswith(b"\x89PNG"):
+        return "image/png"
+
+    return "image/jpeg"
+
+
+def make_session(pool_size: int = 4, retries: int = 3) -> requests.Session:
+    """HTTP session keeping its connections alive, to send many requests to the server
 
-def send_image(img: str, url: str, explain: bool, precision: str = "Medium") -> dict:
+    Args:
+        pool_size (int, optional): Number of connections kept open (i.e. of concurrent requests). Defaults to 4.
+        retries (int, optional): Number of retries on connection errors and on busy or unavailable
+            server (429, 502, 503, 504), with exponential backoff. Defaults to 3.
+
+    Returns:
+        requests.Session: The session
+    """
+
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 502, 503, 504),
+                  allowed_methods=None, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+def send_image(img, url: str, explain: bool, precision: str = "Medium",
+               image_format: str = "png", upload: str = "raw", model: Optional[str] = None,
+               session: Optional[requests.Session] = None, method: Optional[str] = None,
+               budget_ms: Optional[float] = None) -> dict:
     """Send an image to the server
 
     Args:
-        img (str): Image encoded in base64
+        img (bytes | str): Encoded image (e.g. content of a JPEG file), or image encoded in base64
         url (str): URL of the server
         explain (bool): Should the server explain the prediction
         precision (str, optional): Precision of the explanation. Defaults to "Medium".
-            Can be "Low", "Medium" or "High".
+            Can be "Low", "Medium", "High" or "Auto" (adaptive sampling).
+        image_format (str, optional): Encoding of the explanation. Defaults to "png".
+            Can be "json", "png", "webp", "raw" or "segments" (see decode_explanation).
+        upload (str, optional): How the image is sent. Defaults to "raw".
+            Can be "raw" (image as request body), "multipart" (multipart/form-data)
+            or "json" (base64 in a JSON body). A base64 image is always sent as "json".
+        model (Optional[str], optional): Model used by the server (e.g. "resnet18"). Defaults to the
+            default model of the server.
+        session (Optional[requests.Session], optional): Session used to send the request (see make_session).
+            Defaults to a new connection.
+        method (Optional[str], optional): Explanation method, "lime" or "gradcam". Defaults to "lime".
+        budget_ms (Optional[float], optional): Time budget of the explanation in milliseconds: the LIME
+            sampling stops early, at the latest after the budget. Defaults to the budget of the server.
 
     Returns:
         dict: Dictionary containing the prediction, the probability and the explanation.
     """
-    
-    payload = json.dumps({"image": img, "explain": explain, "precision": precision})
+
+    http = session or requests
+    if upload not in UPLOADS:
+        raise ValueError(f"Invalid upload: Should be one of {', '.join(UPLOADS)}")
+
+    fields = {"explain": str(explain).lower(), "precision": precision, "format": image_format}
+    if model is not None:
+        fields["model"] = model
+    if method is not None:
+        fields["method"] = method
+    if budget_ms is not None:
+        fields["budget_ms"] = budget_ms
+
+    try:
+        if isinstance(img, str) or upload == "json":
+            if not isinstance(img, str):
+                img = base64.b64encode(img).decode("utf8")
+            payload = json.dumps({"image": img, **fields, "explain": explain})
+            response = http.post(url, data=payload, headers=headers)
+        elif upload == "multipart":
+            files = {"image": ("image", img, image_mimetype(img))}
+            response = http.post(url, data=fields, files=files)
+        else:
+            response = http.post(url, params=fields, data=img,
+                                 headers={'Content-type': image_mimetype(img)})
+        return response.json()
+    except requests.exceptions.RequestException as e:
+        return {"success": False, "error": str(e)}
+
+
+def send_batch(images: list, url: str, model: Optional[str] = None,
+               session: Optional[requests.Session] = None) -> dict:
+    """Send several images to the batch endpoint of the server
+
+    Args:
+        images (list): (name, encoded image) pairs
+        url (str): URL of the batch endpoint (e.g. http://127.0.0.1:8089/predict_batch)
+        model (Optional[str], optional): Model used by the server. Defaults to the default model of the server.
+        session (Optional[requests.Session], optional): Session used to send the request (see make_session).
+            Defaults to a new connection.
+
+    Returns:
+        dict: Dictionary containing the results ("results"), one per image in the same order, with
+            the name of the image and its prediction and probability, or an error.
+    """
+
+    http = session or requests
+    files = [("images", (name, img, image_mimetype(img))) for name, img in images]
+    fields = {"model": model} if model is not None else {}
+
+    try:
+        return http.post(url, data=fields, files=files).json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        return {"success": False, "error": str(e)}
+
+
+def submit_explanation(img: bytes, url: str, precision: str = "Medium",
+                       image_format: str = "png", model: Optional[str] = None,
+                       method: Optional[str] = None, budget_ms: Optional[float] = None) -> dict:
+    """Start an explanation job on the server
+
+    Args:
+        img (bytes): Encoded image (e.g. content of a JPEG file)
+        url (str): URL of the explanation endpoint (e.g. http://127.0.0.1:8089/explain)
+        precision (str, optional): Precision of the explanation. Defaults to "Medium".
+            Can be "Low", "Medium", "High" or "Auto" (adaptive sampling).
+        image_format (str, optional): Encoding of the explanation (see send_image). Defaults to "png".
+        model (Optional[str], optional): Model used by the server. Defaults to the default model of the server.
+        method (Optional[str], optional): Explanation method, "lime" or "gradcam". Defaults to "lime".
+        budget_ms (Optional[float], optional): Time budget of the explanation in milliseconds (see send_image).
+            Defaults to the budget of the server.
+
+    Returns:
+        dict: Dictionary containing the id ("job") and the status of the job.
+    """
+
+    fields = {"precision": precision, "format": image_format}
+    if model is not None:
+        fields["model"] = model
+    if method is not None:
+        fields["method"] = method
+    if budget_ms is not None:
+        fields["budget_ms"] = budget_ms
+
     try:
-        response = requests.post(url, data=payload, headers=headers)
+        response = requests.post(url, params=fields, data=img,
+                                 headers={'Content-type': image_mimetype(img)})
         return response.json()
     except requests.exceptions.RequestException as e:
         return {"success": False, "error": str(e)}
+
+
+def get_explanation(url: str, job_id: str) -> dict:
+    """Get the status of an explanation job
+
+    Args:
+        url (str): URL of the explanation endpoint (e.g. http://127.0.0.1:8089/explain)
+        job_id (str): Id of the job
+
+    Returns:
+        dict: Dictionary containing the status ("queued", "running", "done" or "failed") and the
+            progress of the job, and once done the prediction, the probability and the explanation.
+    """
+
+    try:
+        return requests.get(f"{url}/{job_id}").json()
+    except requests.exceptions.RequestException as e:
+        return {"success": False, "error": str(e)}
+
+
+def _mark_boundaries(image: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Draw in yellow the boundaries of the regions of a mask
+
+    Args:
+        image (np.ndarray): Image with values in [0, 1]
+        mask (np.ndarray): Regions of the image
+
+    Returns:
+        np.ndarray: The image with the boundaries
+    """
+
+    boundaries = np.zeros(mask.shape, dtype=bool)
+    vertical = mask[1:, :] != mask[:-1, :]
+    horizontal = mask[:, 1:] != mask[:, :-1]
+    boundaries[1:, :] |= vertical
+    boundaries[:-1, :] |= vertical
+    boundaries[:, 1:] |= horizontal
+    boundaries[:, :-1] |= horizontal
+
+    image = image.copy()
+    image[boundaries] = (1, 1, 0)
+
+    return image
+
+
+def render_segments(image: np.ndarray, segments: np.ndarray, weights: list) -> np.ndarray:
+    """Rebuild the explanation overlay from the segments and their weights
+
+    Args:
+        image (np.ndarray): Original image (RGB)
+        segments (np.ndarray): Segment map of the image
+        weights (list): (segment, weight) pairs of the segments used by the model
+
+    Returns:
+        np.ndarray: The image with the segments used by the model, values in [0, 1]
+    """
+
+    temp = image.astype(np.float64)
+    mask = np.zeros(segments.shape, dtype=np.int8)
+
+    for segment, weight in weights:
+        region = segments == segment
+        mask[region] = -1 if weight < 0 else 1
+        temp[region, 0 if weight < 0 else 1] = np.max(image)
+
+    return _mark_boundaries(temp / 255.0, mask)
+
+
+def decode_explanation(data: dict, image: Optional[bytes] = None) -> Optional[np.ndarray]:
+    """Decode the explanation of a server response
+
+    Args:
+        data (dict): Response of the server
+        image (Optional[bytes], optional): Original image, needed for the "segments" format. Defaults to None.
+
+    Returns:
+        Optional[np.ndarray]: The explanation, None if the response has no explanation.
+    """
+
+    encoded = data.get("image")
+    if encoded is None:
+        return None
+
+    image_format = data.get("image_format", "json")
+
+    if image_format == "json":
+        return np.array(encoded)
+
+    buffer = base64.b64decode(encoded)
+
+    if image_format in ("png", "webp"):
+        return np.array(Image.open(io.BytesIO(buffer)))
+
+    if image_format == "raw":
+        return np.frombuffer(buffer, dtype=data["dtype"]).reshape(data["shape"])
+
+    if image is None:
+        raise ValueError("The original image is needed to decode the segments")
+
+    segments = np.frombuffer(zlib.decompress(buffer), dtype=data["dtype"]).reshape(data["shape"])
+    original = ImageOps.exif_transpose(Image.open(io.BytesIO(image))).convert("RGB")
+    if original.size != (segments.shape[1], segments.shape[0]):
+        # The server explains the images at the size of the model input
+        original = original.resize((segments.shape[1], segments.shape[0]), Image.BILINEAR)
+
+    return render_segments(np.array(original), segments, data["weights"])
@@ -0,0 +1,32 @@
+"""Launch the pre-fork production server (gunicorn, see gunicorn_config.py)
+
+    python src/serve.py [--workers 4] [--threads 2] [--bind 0.0.0.0:8089]
+
+The options default to the WORKERS, TORCH_THREADS, HTTP_THREADS and BIND environment variables.
+Without them, the cores of the host are split between workers of 2 torch threads.
+"""
+import argparse
+import os
+import shutil
+import sys
+
+SRC = os.path.dirname(os.path.abspath(__file__))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes. Default: cores / threads")
+    parser.add_argument("--threads", type=int, default=None, help="Torch threads per worker. Default: cores / workers")
+    parser.add_argument("--http_threads", type=int, default=None, help="Concurrent requests per worker. Default: 4")
+    parser.add_argument("--bind", type=str, default=None, help="Address of the server. Default: 0.0.0.0:8089")
+    args = parser.parse_args()
+
+    for name, value in (("WORKERS", args.workers), ("TORCH_THREADS", args.threads),
+                        ("HTTP_THREADS", args.http_threads), ("BIND", args.bind)):
+        if value is not None:
+            os.environ[name] = str(value)
+
+    gunicorn = shutil.which("gunicorn")
+    if gunicorn is None:
+        sys.exit("gunicorn is not installed (pip install gunicorn)")
+
+    os.execv(gunicorn, [gunicorn, "--chdir", SRC, "--config", os.path.join(SRC, "gunicorn_config.py"), "server:app"])
@@ -1,15 +1,59 @@
+import time
+START = time.perf_counter()
+
 from flask import Flask, request
-from model import HAM10000_model
-from explain import ExplainResults
+from model import load_model
+from explain import METHODS, ExplainResults
+from execution import ExecutionMode
+from quantize import load_quantized
+from backend import load_backend
+from registry import ModelRegistry
+from cache import ResultCache, image_digest
+from overlay import encode_explanation, negotiate_format
+from jobs import JobQueue, QueueFullError
+from preprocess import Preprocessor
+from segmentation import Segmenter
 import base64
 import json
 import io
+import itertools
 import torch
-from torchvision import transforms
-from PIL import Image
+from PIL import Image, ImageFile, ImageOps
+from typing import Optional, Tuple
 import os
 
 MODEL = os.environ.get("MODEL", "resnet34")
+MODELS = [name for name in os.environ.get("MODELS", MODEL).split(",") if name] or [MODEL]
+MODEL_MAX_LOADED = int(os.environ.get("MODEL_MAX_LOADED", 0)) or None
+MODEL_IDLE_TTL = float(os.environ.get("MODEL_IDLE_TTL", 0))
+MODEL_CHECK_INTERVAL = float(os.environ.get("MODEL_CHECK_INTERVAL", 2))
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 16))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", 5))
+CACHE_MAX_MB = float(os.environ.get("CACHE_MAX_MB", 512))
+CACHE_DIR = os.environ.get("CACHE_DIR") or None
+CACHE_DISK_MAX_MB = float(os.environ.get("CACHE_DISK_MAX_MB", 2048)) or None
+EXPLAIN_WORKERS = int(os.environ.get("EXPLAIN_WORKERS", 1))
+EXPLAIN_QUEUE_SIZE = int(os.environ.get("EXPLAIN_QUEUE_SIZE", 8))
+JOB_TTL = float(os.environ.get("JOB_TTL", 600))
+JOB_DIR = os.environ.get("JOB_DIR") or None
+BATCH_MAX_IMAGES = int(os.environ.get("BATCH_MAX_IMAGES", 64))
+SEGMENTATION = os.environ.get("SEGMENTATION", "quickshift")
+SEGMENTATION_SCALE = float(os.environ.get("SEGMENTATION_SCALE", 1))
+SEGMENTATION_CACHE_MB = float(os.environ.get("SEGMENTATION_CACHE_MB", 16))
+EXECUTION_MODE = ExecutionMode.from_name(os.environ.get("EXECUTION_MODE", "fp32"))
+MODEL_DIR = os.environ.get("MODEL_DIR", "/code/model")
+WARMUP = os.environ.get("WARMUP", "1") == "1"
+BACKEND = os.environ.get("BACKEND", "torch")
+BACKEND_THREADS = int(os.environ.get("BACKEND_THREADS", 0)) or None
+# Set by gunicorn_config.py: the module is imported by the master, then the workers are forked
+PREFORK = os.environ.get("PREFORK", "0") == "1"
+EXPLAIN_BUDGET_MS = float(os.environ.get("EXPLAIN_BUDGET_MS", 0)) or None
+
+CHECKPOINT_EXTENSION = {
+    "torch": "pth",
+    "torchscript": "ts",
+    "onnx": "onnx",
+}
 
 app = Flask(__name__)
 
@@ -23,21 +67,87 @@ LESION_TYPE = {
     6: 'Dermatofibroma'
 }
 
+BOOLEANS = {
+    "true": True,
+    "1": True,
+    "false": False,
+    "0": False,
+}
+
+CHUNK_SIZE = 64 * 1024
+
 PRECISION = {
     "Low": 50,
     "Medium": 200,
     "High": 1000,
 }
 
-model = HAM10000_model(len(LESION_TYPE), model_type=MODEL)
-model.load_state_dict(torch.load(f"/code/model/model_{MODEL}.pth"))
+# Adaptive sampling, up to the samples of "High"
+ADAPTIVE_PRECISION = "Auto"
+
+# Decodes, turns upright and resizes the images in uint8, then scales them to [0, 1]
+preprocess = Preprocessor((450, 600))
+# Shared by the models: the segment maps only depend on the image
+segmenter = Segmenter(SEGMENTATION, SEGMENTATION_SCALE, max_bytes=int(SEGMENTATION_CACHE_MB * 1024 * 1024))
+
+def checkpoint_path(name: str) -> str:
+    """Path to the checkpoint of a model, given the backend
+
+    Args:
+        name (str): Name of the model (e.g. resnet34, resnet34_int8)
+
+    Returns:
+        str: Path to the checkpoint
+    """
+
+    extension = CHECKPOINT_EXTENSION.get(BACKEND, "pth")
+    if BACKEND == "torch" and name.endswith("_int8"):
+        extension = "pt"
+
+    return f"{MODEL_DIR}/model_{name}.{extension}"
+
+def load_explainer(name: str, path: str) -> ExplainResults:
+    """Load a model and wrap it for the predictions and explanations
+
+    Args:
+        name (str): Name of the model
+        path (str): Path to the checkpoint
 
-transform = transforms.Compose([
-            transforms.ToTensor(), # Scale image to [0, 1]
-            transforms.Resize((450, 600)),
-        ])
+    Returns:
+        ExplainResults: The loaded model
+    """
 
-explain_model = ExplainResults(model, transform, LESION_TYPE)
+    model = None
+    if BACKEND != "torch":
+        backend = load_backend(BACKEND, path, execution=EXECUTION_MODE, threads=BACKEND_THREADS)
+    else:
+        if name.endswith("_int8"):
+            model = load_quantized(path)
+        else:
+            model = load_model(path, len(LESION_TYPE), model_type=name)
+        backend = load_backend(BACKEND, path, model=model, execution=EXECUTION_MODE)
+
+    explain_model = ExplainResults(model, preprocess, LESION_TYPE, execution=EXECUTION_MODE, backend=backend,
+                                   segmenter=segmenter)
+    if WARMUP:
+        explain_model.tensor_prediction(torch.zeros(1, 3, 450, 600))
+
+    return explain_model
+
+# The keys of the cache contain the version of the model (see ModelEntry.tag)
+cache = ResultCache(int(CACHE_MAX_MB * 1024 * 1024), "models", CACHE_DIR,
+                    int(CACHE_DISK_MAX_MB * 1024 * 1024) if CACHE_DISK_MAX_MB else None)
+registry = ModelRegistry(load_explainer, {name: checkpoint_path(name) for name in MODELS}, MODEL,
+                         BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, MODEL_MAX_LOADED, MODEL_IDLE_TTL,
+                         MODEL_CHECK_INTERVAL, on_reload=lambda entry: cache.discard(entry.tag))
+jobs = JobQueue(EXPLAIN_WORKERS, EXPLAIN_QUEUE_SIZE, JOB_TTL, JOB_DIR)
+
+# An ONNX Runtime session starts its thread pools when it is created, and they would not survive
+# the fork: each worker loads the model after the fork instead (see gunicorn_config.post_fork)
+if not (PREFORK and BACKEND == "onnx"):
+    registry.warmup()
+
+STARTUP_SECONDS = time.perf_counter() - START
 
 def return_error(error: str):
     return json.dumps({
@@ -45,38 +155,395 @@ def return_error(error: str):
         "error": error
     })
 
-@app.route("/predict", methods=['POST'])
-def prediction():
-    if not request.json or 'image' not in request.json:
-        return return_error("Missing image")
+def decode_stream(stream) -> Image.Image:
+    """Read an encoded image from a stream and decode it at the size of the model input
+
+    The formats that PIL decodes incrementally are decoded while the stream is read, without
+    holding the encoded file. The other formats, among which JPEG and PNG, can only be decoded
+    from the complete file: it is buffered, which lets JPEG images be decoded at reduced
+    resolution (see Preprocessor). ImageFile.Parser buffers these formats the same way.
+
+    Args:
+        stream: File-like object with the encoded image
+
+    Returns:
+        Image.Image: The decoded image
+    """
+
+    parser = ImageFile.Parser()
+    chunks = iter(lambda: stream.read(CHUNK_SIZE), b"")
+    head = []
+    for chunk in chunks:
+        head.append(chunk)
+        parser.feed(chunk)
+        if parser.image is not None:
+            break
+
+    if parser.decoder is not None:
+        for chunk in chunks:
+            parser.feed(chunk)
+        return preprocess.resize(ImageOps.exif_transpose(parser.close()))
+
+    buffer = io.BytesIO()
+    for chunk in itertools.chain(head, chunks):
+        buffer.write(chunk)
+
+    buffer.seek(0)
+    return preprocess.load(buffer)
+
+def read_fields(fields) -> dict:
+    """Read the options given as form or query fields
+
+    Args:
+        fields: Form or query fields of the request
+
+    Returns:
+        dict: The options, with explain converted to a boolean when possible
+    """
+
+    fields = fields.to_dict()
+    if 'explain' in fields:
+        fields['explain'] = BOOLEANS.get(fields['explain'].lower(), fields['explain'])
+
+    return fields
+
+def read_request() -> Tuple[Image.Image, dict]:
+    """Read the image and the options of a request. The image can be sent as a raw body
+    (options in the query string), as multipart/form-data (options in the form or the
+    query string) or encoded in base64 in a JSON body.
+
+    Raises:
+        ValueError: If the image is missing or invalid.
+
+    Returns:
+        Tuple[Image.Image, dict]: The image, the options
+    """
+
+    if request.is_json:
+        fields = request.get_json(silent=True)
+        if not fields or 'image' not in fields:
+            raise ValueError("Missing image")
         
-    try:
-        img = request.json['image']
-        img_bytes = base64.b64decode(img.encode('utf-8'))
-        img = Image.open(io.BytesIO(img_bytes))
+        try:
+            img_bytes = base64.b64decode(fields['image'].encode('utf-8'))
+            return preprocess.load(io.BytesIO(img_bytes)), fields
+        except Exception as e:
+            raise ValueError("Invalid image: " + str(e))
+
+    if request.mimetype == "multipart/form-data":
+        if 'image' not in request.files:
+            raise ValueError("Missing image")
         
+        stream = request.files['image'].stream
+        fields = read_fields(request.args)
+        fields.update(read_fields(request.form))
+    else:
+        stream = request.stream
+        fields = read_fields(request.args)
+
+    try:
+        return decode_stream(stream), fields
     except Exception as e:
-        return return_error("Invalid image: " + str(e))
+        raise ValueError("Invalid image: " + str(e))
+
+def read_images() -> Tuple[list, dict]:
+    """Read the images and the options of a batch request. The images can be sent as
+    multipart/form-data fields named images (options in the form or the query string) or
+    encoded in base64 in the images list of a JSON body (with an optional names list).
 
-    should_explain = request.json['explain'] if 'explain' in request.json else False
+    Raises:
+        ValueError: If the images are missing or too many, or if the names do not match the images.
+
+    Returns:
+        Tuple[list, dict]: (name, image) pairs, the image being None if it cannot be decoded, the options
+    """
+
+    if request.is_json:
+        fields = request.get_json(silent=True) or {}
+        encoded = fields.get('images')
+        if not isinstance(encoded, list) or not encoded:
+            raise ValueError("Missing images")
+
+        names = fields.get('names') or [str(i) for i in range(len(encoded))]
+        if not isinstance(names, list) or len(names) != len(encoded):
+            raise ValueError("Invalid names: Should be a list with one name per image")
+        streams = [(name, lambda data=data: io.BytesIO(base64.b64decode(data.encode('utf-8'))))
+                   for name, data in zip(names, encoded)]
+    elif request.mimetype == "multipart/form-data":
+        files = request.files.getlist('images')
+        if not files:
+            raise ValueError("Missing images")
+
+        fields = read_fields(request.args)
+        fields.update(read_fields(request.form))
+        streams = [(f.filename or str(i), lambda f=f: f.stream) for i, f in enumerate(files)]
+    else:
+        raise ValueError("The images should be sent as multipart/form-data or JSON")
+
+    if len(streams) > BATCH_MAX_IMAGES:
+        raise ValueError(f"Too many images: {len(streams)} (maximum: {BATCH_MAX_IMAGES})")
+
+    images = []
+    for name, stream in streams:
+        try:
+            images.append((name, decode_stream(stream())))
+        except Exception:
+            images.append((name, None))
+
+    return images, fields
+
+def read_options(fields: dict) -> Tuple[bool, int, str, str, str, Optional[float]]:
+    """Read the options of a prediction
+
+    Args:
+        fields (dict): Fields of the request (see read_request)
+
+    Raises:
+        ValueError: If an option is invalid.
+
+    Returns:
+        Tuple[bool, int, str, str, str, Optional[float]]: Should explain, number of LIME samples (the maximum
+            with adaptive sampling), format of the explanation, model, explanation method, time budget of
+            the explanation in seconds (None without adaptive sampling, inf without limit)
+    """
+
+    should_explain = fields.get('explain', False)
     if type(should_explain) is not bool:
-        return return_error("Invalid type for explain: Should be a boolean")
+        raise ValueError("Invalid type for explain: Should be a boolean")
         
-    precision = request.json['precision'] if 'precision' in request.json else "Medium"
-    precision = PRECISION.get(precision, 10)
+    precision = fields.get('precision', "Medium")
+    adaptive = precision == ADAPTIVE_PRECISION
+    precision = PRECISION["High"] if adaptive else PRECISION.get(precision, 10)
+
+    budget_ms = fields.get('budget_ms') or EXPLAIN_BUDGET_MS
+    if budget_ms is not None:
+        try:
+            budget_ms = float(budget_ms)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid budget_ms: Should be a number")
+        if not budget_ms > 0:
+            raise ValueError("Invalid budget_ms: Should be positive")
+    budget = budget_ms / 1000 if budget_ms is not None else (float("inf") if adaptive else None)
     
+    image_format = negotiate_format(fields.get('format'), request.headers.get('Accept'))
+
+    model = fields.get('model') or MODEL
+    if model not in registry:
+        raise ValueError(f"Unknown model: {model} (models: {', '.join(MODELS)})")
+
+    method = fields.get('method') or "lime"
+    if method not in METHODS:
+        raise ValueError(f"Invalid method: {method} (methods: {', '.join(METHODS)})")
+    if should_explain and method == "gradcam" and (BACKEND != "torch" or model.endswith("_int8")):
+        raise ValueError("Grad-CAM needs the eager PyTorch model (BACKEND=torch, not quantized)")
+
+    return should_explain, precision, image_format, model, method, budget
+
+def result_key(img: Image.Image, entry, should_explain: bool, precision: int, method: str,
+               adaptive: bool = False) -> str:
+    """Key of a result in the cache, depending on the version of the model and on the explanation
+
+    Args:
+        img (Image.Image): Image
+        entry (ModelEntry): Model
+        should_explain (bool): Is the prediction explained
+        precision (int): Number of LIME samples
+        method (str): Explanation method
+        adaptive (bool, optional): Is the LIME sampling adaptive (precision being the maximum). Defaults to False.
+
+    Returns:
+        str: The key
+    """
+
+    if not should_explain:
+        return ResultCache.key(image_digest(img), entry.tag, 0)
+    if method == "gradcam":
+        return ResultCache.key(image_digest(img), f"{entry.tag}-gradcam", 1)
+
+    name = f"{entry.tag}-{segmenter.name}-adaptive" if adaptive else f"{entry.tag}-{segmenter.name}"
+    return ResultCache.key(image_digest(img), name, precision)
+
+def predict(img: Image.Image, should_explain: bool, precision: int, model: str = None,
+            progress=None, method: str = "lime", budget: Optional[float] = None) -> Tuple[tuple, dict]:
+    """Predict (and explain) an image, using the cached results when possible
+
+    Args:
+        img (Image.Image): Image to classify
+        should_explain (bool): Should the prediction be explained
+        precision (int): Number of LIME samples
+        model (str, optional): Name of the model. Defaults to MODEL.
+        progress (Callable[[int, int], None], optional): Progress of the explanation. Defaults to None.
+        method (str, optional): Explanation method, "lime" or "gradcam". Defaults to "lime".
+        budget (Optional[float], optional): Time budget in seconds of a LIME explanation with adaptive
+            sampling (precision being the maximum number of samples). Defaults to None (fixed sampling).
+
+    Returns:
+        Tuple[tuple, dict]: (The prediction, The probability), The explanation (None if should_explain is False)
+    """
+
+    deadline = time.monotonic() + budget if budget is not None else None
+    with registry.use(model) as entry:
+        key = result_key(img, entry, should_explain, precision, method, adaptive=budget is not None)
+        cached = cache.get(key)
+
+        if cached is not None:
+            return cached
+
+        explain_model = entry.explain_model
+        if should_explain and method == "gradcam":
+            # Prediction and explanation come from the same forward pass
+            [(probs, explanation)] = entry.gradcam_batcher.submit(img)
+            lesion = explain_model.describe(probs)
+        else:
+            lesion = explain_model.describe(entry.batcher.submit(img))
+            explanation = explain_model.explanation(img, precision, progress=progress, adaptive=budget is not None,
+                                                    deadline=deadline) if should_explain else None
+
+        # An explanation cut by its deadline would be returned to requests with a larger budget
+        if explanation is None or explanation.get("convergence") != "deadline":
+            cache.put(key, lesion, explanation)
+
+    return lesion, explanation
+
+def predict_batch(images: list, model: str = None, should_explain: bool = False) -> list:
+    """Predict (and explain with Grad-CAM) several images with batched forward passes, using the
+    cached results when possible
+
+    Args:
+        images (list): Images to classify
+        model (str, optional): Name of the model. Defaults to MODEL.
+        should_explain (bool, optional): Explain the predictions with Grad-CAM. Defaults to False.
+
+    Returns:
+        list: (The prediction, The probability), The explanation (None if should_explain is False) of each image
+    """
+
+    with registry.use(model) as entry:
+        keys = [result_key(img, entry, should_explain, 0, "gradcam") for img in images]
+        results = [cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+
+        explain_model = entry.explain_model
+        for start in range(0, len(missing), BATCH_MAX_SIZE):
+            chunk = missing[start:start + BATCH_MAX_SIZE]
+            if should_explain:
+                outputs = explain_model.gradcam_explanations([images[i] for i in chunk])
+            else:
+                probs = explain_model.batch_prediction([images[i] for i in chunk])
+                outputs = [(probs[row:row + 1], None) for row in range(len(chunk))]
+
+            for i, (probs, explanation) in zip(chunk, outputs):
+                lesion = explain_model.describe(probs)
+                cache.put(keys[i], lesion, explanation)
+                results[i] = (lesion, explanation)
+
+    return results
+
+def encode_result(lesion: tuple, explanation: dict, image_format: str) -> dict:
+    return {
+        "success": True,
+        "prediction": lesion[0],
+        "probability": float(lesion[1]),
+        **encode_explanation(explanation, image_format)
+    }
+
+@app.route("/predict", methods=['POST'])
+def prediction():
+    try:
+        img, fields = read_request()
+        should_explain, precision, image_format, model, method, budget = read_options(fields)
+    except ValueError as e:
+        return return_error(str(e))
+    
+    # The image and the options are valid: a failure comes from the model (e.g. missing checkpoint)
     try:
-        lesion, mask = explain_model.prediction(img, should_explain, precision)
-        mask = mask.tolist() if mask is not None else None
+        lesion, explanation = predict(img, should_explain, precision, model, method=method, budget=budget)
     except Exception as e:
-        return return_error("Invalid image: " + str(e))
+        return return_error("Model error: " + str(e)), 500
         
+    return json.dumps(encode_result(lesion, explanation, image_format))
+
+@app.route("/predict_batch", methods=['POST'])
+def batch_prediction():
+    try:
+        images, fields = read_images()
+        should_explain, _, image_format, model, method, _ = read_options(fields)
+        if should_explain and method != "gradcam":
+            raise ValueError("Batches can only be explained with method=gradcam")
+    except ValueError as e:
+        return return_error(str(e))
+
+    valid = [img for _, img in images if img is not None]
+    try:
+        predictions = iter(predict_batch(valid, model, should_explain))
+    except Exception as e:
+        return return_error("Model error: " + str(e)), 500
+
+    results = []
+    for name, img in images:
+        if img is None:
+            results.append({"name": name, "success": False, "error": "Invalid image"})
+        elif should_explain:
+            results.append({"name": name, **encode_result(*next(predictions), image_format)})
+        else:
+            lesion, _ = next(predictions)
+            results.append({"name": name, "success": True, "prediction": lesion[0], "probability": float(lesion[1])})
+
+    return json.dumps({"success": True, "results": results})
+
+@app.route("/explain", methods=['POST'])
+def submit_explanation():
+    try:
+        img, fields = read_request()
+        fields['explain'] = True
+        _, precision, image_format, model, method, budget = read_options(fields)
+    except ValueError as e:
+        return return_error(str(e))
+
+    def run(job):
+        job.progress(0, precision)
+        lesion, explanation = predict(img, True, precision, model, progress=job.progress, method=method,
+                                      budget=budget)
+        # Adaptive sampling may stop before precision samples
+        samples = int(explanation["samples"]) if "samples" in explanation else precision
+        job.progress(samples, samples)
+        return encode_result(lesion, explanation, image_format)
+
+    try:
+        job = jobs.submit(run)
+    except QueueFullError as e:
+        return return_error(str(e)), 429
+
+    return json.dumps({"success": True, **job.to_dict()}), 202
+
+@app.route("/explain/<job_id>", methods=['GET'])
+def explanation_status(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return return_error("Unknown job: " + job_id), 404
+
+    return json.dumps({"success": job.status != "failed", **job.to_dict()})
+
+@app.route("/ready", methods=['GET'])
+def ready():
     return json.dumps({
-        "success": True,
-        "prediction": lesion[0],
-        "probability": float(lesion[1]),
-        "image": mask
-    })    
+        "ready": True,
+        "model": MODEL,
+        "models": MODELS,
+        "backend": BACKEND,
+        "startup_seconds": STARTUP_SECONDS
+    })
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    return json.dumps({
+        "pid": os.getpid(),
+        "threads": torch.get_num_threads(),
+        "models": registry.stats(),
+        "cache": cache.stats(),
+        "segmentation": segmenter.stats(),
+        "jobs": jobs.stats()
+    })
     
 if __name__ == "__main__":
     app.run("0.0.0.0", port=8089)
@@ -1,5 +1,15 @@
 import torch
-from typing import Tuple
+import torch.nn.functional as F
+from typing import Callable, Tuple
+
+try:
+    from .execution import ExecutionMode
+    from .instrument import NullInstrumentation
+    from .model import save_checkpoint
+except ImportError:
+    from execution import ExecutionMode
+    from instrument import NullInstrumentation
+    from model import save_checkpoint
 
 class SaveBestModel:
     def __init__(self, path: str, best_accuracy: float = 0) -> None:
@@ -24,19 +34,58 @@ class SaveBestModel:
 
         if accuracy > self.best_accuracy:
             self.best_accuracy = accuracy
-            torch.save(model.state_dict(), self.path)
+            save_checkpoint(model.state_dict(), self.path)
             
             return True
         
         return False
 
+class DistillationLoss(torch.nn.Module):
+    def __init__(self, alpha: float = 0.5, temperature: float = 4.0) -> None:
+        """Knowledge distillation loss: cross entropy with the labels mixed with the KL divergence
+        between the softened predictions of the model and of a teacher.
+        Args:
+            alpha (float, optional): Weight of the distillation term (0: labels only). Defaults to 0.5.
+            temperature (float, optional): Temperature of the softmax of both models. Defaults to 4.0.
+        """
+
+        super().__init__()
+        self.alpha = alpha
+        self.temperature = temperature
+
+    def forward(self, pred: torch.Tensor, y: torch.Tensor, teacher_pred: torch.Tensor = None) -> torch.Tensor:
+        """Compute the loss.
+        Args:
+            pred (torch.Tensor): Logits of the model.
+            y (torch.Tensor): Labels.
+            teacher_pred (torch.Tensor, optional): Logits of the teacher. Defaults to None (cross entropy only).
+
+        Returns:
+            torch.Tensor: The loss.
+        """
+
+        loss = F.cross_entropy(pred, y)
+        if teacher_pred is None:
+            return loss
+
+        t = self.temperature
+        distillation = F.kl_div(F.log_softmax(pred.float() / t, dim=1), F.log_softmax(teacher_pred.float() / t, dim=1),
+                                reduction="batchmean", log_target=True) * t * t
+
+        return (1 - self.alpha) * loss + self.alpha * distillation
+
 class Trainer:
     def __init__(self,
                  model: torch.nn.Module,
                  optimizer: torch.optim.Optimizer,
                  loss: torch.nn.Module,
                  device: str,
-                 scheduler: torch.optim.lr_scheduler.StepLR = None):
+                 scheduler: torch.optim.lr_scheduler.StepLR = None,
+                 batch_transform: Callable[[torch.Tensor], torch.Tensor] = None,
+                 eval_batch_transform: Callable[[torch.Tensor], torch.Tensor] = None,
+                 execution: ExecutionMode = None,
+                 instrumentation=None,
+                 teacher: torch.nn.Module = None):
         """Initialize the trainer.
         Args:
             model (torch.nn.Module): Model to train.
@@ -44,37 +93,84 @@ class Trainer:
             loss (torch.nn.Module): Loss function to use.
             device (str): Device to use (cuda or cpu).
             scheduler (torch.optim.lr_scheduler.StepLR): Scheduler to use. Defaults to None.
+            batch_transform (Callable[[torch.Tensor], torch.Tensor], optional): Transformation applied
+                to each training batch once on the device (e.g. BatchAugment). Defaults to None.
+            eval_batch_transform (Callable[[torch.Tensor], torch.Tensor], optional): Transformation
+                applied to each evaluation batch once on the device (e.g. to_float). Defaults to None.
+            execution (ExecutionMode, optional): Precision and memory format of the model. Defaults to fp32.
+            instrumentation (Instrumentation, optional): Records the timings of each step. Defaults to None (disabled).
+            teacher (torch.nn.Module, optional): Trained model whose logits are given to the loss as a third
+                argument during training (e.g. with DistillationLoss). Defaults to None.
         """
-        self.model = model.to(device)
+        self.instrumentation = instrumentation or NullInstrumentation()
+        self.execution = execution or ExecutionMode()
+        self.model = self.execution.prepare_model(model.to(device))
         self.optimizer = optimizer
         self.loss = loss
         self.scheduler = scheduler
         self.device = device
+        self.batch_transform = batch_transform
+        self.eval_batch_transform = eval_batch_transform
+        self.teacher = None
+        if teacher is not None:
+            self.teacher = self.execution.prepare_model(teacher.to(device)).eval()
+            for param in self.teacher.parameters():
+                param.requires_grad_(False)
 
-    def _train(self, dataloader: torch.utils.data.DataLoader) -> None:
+    def _train(self, dataloader: torch.utils.data.DataLoader) -> Tuple[float, float]:
         """Train the model for one epoch.
         Args:
             dataloader (torch.utils.data.DataLoader): Dataloader to use.
+
+        Returns:
+            Tuple[float, float]: Loss, accuracy, accumulated on the training batches during the epoch.
         """
         
+        size = len(dataloader.dataset)
+        num_batches = len(dataloader)
         self.model.train()
         
+        train_loss = torch.zeros((), device=self.device)
+        correct = torch.zeros((), device=self.device)
+        timer = self.instrumentation.timer("train")
         for _, (X, y) in enumerate(dataloader):
+            timer.mark("data")
             X = X.to(self.device)
             y = y.to(self.device)
+            timer.mark("copy")
+            
+            if self.batch_transform is not None:
+                X = self.batch_transform(X)
+            timer.mark("augment")
             
             # Compute prediction error
-            pred = self.model(X)
-            loss = self.loss(pred, y)
+            with self.execution.autocast(self.device):
+                X = self.execution.prepare_input(X)
+                pred = self.model(X)
+                if self.teacher is None:
+                    loss = self.loss(pred, y)
+                else:
+                    with torch.no_grad():
+                        teacher_pred = self.teacher(X)
+                    loss = self.loss(pred, y, teacher_pred)
+            timer.mark("forward")
             
             # Backpropagation
             self.optimizer.zero_grad()
             loss.backward()
+            timer.mark("backward")
             self.optimizer.step()
             
+            train_loss += loss.detach()
+            correct += (pred.detach().argmax(1) == y).sum()
+            timer.mark("optimizer")
+            timer.end(len(y))
+            
         if self.scheduler is not None:
             self.scheduler.step()
 
+        return train_loss.item() / num_batches, correct.item() / size
+
     def evaluate(self, dataloader: torch.utils.data.DataLoader) -> Tuple[float, float]:
         """Compute the loss and the accurary for a given dataloader.
         Args:
@@ -89,25 +185,57 @@ class Trainer:
         self.model.eval()
         
         test_loss, correct = 0, 0
-        with torch.no_grad():
+        timer = self.instrumentation.timer("eval")
+        with torch.inference_mode(), self.execution.autocast(self.device):
             for X, y in dataloader:
+                timer.mark("data")
                 X, y = X.to(self.device), y.to(self.device)
-                pred = self.model(X)
+                timer.mark("copy")
+                if self.eval_batch_transform is not None:
+                    X = self.eval_batch_transform(X)
+                timer.mark("augment")
+                pred = self.model(self.execution.prepare_input(X)).float()
                 test_loss += self.loss(pred, y).item()
                 correct += (pred.argmax(1) == y).type(torch.float).sum().item()
+                timer.mark("forward")
+                timer.end(len(y))
                 
         test_loss /= num_batches
         correct /= size
         
         return test_loss, correct
     
+    @staticmethod
+    def _subset_loader(dataloader: torch.utils.data.DataLoader, size: float,
+                       seed: int = 0) -> torch.utils.data.DataLoader:
+        """Dataloader on a fixed random subset of a dataloader.
+        Args:
+            dataloader (torch.utils.data.DataLoader): Dataloader to sample.
+            size (float): Number of samples (if > 1) or fraction of the dataset (if <= 1).
+            seed (int, optional): Seed of the subset. Defaults to 0.
+
+        Returns:
+            torch.utils.data.DataLoader: Dataloader on the subset.
+        """
+        
+        total = len(dataloader.dataset)
+        size = int(size * total) if size <= 1 else int(size)
+        generator = torch.Generator().manual_seed(seed)
+        indices = torch.randperm(total, generator=generator)[:max(size, 1)].tolist()
+        
+        return torch.utils.data.DataLoader(torch.utils.data.Subset(dataloader.dataset, indices),
+                                           batch_size=dataloader.batch_size,
+                                           num_workers=dataloader.num_workers,
+                                           collate_fn=dataloader.collate_fn,
+                                           pin_memory=dataloader.pin_memory)
+    
     def save(self, path: str) -> None:
         """Save the model.
         Args:
             path (str): Path to save the model.
         """
         
-        torch.save(self.model.to('cpu').state_dict(), path)
+        save_checkpoint(self.model.to('cpu').state_dict(), path)
         print(f"Model saved to {path}.")
    
     def train(self,
@@ -115,21 +243,37 @@ class Trainer:
               test_loader: torch.utils.data.DataLoader,
               epochs: int = 10,
               keep_best: bool = False,
-              path_best_model: str = "best_model.pth"
+              path_best_model: str = "best_model.pth",
+              eval_every: int = 1,
+              eval_subset: float = None
               ) -> Tuple[list, list, list, list]:
         """Train the model for a given number of epochs.
         
+        The train loss and accuracy are accumulated during the epoch (on the augmented batches,
+        while the model is updated) instead of running a second pass on the training set.
+        
         Args:
             train_loader (torch.utils.data.DataLoader): Dataloader for the training set.
             test_loader (torch.utils.data.DataLoader): Dataloader for the test set.
             epochs (int, optional): Number of epochs. Defaults to 10.
             keep_best (bool, optional): Keep the best model. Defaults to False.
             path_best_model (str, optional): Path to save the best model. Defaults to "best_model.pth".
+            eval_every (int, optional): Evaluate on the test set every eval_every epochs (and after the last epoch). Defaults to 1.
+            eval_subset (float, optional): Evaluate on a fixed random subset of the test set: number of samples (if > 1)
+                or fraction of the test set (if <= 1). Defaults to None (whole test set).
+            
+        Raises:
+            ValueError: If eval_every is below 1 or eval_subset is not positive.
             
         Returns:
-            Tuple[list, list, list, list]: Train loss, train accuracy, test loss, test accuracy.
+            Tuple[list, list, list, list]: Train loss, train accuracy, test loss, test accuracy (None for the epochs without evaluation).
         """
         
+        if eval_every < 1:
+            raise ValueError("eval_every should be at least 1")
+        if eval_subset is not None and eval_subset <= 0:
+            raise ValueError("eval_subset should be positive")
+        
         train_losses = [0] * epochs
         train_accuracies = [0] * epochs
         test_losses = [0] * epochs
@@ -137,10 +281,17 @@ class Trainer:
         
         save_model = SaveBestModel(path_best_model)
         
+        if eval_subset is not None:
+            test_loader = self._subset_loader(test_loader, eval_subset)
+        
         for e in range(epochs):
-            self._train(train_loader)
-            train_loss, train_accuracy = self.evaluate(train_loader)
-            test_loss, test_accuracy = self.evaluate(test_loader)
+            self.instrumentation.epoch = e + 1
+            train_loss, train_accuracy = self._train(train_loader)
+            
+            if (e + 1) % eval_every == 0 or e + 1 == epochs:
+                test_loss, test_accuracy = self.evaluate(test_loader)
+            else:
+                test_loss, test_accuracy = None, None
             
             train_losses[e] = train_loss
             train_accuracies[e] = train_accuracy
@@ -148,12 +299,15 @@ class Trainer:
             test_accuracies[e] = test_accuracy
                 
             saved = ""
-            if keep_best:
+            if keep_best and test_accuracy is not None:
                 saved = "---> Saved" if save_model(self.model, test_accuracy) else ""
             
+            if test_accuracy is None:
+                test = "Test loss: -, Test accuracy: -"
+            else:
+                test = f"Test loss: {test_loss:.4f}, Test accuracy: {test_accuracy:.4f} {saved}"
             print(f"Epoch {e + 1}/{epochs}, Train loss: {train_loss:.4f}, "
-                    f"Train accuracy: {train_accuracy:.4f}, Test loss: {test_loss:.4f}, "
-                    f"Test accuracy: {test_accuracy:.4f} {saved}")
+                    f"Train accuracy: {train_accuracy:.4f}, {test}")
                 
         if keep_best:
             self.model.load_state_dict(torch.load(path_best_model))
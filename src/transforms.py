@@ -0,0 +1,22 @@
+from torchvision import transforms
+
+# Augmentation of the training images, one PIL image at a time
+train_transform = transforms.Compose(
+    [
+        transforms.GaussianBlur(kernel_size=(5, 5)),
+        transforms.RandomPerspective(),
+        transforms.RandomRotation(180),
+        transforms.ToTensor(), # Scale image to [0, 1]
+    ])
+
+test_transform = transforms.Compose(
+    [
+        transforms.ToTensor(),
+    ])
+
+# Batched augmentation: the images are only converted to uint8 tensors in the
+# DataLoader, the augmentation runs on whole batches (see BatchAugment).
+batch_transform = transforms.Compose(
+    [
+        transforms.PILToTensor(),
+    ])
@@ -0,0 +1,53 @@
+"""Logits of the exported models (TorchScript, ONNX) against the eager PyTorch model.
+
+Run from the root of the repository:
+
+    python -m pytest tests
+"""
+import pytest
+import torch
+
+from src import HAM10000_model
+from src.backend import export_onnx, export_torchscript, load_backend
+
+TOLERANCE = 1e-3
+
+
+@pytest.fixture(scope="module")
+def model() -> torch.nn.Module:
+    torch.manual_seed(0)
+    return HAM10000_model(7, model_type="resnet18", pretrained=False).eval()
+
+
+@pytest.fixture(scope="module")
+def batch() -> torch.Tensor:
+    # Batch size different from the example of the export: the batch dimension must be dynamic
+    return torch.rand(3, 3, 96, 128, generator=torch.Generator().manual_seed(0))
+
+
+@pytest.fixture(scope="module")
+def expected(model, batch) -> torch.Tensor:
+    return load_backend("torch", None, model=model)(batch)
+
+
+def test_torchscript(model, batch, expected, tmp_path):
+    path = str(tmp_path / "model.ts")
+    export_torchscript(model, path, batch[:1])
+
+    logits = load_backend("torchscript", path)(batch)
+
+    assert logits.shape == expected.shape
+    assert torch.allclose(logits, expected, atol=TOLERANCE)
+
+
+def test_onnx(model, batch, expected, tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+
+    path = str(tmp_path / "model.onnx")
+    export_onnx(model, path, batch[:1])
+
+    logits = load_backend("onnx", path, threads=1)(batch)
+
+    assert logits.shape == expected.shape
+    assert torch.allclose(logits, expected, atol=TOLERANCE)